@@ -1,6 +1,6 @@
 #!/python
 from flask import Flask, jsonify, render_template, request, send_file, Response
-from flask_socketio import SocketIO, emit #sudo apt install python3-flask-socketio -y
+from flask_socketio import SocketIO, emit, join_room, leave_room #sudo apt install python3-flask-socketio -y
 import csv
 import io
 import subprocess
@@ -13,10 +13,25 @@ import time
 import threading
 import queue
 import logging
-import struct
 import math
+import os
+import zlib
+import argparse
+from can_socket import CANBatchReader, LinkStatsReader, pgn_filter
+from pgn_decoders import load_decoders
+from candump import replay_candump
+from j1939 import TransportReassembler, FastPacketAssembler, TP_CM_PGN, TP_DT_PGN, IDCache
+from binary_payloads import BINARY_SUFFIX, binary_streams, pack_stream
+import can_log
+import can_archive
+import downsample
+from log_buffer import LogBuffer, LOG_BUFFER_POLICIES, LOG_BUFFER_FRAMES
+from pgn_stats import StatsStore, BYTE_FIELDS, RECENT_WINDOW
+from discovery import SignalDiscovery
 
 DATABASE = 'can_messages.db'
+ARCHIVE_DIR = None  # with --archive-dir, every log session is also appended to <table>.canarc there
+PGN_DECODER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pgn_decoders.json')
 
 app = Flask(__name__)
 socketio = SocketIO(app, async_mode="eventlet", cors_allowed_origins="*")
@@ -163,26 +178,64 @@ def get_sa_name(sa):
     
 # Define the queues
 raw_data_queue = queue.Queue(5000)
-processed_data_queue = queue.Queue(5000)
+# Frames waiting for write_to_db; put() never blocks, see log_buffer.py
+processed_data_queue = LogBuffer(LOG_BUFFER_FRAMES, 'drop-oldest')
 summary_data_queue = queue.Queue(2) # this is a holding queue for data. 
 nav_data_queue = queue.Queue(5) # this is a holding queue for data.
+# Nothing may block process_data, so nav states that find nav_data_queue full are dropped
+nav_queue_stats = {'dropped': 0}
 
 # Setup CAN interfaces (adjust the settings according to your hardware)
 #can_interfaces = ['can0', 'can1']
 can_interfaces = ['can1']
 can_bitrates = [250000,]
 
-summary_data = {"total_count":0}
+# Rebuild multi-packet (TP.CM/TP.DT) and NMEA 2000 fast packet messages in process_data
+transport = TransportReassembler()
+fast_packets = FastPacketAssembler()
+
+summary_data = {"total_count":0, "transport":transport.stats, "fast_packet":fast_packets.stats,
+                "log_buffer":processed_data_queue.stats, "nav_queue":nav_queue_stats}
 for i in can_interfaces:
     summary_data[i] = { "name":f"{i}",
-                        "count":0,
-                        "source":{}
+                        "count":0
                        }
+
+# Per (interface, sa, pgn) statistics, kept raw by process_data (see pgn_stats.py)
+pgn_stats = StatsStore()
+# Fed every frame by process_data while /api/discovery has one running
+signal_discovery = None
+
+# The 'message' event only carries what changed since the previous one.
+# pgn_stats collects the entries process_data touched, and summary_view is
+# what every client has after merging all the updates so far; new
+# subscribers get it whole as a snapshot.
+summary_view = {"seq": 0}
+SUMMARY_TOP_KEYS = ("total_count", "logging", "can_filter", "transport", "fast_packet", "log_buffer", "nav_queue")
+
+# Socket.IO streams a page can subscribe to. Each is emitted to the room of
+# the same name, or of that name plus BINARY_SUFFIX for pages that asked for
+# the binary encoding, and its payload is only built while a room has members.
+STREAMS = ('message', 'ballast', 'nav_update', 'can_stats')
+stream_subscribers = {room: set() for stream in STREAMS for room in (stream, stream + BINARY_SUFFIX)}  # room: session ids
+
+def subscribed(stream):
+    return bool(stream_subscribers[stream] or stream_subscribers[stream + BINARY_SUFFIX])
+
+def emit_stream(stream, data):
+    # JSON to the plain room, encoded once for the binary room
+    if stream_subscribers[stream]:
+        socketio.emit(stream, data, to=stream)
+    binary_room = stream + BINARY_SUFFIX
+    if stream_subscribers[binary_room]:
+        socketio.emit(stream, pack_stream(stream, data), to=binary_room)
           
                 
 
 # Control flags for logging
 logging_active = threading.Event()
+write_thread = None
+log_table = None  # the table write_to_db logs to
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='app.py %(levelname)s:%(message)s')
@@ -192,76 +245,83 @@ UPDATE_PERIOD = 0.91  # seconds
 STATS_UPDATE_PERIOD = 0.29
 BALLAST_UPDATE_TIME = 0.37
 NAV_BROADCAST_PERIOD = 0.23
+CAN_BATCH_SIZE = 64  # max frames drained from the socket per system call
+
+# Decoders for the PGNs process_data turns into ballast and nav updates
+pgn_decoders = load_decoders(PGN_DECODER_FILE)
+
+# Kernel CAN_RAW_FILTER profiles for the reader sockets. "decode" only lets
+# through the PGNs that have a decoder; "full" captures every frame for the
+# J1939 display and logging, so logging always runs with it.
+CAN_FILTER_PROFILES = {
+    'decode': [pgn_filter(pgn, sa) for pgn, sa in pgn_decoders] + [pgn_filter(TP_CM_PGN), pgn_filter(TP_DT_PGN)],
+    'full': None,
+}
+can_filter_profile = summary_data['can_filter'] = 'full'
+can_readers = {}  # interface: CANBatchReader, so filters can be changed at runtime
 
-# Struct format for CAN frame
-can_frame_format = "<lB3x8s"
+# Interface counters and CAN state, shared by socket_can_data and /api/can_stats
+CAN_STATS_TTL = 0.5  # seconds
+can_link_stats = LinkStatsReader(CAN_STATS_TTL)
 
-# J1939 bit masks and shifts
-PRIORITY_MASK = 0x1C000000
-EDP_MASK = 0x02000000
-DP_MASK = 0x01000000
-PF_MASK = 0x00FF0000
-PS_MASK = 0x0000FF00
-SA_MASK = 0x000000FF
-PDU1_PGN_MASK = 0x03FF0000
-PDU2_PGN_MASK = 0x03FFFF00
+# J1939 fields and id text of the ids seen, per interface so each reader
+# thread counts its own hits (see j1939.IDCache). Made on first use.
+id_caches = {}
 
 def read_can_data(interface):
-    # Create a raw socket and bind it to the CAN interface
-    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
-    sock.bind((interface,))
-    logger.info(f"Listening on {interface}: {sock.getsockname()}")
+    # Create a raw socket bound to the CAN interface. Frames are drained in
+    # batches and each batch goes into raw_data_queue as a single list.
+    reader = CANBatchReader(interface, CAN_BATCH_SIZE, CAN_FILTER_PROFILES[can_filter_profile])
+    can_readers[interface] = reader
+    logger.info(f"Listening on {interface}: {reader.sock.getsockname()}")
     while True:
         try:
-            can_packet = sock.recv(16)
+            frames, stamps = reader.read()
         except OSError as e:
             logger.info(f"Reading {interface} failed with error {e}")
             time.sleep(1)
-            sock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
-            sock.bind((interface,))
+            reader.open()
             continue
 
-        can_time = time.time()
-        extended_frame,can_id, can_dlc, can_data, can_id_string = unpack_CAN(can_packet)
-        can_data_string = " ".join(["{:02X}".format(b) for b in can_data[:can_dlc]])
-        if extended_frame:
-            priority, pgn, da, sa = get_j1939_from_id(can_id)
-        else:
-            #11-bit IDs, so J1939 is not defined
-            priority = 0xE #out of range value
-            pgn = 0xFFFFE #made up no-sensical value
-            da = 0xFE #null
-            sa = 0xFE #null
+        batch = records_from_frames(interface, frames, stamps)
         try:
-            raw_data_queue.put((interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data[:can_dlc]))
-            logger.debug(f"Raw data put in queue: {interface} {sa} {pgn} {can_time} {da} {can_id_string} {can_data_string}")
-            summary_data['total_count']+=1
-            summary_data[interface]['count']+=1
+            raw_data_queue.put(batch)
+            logger.debug(f"Raw data batch of {len(batch)} frames put in queue from {interface}")
+            summary_data['total_count'] += len(batch)
+            summary_data[interface]['count'] += len(batch)
         except Exception as e:
             logger.warning(f"Failed to put data in raw_data_queue: {str(e)}")
 
-def get_j1939_from_id(can_id):
-    priority = (PRIORITY_MASK & can_id) >> 26
-    PF = (can_id & PF_MASK) >> 16
-    if PF >= 0xF0:  # PDU 2 format
-        DA = 255
-        PGN = (can_id & PDU2_PGN_MASK) >> 8
-    else:  # PDU 1 format
-        PGN = (can_id & PDU1_PGN_MASK) >> 8
-        DA = (can_id & PS_MASK) >> 8
-    SA = (can_id & SA_MASK)
-    return priority, PGN, DA, SA
-
-def unpack_CAN(can_packet):
-    can_id, can_dlc, can_data = struct.unpack(can_frame_format, can_packet)
-    extended_frame = bool(can_id & socket.CAN_EFF_FLAG)
-    if extended_frame:
-        can_id &= socket.CAN_EFF_MASK
-        can_id_string = "{:08X}".format(can_id)
-    else:  # Standard Frame
-        can_id &= socket.CAN_SFF_MASK
-        can_id_string = "{:03X}".format(can_id)
-    return extended_frame,can_id, can_dlc, can_data, can_id_string
+def replay_can_data(filename, interface, speed=1.0, loop=False):
+    # Stand-in for read_can_data that feeds a candump log into the same
+    # pipeline. The logged timestamps are kept; every frame is attributed
+    # to interface so it lands in that summary_data entry.
+    logger.info(f"Replaying {filename} as {interface} at speed {speed or 'max'}")
+    for frames, stamps in replay_candump(filename, speed, CAN_BATCH_SIZE, loop):
+        batch = records_from_frames(interface, frames, stamps)
+        try:
+            raw_data_queue.put(batch)
+            summary_data['total_count'] += len(batch)
+            summary_data[interface]['count'] += len(batch)
+        except Exception as e:
+            logger.warning(f"Failed to put data in raw_data_queue: {str(e)}")
+    logger.info(f"Finished replaying {filename}")
+    if interface in id_caches:
+        id_stats = id_caches[interface].stats
+        logger.info(f"Id cache hit rate {id_stats['hit_rate']:.1%} over {id_stats['ids']} ids")
+
+def records_from_frames(interface, frames, stamps):
+    # Convert (can_id, can_dlc, can_data) tuples from the reader and their
+    # kernel receive times into the records that process_data and write_to_db expect.
+    batch = []
+    id_cache = id_caches.get(interface)
+    if id_cache is None:
+        id_cache = id_caches[interface] = IDCache()
+    id_fields = id_cache.split_frames(frames)
+    for (can_id, can_dlc, can_data), can_time, (priority, pgn, da, sa, can_id_string) in zip(frames, stamps, id_fields):
+        can_data = can_data[:can_dlc]
+        batch.append((interface, sa, pgn, can_time, da, can_id_string, can_data.hex(' ').upper(), can_data))
+    return batch
 
 def autopilot():
     """
@@ -272,6 +332,118 @@ def autopilot():
         # Placeholder for autopilot logic
         time.sleep(1)  # Simulate some processing delay
 
+def summary_delta():
+    '''
+    Build the next 'message' update from the changed pgn_stats and merge it into
+    summary_view. PGN entries only carry the fields that changed, and std
+    only the bytes that changed; PGNs and sources nobody has seen yet come
+    with everything.
+    '''
+    seq = summary_view['seq'] + 1
+    delta = {'seq': seq, 'snapshot': False}
+    for key in SUMMARY_TOP_KEYS:
+        value = summary_data.get(key)
+        if isinstance(value, dict):
+            value = dict(value)
+        if value is not None and summary_view.get(key) != value:
+            delta[key] = summary_view[key] = value
+    summary_view['seq'] = seq
+
+    source_counts = {}
+    for stats in pgn_stats.take_changed():
+        interface, sa, pgn = stats.interface, stats.sa, stats.pgn
+        entry = stats.render()
+
+        view_interface = summary_view.setdefault(interface, {'name': interface, 'count': 0, 'source': {}})
+        view_interface['count'] = summary_data[interface]['count']
+        delta_interface = delta.setdefault(interface, {'name': interface, 'count': view_interface['count'], 'source': {}})
+
+        view_source = view_interface['source'].get(sa)
+        if view_source is None:
+            name = get_sa_name(sa)
+            view_source = view_interface['source'][sa] = {'address': sa, 'name': name, 'count': 0, 'pgns': {}}
+            delta_source = delta_interface['source'][sa] = {'address': sa, 'name': name, 'pgns': {}}
+        else:
+            delta_source = delta_interface['source'].setdefault(sa, {'pgns': {}})
+        count = source_counts.get((interface, sa))
+        if count is None:
+            count = source_counts[(interface, sa)] = pgn_stats.source_count(interface, sa)
+        view_source['count'] = delta_source['count'] = count
+
+        view_entry = view_source['pgns'].get(pgn)
+        if view_entry is None:
+            view_source['pgns'][pgn] = dict(entry)
+            delta_source['pgns'][pgn] = entry
+        else:
+            previous = {field: view_entry[field] for field in BYTE_FIELDS}
+            changed = {field: value for field, value in entry.items() if view_entry[field] != value}
+            view_entry.update(changed)
+            for field in BYTE_FIELDS:
+                if field in changed:
+                    # Only the bytes that moved, as {index: value}, so unchanging bytes send nothing
+                    changed[field] = {i: value for i, (value, old) in enumerate(zip(entry[field], previous[field]))
+                                      if value != old}
+            delta_source['pgns'][pgn] = changed
+    return delta
+
+def summary_snapshot():
+    return dict(summary_view, snapshot=True)
+
+def emit_to_client(stream, data):
+    # Reply to the client of the current event in the encoding it subscribed with
+    if request.sid in stream_subscribers[stream + BINARY_SUFFIX]:
+        data = pack_stream(stream, data)
+    emit(stream, data)
+
+@socketio.on('subscribe')
+def subscribe(request_data):
+    '''
+    Pages join the rooms of the streams they render, either with a list like
+    ['nav_update'] or with {"streams": [...], "binary": true} to get the
+    binary encoding of the streams that have one.
+    '''
+    binary = False
+    streams = request_data
+    if isinstance(request_data, dict):
+        streams = request_data.get('streams', [])
+        binary = bool(request_data.get('binary'))
+    if isinstance(streams, str):
+        streams = [streams]
+    for stream in streams:
+        if stream not in STREAMS:
+            continue
+        room = stream + BINARY_SUFFIX if binary and stream in binary_streams() else stream
+        for other in (stream, stream + BINARY_SUFFIX):
+            if other != room and request.sid in stream_subscribers[other]:
+                leave_room(other)
+                stream_subscribers[other].discard(request.sid)
+        join_room(room)
+        stream_subscribers[room].add(request.sid)
+        if stream == 'message':
+            emit_to_client('message', summary_snapshot())
+
+@socketio.on('unsubscribe')
+def unsubscribe(streams):
+    if isinstance(streams, dict):
+        streams = streams.get('streams', [])
+    if isinstance(streams, str):
+        streams = [streams]
+    for stream in streams:
+        if stream in STREAMS:
+            for room in (stream, stream + BINARY_SUFFIX):
+                leave_room(room)
+                stream_subscribers[room].discard(request.sid)
+
+@socketio.on('disconnect')
+def unsubscribe_all(reason=None):
+    for subscribers in stream_subscribers.values():
+        subscribers.discard(request.sid)
+
+@socketio.on('resync')
+def resync_summary():
+    # A client that missed an update asks for the whole view again
+    emit_to_client('message', summary_snapshot())
+
 def process_data():
     start_time = time.time()
     ballast_start_time = time.time()
@@ -286,156 +458,202 @@ def process_data():
         "steer":    None,   # helm angle or rate‑of‑turn
         "steer_goal": None  # desired helm / ROT
     }
+    update_stats = pgn_stats.update
+    decoder_sources = pgn_decoders.by_source
     while True:
         logger.debug(f"Queue size: {raw_data_queue.qsize()}")
         try: #while not raw_data_queue.empty():
-            (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data) = raw_data_queue.get(timeout=1)
-            logger.debug(f"Received queue: {interface} {sa} {pgn} {can_time} {da} {can_id_string} {can_data_string}")
+            batch = raw_data_queue.get(timeout=1)
+            logger.debug(f"Received batch of {len(batch)} frames from queue")
         except queue.Empty:
             # Timeout waiting for data — not a failure
             time.sleep(.05)   
             continue
         
-        try:
-            processed_data_queue.put((interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data))
-            
-            try:
-                summary_data[interface]["source"][sa]['count'] += 1
-            except KeyError:
-                summary_data[interface]["source"][sa] = {'count': 1, 'address': sa, 'name': get_sa_name(sa), 'pgns': {}}
+        if logging_active.is_set():
+            processed_data_queue.put(batch)
+        discovery = signal_discovery
+        if discovery is not None:
+            discovery.feed_records(batch)
+        # Multi-packet messages follow the frame that completes them
+        for record in fast_packets.expand(transport.expand(batch)):
+            (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data) = record
             try:
-                summary_data[interface]["source"][sa]['pgns'][pgn]['count'] += 1
-            except KeyError:
-                summary_data[interface]["source"][sa]['pgns'][pgn] = {'count': 1,'sums':[0,0,0,0,0,0,0,0],'sumsquared':[0,0,0,0,0,0,0,0] }  
-            try:
-                summary_data[interface]["source"][sa]['pgns'][pgn]['time_delta'] = "{:d}ms".format(
-                    int((can_time - summary_data[interface]["source"][sa]['pgns'][pgn]['time']) * 1000))
-            except KeyError:
-                summary_data[interface]["source"][sa]['pgns'][pgn]['time_delta'] = "-1ms"
-
-            summary_data[interface]["source"][sa]['pgns'][pgn]['time'] = can_time
-            summary_data[interface]["source"][sa]['pgns'][pgn]['id'] = can_id_string
-            summary_data[interface]["source"][sa]['pgns'][pgn]['da'] = da
-            summary_data[interface]["source"][sa]['pgns'][pgn]['data'] = can_data_string
-            
-            for i in range(len(can_data)):
-                summary_data[interface]["source"][sa]['pgns'][pgn]['sums'][i] += can_data[i]
-                summary_data[interface]["source"][sa]['pgns'][pgn]['sumsquared'][i] += can_data[i]**2
-            
-            if logging_active.is_set():
-                summary_data['logging'] = True
-            else:
-                summary_data['logging'] = False
-
-            if (can_time - start_time) > STATS_UPDATE_PERIOD:
-                start_time = can_time
-                socketio.emit('message', summary_data)  # Emit processed data to the WebSocket
-                logger.debug(f"emitted message: {summary_data}")
-
-            # Water level indicator added to the ballast pump lead tubes.
-            if sa == 57 and pgn == 0x1F211: # Matches arduino script
-                ballast_data["center_fill"]=bool(can_data[0])
-                ballast_data["port_fill"]=bool(can_data[1])
-                ballast_data["star_fill"]=bool(can_data[2])
-
-            elif pgn == 127245 and len(can_data) >= 2:          # Rudder Angle
-                angle = struct.unpack_from('<h', can_data)[0] * 0.0001 * 180/3.14159
-                nav_state["rudder"] = round(angle, 1)
-
-            elif pgn == 128259 and len(can_data) >= 2:          # Speed through water
-                spd = struct.unpack_from('<H', can_data)[0] * 0.01 * 1.94384  # m/s → kn
-                nav_state["speed"] = round(spd, 2)
-
-            elif pgn == 127237 and len(can_data) >= 2:          # Heading/Track control (goal)
-                goal = struct.unpack_from('<H', can_data)[0] * 0.0001 * 180/3.14159
-                nav_state["hdg_goal"] = round(goal, 1)
-
-            elif pgn == 127250 and len(can_data) >= 2:          # Actual vessel heading
-                hdg = struct.unpack_from('<H', can_data)[0] * 0.0001 * 180/3.14159
-                nav_state["heading"] = round(hdg, 1)
-
-            elif pgn == 61469 and len(can_data) >= 8:          # Steering angle (2nd field)
-                steer = (struct.unpack('<L', can_data[:4])[0] - 0x80000000)/1000
-                nav_state["steer"] = round(steer)
-                sgoal = (struct.unpack('<L', can_data[4:])[0] - 0x80000000)/1000
-                nav_state["steer_goal"] = round(sgoal)
-                nav_data_queue.put(nav_state)  # Add nav_state to the queue for later processing
-
-
-            if (can_time - ballast_start_time) > BALLAST_UPDATE_TIME:
-                ballast_start_time = can_time
-                socketio.emit('ballast', ballast_data)  # Emit processed data to the WebSocket
-                logger.info(f"ballast: {ballast_data}")
-                ballast_data={"center_fill": None,
-                              "port_fill": None,
-                              "star_fill": None}
+                update_stats(interface, sa, pgn, can_time, da, can_id_string, can_data)
+
+                if logging_active.is_set():
+                    summary_data['logging'] = True
+                else:
+                    summary_data['logging'] = False
+
+                if (can_time - start_time) > STATS_UPDATE_PERIOD:
+                    start_time = can_time
+                    # Changes keep collecting until a j1939_display client subscribes
+                    if subscribed('message'):
+                        delta = summary_delta()
+                        emit_stream('message', delta)  # Emit what changed to the WebSocket
+                        logger.debug(f"emitted message {delta['seq']}")
+
+                # Ballast fill tubes, nav and engine PGNs from pgn_decoders.json
+                sources = decoder_sources.get(pgn)
+                if sources is not None and not fast_packets.is_fragment(record):
+                    decoder = sources[sa]
+                    if decoder is not None:
+                        state = ballast_data if decoder.target == 'ballast' else nav_state
+                        if decoder.decode_into(can_data, state) and decoder.enqueue:
+                            try:
+                                nav_data_queue.put_nowait(nav_state)  # Add nav_state to the queue for later processing
+                            except queue.Full:
+                                nav_queue_stats['dropped'] += 1
+
+                if (can_time - ballast_start_time) > BALLAST_UPDATE_TIME:
+                    ballast_start_time = can_time
+                    if subscribed('ballast'):
+                        emit_stream('ballast', ballast_data)  # Emit processed data to the WebSocket
+                    logger.info(f"ballast: {ballast_data}")
+                    ballast_data={"center_fill": None,
+                                  "port_fill": None,
+                                  "star_fill": None}
                 
-            if (can_time - nav_start_time) > NAV_BROADCAST_PERIOD:
-                nav_start_time = can_time
-                socketio.emit('nav_update', nav_state)
-                logger.info(f"nav_update: {nav_state}")
-                nav_state = {
-                    "rudder":   None,   # degrees (+starboard, –port)
-                    "speed":    None,   # knots
-                    "hdg_goal": None,   # degrees True
-                    "heading":  None,   # degrees True
-                    "steer":    None,   # helm angle or rate‑of‑turn
-                    "steer_goal": None  # desired helm / ROT
-                }
-        except queue.Empty:
-            # Timeout waiting for data — not a failure
-            time.sleep(.005)
-        except Exception as e:
-            logger.exception("Error in process_raw_data")
-            time.sleep(1)  # Sleep to avoid busy-waiting in case of an error
+                if (can_time - nav_start_time) > NAV_BROADCAST_PERIOD:
+                    nav_start_time = can_time
+                    if subscribed('nav_update'):
+                        emit_stream('nav_update', nav_state)
+                    logger.info(f"nav_update: {nav_state}")
+                    nav_state = {
+                        "rudder":   None,   # degrees (+starboard, –port)
+                        "speed":    None,   # knots
+                        "hdg_goal": None,   # degrees True
+                        "heading":  None,   # degrees True
+                        "steer":    None,   # helm angle or rate‑of‑turn
+                        "steer_goal": None  # desired helm / ROT
+                    }
+            except Exception as e:
+                logger.exception("Error in process_raw_data")
+                time.sleep(1)  # Sleep to avoid busy-waiting in case of an error
 
 def socket_can_data(interface):
     while True:
-        data = get_can_stats(interface)
-        socketio.emit('can_stats', data)  # Emit processed data to the WebSocket
+        if subscribed('can_stats'):
+            data = get_can_stats(interface)
+            emit_stream('can_stats', data)  # Emit processed data to the WebSocket
         #logger.debug(f"emitted can_stats: {data}")
         time.sleep(1.09)
 
 def write_to_db(table_name):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    interface TEXT,
-                    sa INTEGER,
-                    pgn INTEGER,
-                    timestamp FLOAT,
-                    da INTEGER,
-                    can_id TEXT,
-                    data_hex TEXT,
-                    data_bytes BLOB,
-                    PRIMARY KEY (interface, sa, pgn, timestamp)
-                )
-            ''')
-    conn.commit()
-    cursor.close()
+    # One connection for the life of the thread. Each logging session (from
+    # start to stop, or until log_table changes) writes to one table, and that
+    # table gets its indexes once the session is over. Records the database
+    # turns away while an index build or /api/vacuum holds the write lock
+    # past the busy timeout are kept and go in first on the next round.
+    global log_table
+    log_table = table_name
+    conn = can_log.connect(DATABASE)
+    table = None
+    compact = True
+    archive = None
+    pending = []
     while True:
-        table_data = []
         time.sleep(UPDATE_PERIOD)
-        while not processed_data_queue.empty():
-            #data = (interface, sa, pgn, can_time, da, can_id, can_data_string, can_data)
-            data = processed_data_queue.get() 
-            table_data.append(data)
-        if logging_active.is_set():  # check to see if logging is active    
-            try:
-                conn = sqlite3.connect(DATABASE)
-                with conn:
-                    conn.executemany(f'''
-                        INSERT INTO {table_name} (interface, sa, pgn, timestamp, da, can_id, data_hex, data_bytes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', table_data)
-                    #logger.debug(f"Inserted {len(table_data)} lines into the database.")
-            except sqlite3.Error as e:
+        #records of (interface, sa, pgn, can_time, da, can_id, can_data_string, can_data)
+        table_data = processed_data_queue.take()
+        if pending:
+            table_data = pending + table_data
+            pending = []
+        try:
+            if logging_active.is_set():  # check to see if logging is active    
+                if table != log_table:
+                    if table is not None:
+                        finish_log_session(table, archive)
+                        table = None
+                        archive = None
+                    new_table = log_table
+                    compact = can_log.create_table(conn, new_table)
+                    if compact:
+                        can_log.drop_indexes(conn, new_table)  # rebuilt when the session ends
+                    table = new_table
+                    archive = open_archive(table, fresh=not can_log.has_rows(conn, table))
+                can_log.insert_records(conn, table, table_data, compact)
+                if archive is not None:
+                    archive.append(table_data)
+                #logger.debug(f"Inserted {len(table_data)} lines into the database.")
+            elif table is not None:
+                # Frames queued before logging stopped still belong to the session
+                if table_data:
+                    can_log.insert_records(conn, table, table_data, compact)
+                    if archive is not None:
+                        archive.append(table_data)
+                finish_log_session(table, archive)
+                table = None
+                archive = None
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
                 logger.warning(f"SQLite transaction error: {e}")
-            except Exception as e:
-                logger.warning(f"Database error: {e}")
-            finally:
-                conn.close()
+                continue
+            # Retry next round, holding no more than the log buffer would
+            overflow = len(table_data) - processed_data_queue.max_frames
+            if overflow > 0:
+                processed_data_queue.drop(overflow)
+                table_data = table_data[overflow:]
+            pending = table_data
+            logger.warning(f"SQLite database locked, retrying {len(pending)} frames: {e}")
+        except sqlite3.Error as e:
+            logger.warning(f"SQLite transaction error: {e}")
+        except Exception as e:
+            logger.warning(f"Database error: {e}")
+
+def open_archive(table_name, fresh):
+    # An archive holds every row of its table: a session on an empty table
+    # starts it over, one on a table with rows only appends to an existing one
+    if ARCHIVE_DIR is None:
+        return None
+    path = archive_path(table_name)
+    if not fresh and not os.path.exists(path):
+        logger.info(f"Not archiving {table_name}, it has rows from before archiving was on")
+        return None
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        return can_archive.ArchiveWriter(path, truncate=fresh)
+    except OSError as e:
+        logger.warning(f"Cannot open the archive for {table_name}: {e}")
+        return None
+
+def archive_path(table_name):
+    return os.path.join(ARCHIVE_DIR, f"{table_name}.canarc")
+
+def remove_archive(table_name):
+    # The archive of a deleted or dropped table; a writer still appending to
+    # it keeps an unlinked file, and the next empty session starts a new one
+    if ARCHIVE_DIR is None:
+        return
+    try:
+        os.remove(archive_path(table_name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Removing the archive of {table_name} failed: {e}")
+
+def finish_log_session(table_name, archive=None):
+    if archive is not None:
+        try:
+            archive.close()
+            logger.info(f"Archived {archive.frames} frames of {table_name}, "
+                        f"{os.path.getsize(archive_path(table_name))} bytes")
+        except OSError as e:
+            logger.warning(f"Closing the archive of {table_name} failed: {e}")
+    # Index the finished table on its own connection. The build holds the write
+    # lock throughout; write_to_db keeps and retries what it cannot insert meanwhile
+    def build():
+        conn = can_log.connect(DATABASE)
+        try:
+            start = time.time()
+            can_log.build_indexes(conn, table_name)
+            logger.info(f"Indexed {table_name} in {time.time() - start:.1f}s")
+        except sqlite3.Error as e:
+            logger.warning(f"Indexing {table_name} failed: {e}")
+        finally:
+            conn.close()
+    threading.Thread(target=build, daemon=True).start()
     
 
 ################################################
@@ -472,70 +690,158 @@ def get_db():
     conn.row_factory = sqlite3.Row
     return conn
 
+cataloging = set()  # tables catalog_table is summarising in the background
+
 @app.route('/api/tables', methods=['GET'])
 def get_tables():
-    # Connect to the SQLite database
+    '''
+    {table_name: row count} of the log tables with rows, from log_catalog.
+    With ?details=1, the whole catalog entry of every table instead (row
+    count, payload bytes, first and last time, interfaces, sas and pgns),
+    and "pending" for tables still being catalogued.
+    '''
     conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+    try:
+        catalog = can_log.read_catalog(conn)
+        tables = can_log.log_tables(conn)
+    finally:
+        conn.close()
 
-    # Execute the query to get the list of tables
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    
-    # Fetch all results
-    tables = cursor.fetchall()
-    
-    non_zero_tables = {}
-    
-    # Check the row count of each table
-    for table in tables:
-        table_name = table[0]
-        cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-        count = cursor.fetchone()[0]
-        if count > 0:
-            non_zero_tables[table_name] = count
-    
-    # Close the connection
-    conn.close()
-    
-    return jsonify(non_zero_tables)
+    # Tables from before the catalog get counted once, off the request
+    for table_name in tables:
+        if table_name not in catalog and table_name not in cataloging:
+            cataloging.add(table_name)
+            threading.Thread(target=catalog_table, args=(table_name,), daemon=True).start()
+
+    if request.args.get('details') == '1':
+        return jsonify({"tables": {name: catalog[name] for name in tables if name in catalog},
+                        "pending": sorted(name for name in tables if name not in catalog)})
+    return jsonify({name: catalog[name]['rows'] for name in tables if name in catalog and catalog[name]['rows'] > 0})
+
+def catalog_table(table_name):
+    conn = can_log.connect(DATABASE)
+    try:
+        start = time.time()
+        can_log.catalog_table(conn, table_name)
+        logger.info(f"Catalogued {table_name} in {time.time() - start:.1f}s")
+    except sqlite3.Error as e:
+        logger.warning(f"Cataloguing {table_name} failed: {e}")
+    finally:
+        conn.close()
+        cataloging.discard(table_name)
     
         
 def is_valid_hex(can_id):
     # Check if the string contains only valid hex characters
     return bool(re.fullmatch(r'[0-9A-Fa-f]+', can_id))
 
+MESSAGES_PAGE_SIZE = 1000
+MESSAGES_MAX_PAGE_SIZE = 10000
+
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
-    conn = get_db()
-    cursor = conn.cursor()
-    
+    '''
+    Page through a log table in time order.
+
+    table_name   required
+    can_id       hex ids, any number
+    start, end, interface, sa, pgn
+                 as for /api/download
+    fields       comma separated subset of can_log.QUERY_FIELDS
+    limit        rows per page, up to MESSAGES_MAX_PAGE_SIZE
+    after        the "next" value of the previous page
+
+    Returns {"fields": [...], "rows": [[...], ...], "next": cursor or null}.
+    '''
     table_name = request.args.get('table_name')
     can_ids = request.args.getlist('can_id')
     
     if not table_name:
         return jsonify({"error": "table_name parameter is required"}), 400
-    if not can_ids:
-        return jsonify({"error": "can_id parameter is required"}), 400
     
     # Validate can_id values
     for can_id in can_ids:
         if not is_valid_hex(can_id):
             return jsonify({"error": f"Invalid can_id value: {can_id}"}), 400
-    
+
+    fields = tuple(request.args.get('fields', ','.join(can_log.QUERY_FIELDS)).split(','))
+    for field in fields:
+        if field not in can_log.QUERY_FIELDS:
+            return jsonify({"error": f"Unknown field: {field}"}), 400
+    try:
+        filters = log_filters(request.args)
+        limit = min(int(request.args.get('limit', MESSAGES_PAGE_SIZE)), MESSAGES_MAX_PAGE_SIZE)
+        after = request.args.get('after')
+        if after:
+            timestamp, rowid = after.split(':')
+            after = (float(timestamp), int(rowid))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+
+    conn = sqlite3.connect(DATABASE)
     try:
-        query = f"SELECT * FROM {table_name} WHERE can_id IN ({','.join('?' for _ in can_ids)})"
-        cursor.execute(query, can_ids)
-        rows = cursor.fetchall()
-        messages = [dict(row) for row in rows]
-        return jsonify(messages)
+        rows, cursor = can_log.query_frames(conn, table_name, fields, can_ids, after, limit, **filters)
+        return jsonify({"fields": fields, "rows": rows,
+                        "next": f"{cursor[0]!r}:{cursor[1]}" if cursor else None})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
-        cursor.close()
         conn.close()
 
+@app.route('/api/signal', methods=['GET'])
+def get_signal():
+    '''
+    A logged signal reduced to plot size.
+
+    table_name   required
+    signal       a signal name from pgn_decoders.json (rudder, engine_rpm,
+                 fluid_level_0, ...), or
+    pgn & byte   a raw data byte of that PGN
+    start, end, interface, sa, pgn
+                 as for /api/download
+    width        points wanted, about the plot width in pixels
+    method       minmax (default): columns t, min, max, mean, last, count
+                 per time bucket; lttb: columns t and value
+    '''
+    table_name = request.args.get('table_name')
+    if not table_name:
+        return jsonify({"error": "table_name parameter is required"}), 400
+    method = request.args.get('method', 'minmax')
+    if method not in ('minmax', 'lttb'):
+        return jsonify({"error": f"Unknown method: {method}"}), 400
+    try:
+        filters = log_filters(request.args)
+        width = max(1, min(int(request.args.get('width', 800)), downsample.MAX_WIDTH))
+        byte = request.args.get('byte')
+        byte = int(byte) if byte else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+
+    conn = sqlite3.connect(DATABASE)
+    try:
+        result = {"signal": request.args.get('signal'), "method": method}
+        result.update(downsample.downsample(conn, table_name, pgn_decoders, width, method, request.args.get('signal'),
+                                            byte, filters['pgns'], filters['sas'], filters['interfaces'],
+                                            filters.get('start'), filters.get('end')))
+        return jsonify(result)
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e).strip("'")}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/build_indexes', methods=['POST'])
+def build_indexes():
+    # For tables logged before indexes were built at the end of a session
+    table_name = request.json.get('table_name')
+    if not table_name:
+        return jsonify({"error": "Table name is required"}), 400
+    finish_log_session(table_name)
+    return jsonify({"status": f"Indexing {table_name} in the background"}), 202
+
 @app.route('/api/delete_table', methods=['POST'])
 def delete_table():
     logger.info("Delete table data has been requested.")
@@ -548,27 +854,93 @@ def delete_table():
     
     if not table_name:
         return jsonify({"error": "table_name parameter is required"}), 400
-    
+
+    if not table_exists(table_name):
+        return jsonify({"success":False, "error": f"no such table: {table_name}"}), 404
+
+    # A job swaps in an empty table, once any earlier job is done, and then frees the old one's space
+    job = start_table_job('delete', table_name)
+    return jsonify({"success":True, "job": job['id'],
+                    "message": f"Deleting the contents of {table_name} in the background"}), 202
+
+################################################
+# Table jobs
+# Deleting a multi-GB table and giving its space back to the SD card runs
+# in a thread, so neither the eventlet server nor the database writer waits
+# for it. A job first swaps the table out under a deleting_ name (an empty
+# one takes its place for 'delete'), then drops it an object at a time and
+# shrinks the file with incremental_vacuum. Poll /api/table_jobs for progress.
+table_jobs = {}  # job id: job dict
+table_jobs_lock = threading.Lock()
+table_job_runner = threading.Lock()  # held by the running job; they all need the write lock
+
+def table_exists(table_name):
+    conn = sqlite3.connect(DATABASE)
     try:
-        #connect to the database
-        conn = get_db()
-        cursor = conn.cursor()
-    
-        query = f"DELETE FROM {table_name}"
-        cursor.execute(query)
-        conn.commit()
-        cursor.execute("VACUUM")
-        conn.commit()
-        
-    except sqlite3.Error as e:
-        return jsonify({"success":False, "error": str(e)}), 500    
-    except Exception as e:
-        return jsonify({"success":False, 'error': str(e)}), 500
+        return table_name in can_log.log_tables(conn)
     finally:
-        cursor.close()
         conn.close()
-    logger.info(f"Table {table_name} deleted successfully")
-    return jsonify({"success":True, "message": f"Table {table_name} deleted successfully"}), 200
+
+def start_table_job(action, table_name=None):
+    with table_jobs_lock:
+        job = {"id": len(table_jobs) + 1, "action": action, "table": table_name, "phase": "queued",
+               "progress": 0.0, "started": time.time(), "finished": None, "error": None,
+               "pages_freed": 0}
+        table_jobs[job["id"]] = job
+    threading.Thread(target=run_table_job, args=(job,), daemon=True).start()
+    return job
+
+def run_table_job(job):
+    with table_job_runner:
+        conn = can_log.connect(DATABASE)
+        try:
+            def progress(phase, start, weight):
+                def report(done, total):
+                    job["progress"] = round(start + weight*done/max(total, 1), 3)
+                job["phase"] = phase
+                return report
+
+            if job["action"] == 'vacuum':
+                job["phase"] = "vacuum"
+                can_log.convert_to_incremental(conn)
+            else:
+                job["phase"] = "swap"
+                can_log.swap_out_table(conn, job["table"], keep=job["action"] == 'delete')
+                downsample.forget_table(job["table"])
+                remove_archive(job["table"])
+                job["progress"] = 0.05
+                # Also whatever an interrupted job left behind
+                trash = can_log.trash_tables(conn)
+                for i, name in enumerate(trash):
+                    can_log.drop_trash(conn, name, progress("drop", 0.05 + 0.25*i/len(trash), 0.25/len(trash)))
+            job["pages_freed"] = can_log.reclaim_space(conn, progress("reclaim", 0.3, 0.7))
+            job["phase"] = "done"
+            job["progress"] = 1.0
+            logger.info(f"Table job {job['action']} {job['table']} done, {job['pages_freed']} pages freed")
+        except sqlite3.Error as e:
+            job["phase"] = "failed"
+            job["error"] = str(e)
+            logger.warning(f"Table job {job['action']} {job['table']} failed: {e}")
+        finally:
+            job["finished"] = time.time()
+            conn.close()
+
+@app.route('/api/table_jobs', methods=['GET'])
+def get_table_jobs():
+    return jsonify(list(table_jobs.values()))
+
+@app.route('/api/table_jobs/<int:job_id>', methods=['GET'])
+def get_table_job(job_id):
+    job = table_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), 404
+    return jsonify(job)
+
+@app.route('/api/vacuum', methods=['POST'])
+def vacuum_database():
+    # One full VACUUM, as a job, to give a database from before auto_vacuum=INCREMENTAL the ability to shrink
+    job = start_table_job('vacuum')
+    return jsonify({"job": job['id']}), 202
 
 @app.route('/api/download_db', methods=['POST'])
 def download_db():
@@ -576,45 +948,117 @@ def download_db():
                      as_attachment=True,
                      download_name=f'{DATABASE}')
 
-def generate_csv( table_name, chunk_size=100000):
-    # Connect to the SQLite database
-    conn =  get_db()
-    cursor = conn.cursor()
-
-    # Get column headers
-    cursor.execute(f"SELECT * FROM {table_name} LIMIT 1")
-    headers = [description[0] for description in cursor.description]
-
-    # Create a CSV writer that writes to an in-memory list
-    yield ','.join(headers) + '\n'  # Write header row
-
-    offset = 0
-    while True:
-        # Fetch a chunk of rows
-        cursor.execute(f"SELECT * FROM {table_name} LIMIT {chunk_size} OFFSET {offset}")
-        rows = cursor.fetchall()
-        if not rows:
-            break
-
-        # Write rows to CSV format and yield each row
-        for row in rows:
-            yield ','.join(map(str, row)) + '\n'
+def parse_number(value):
+    # Source addresses and PGNs as decimal or 0x hex
+    return int(value, 0)
 
-        # Move to the next chunk
-        offset += chunk_size
+def log_filters(values):
+    '''
+    Keyword arguments for can_log.filter_clause from request values:
+    start and end (epoch seconds), and any number of interface, sa and pgn.
+    Raises ValueError for values that do not parse.
+    '''
+    filters = {}
+    for name in ('start', 'end'):
+        if values.get(name):
+            filters[name] = float(values[name])
+    filters['interfaces'] = [interface for interface in values.getlist('interface') if interface]
+    filters['sas'] = [parse_number(sa) for sa in values.getlist('sa') if sa]
+    filters['pgns'] = [parse_number(pgn) for pgn in values.getlist('pgn') if pgn]
+    return filters
+
+def generate_csv(table_name, filters=None, chunk_size=10000):
+    '''
+    Yield the table as CSV text, a block of chunk_size rows at a time,
+    read with keyset pagination so the whole export is one pass over the
+    table.
+    '''
+    conn = sqlite3.connect(DATABASE)
+    try:
+        # Compact tables are written out with the columns of the old schema
+        compact = can_log.is_compact(conn, table_name)
+        if compact:
+            headers = can_log.LEGACY_COLUMNS[:-1]
+            columns = can_log.COMPACT_COLUMNS
+        else:
+            headers = columns = can_log.table_columns(conn, table_name)
+        where, params = can_log.filter_clause(**(filters or {}))
+
+        block = io.StringIO()
+        writer = csv.writer(block, lineterminator='\n')
+        writer.writerow(headers)
+        for rows in can_log.iter_chunks(conn, table_name, columns, where, params, chunk_size):
+            if compact:
+                rows = [can_log.legacy_row(*row)[:-1] for row in rows]
+            writer.writerows(rows)
+            yield block.getvalue()
+            block.seek(0)
+            block.truncate()
+        yield block.getvalue()
+    finally:
+        conn.close()
 
-    # Close the database connection
-    conn.close()
+def gzip_stream(chunks, level=6):
+    # Compress text chunks on the fly into one gzip stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
 
 @app.route('/api/download', methods=['POST'])
 def download_table():
+    '''
+    Stream a table as CSV. Optional form fields: start, end, interface, sa
+    and pgn to filter the rows, and gzip=1 for a .csv.gz file. Browsers
+    that accept gzip get the plain CSV gzip encoded on the wire.
+    '''
     table_name = request.form['table_name']
     if not table_name:
         return jsonify({"error": "table_name parameter is required"}), 400
+    try:
+        filters = log_filters(request.values)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+
+    filename = "can_data_output.csv"
+    if request.values.get('gzip') == '1':
+        response = Response(gzip_stream(generate_csv(table_name, filters)), mimetype='application/gzip')
+        filename += '.gz'
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(gzip_stream(generate_csv(table_name, filters)), mimetype='text/csv')
+        response.headers.set("Content-Encoding", "gzip")
+    else:
+        response = Response(generate_csv(table_name, filters), mimetype='text/csv')
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    return response
 
-    # Stream the CSV to the browser
-    response = Response(generate_csv(table_name), mimetype='text/csv')
-    response.headers.set("Content-Disposition", "attachment", filename="can_data_output.csv")
+@app.route('/api/download_archive', methods=['POST'])
+def download_archive():
+    table_name = request.form['table_name']
+    if not table_name:
+        return jsonify({"error": "table_name parameter is required"}), 400
+    if not re.fullmatch(r'\w+', table_name):
+        return jsonify({"error": "Invalid table name"}), 400
+    if not table_exists(table_name):
+        return jsonify({"error": f"no such table: {table_name}"}), 404
+
+    # The file written while logging, unless that session is still running
+    if ARCHIVE_DIR is not None and os.path.exists(archive_path(table_name)) and \
+            not (logging_active.is_set() and table_name == log_table):
+        return send_file(os.path.abspath(archive_path(table_name)), as_attachment=True,
+                         download_name=f"{table_name}.canarc")
+
+    # Otherwise build it from the table while it streams
+    def generate():
+        conn = sqlite3.connect(DATABASE)
+        try:
+            yield from can_archive.generate_archive(conn, table_name)
+        finally:
+            conn.close()
+    response = Response(generate(), mimetype='application/octet-stream')
+    response.headers.set("Content-Disposition", "attachment", filename=f"{table_name}.canarc")
     return response
 
 def get_ip_address():
@@ -631,41 +1075,104 @@ def get_ip():
     return jsonify({'ip': ip_address})
 
 
+# Columns of `ip -statistics`, which the page shows, and the counters behind them
+CAN_STATS_RX_COLUMNS = (('bytes', 'rx_bytes'), ('packets', 'rx_packets'), ('errors', 'rx_errors'),
+                        ('dropped', 'rx_dropped'), ('missed', 'rx_missed_errors'), ('mcast', 'multicast'))
+CAN_STATS_TX_COLUMNS = (('bytes', 'tx_bytes'), ('packets', 'tx_packets'), ('errors', 'tx_errors'),
+                        ('dropped', 'tx_dropped'), ('carrier', 'tx_carrier_errors'), ('collsns', 'collisions'))
+
 def get_can_stats(interface):
-    # Command to get CAN statistics with detailed information
-    command = f"ip -details -statistics link show {interface}"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
+    # CAN statistics with detailed information, read over rtnetlink. Keeps
+    # the fields and formatting of the `ip -details -statistics` parse it replaced.
+    try:
+        link = can_link_stats.get(interface)
+    except OSError as e:
+        logger.debug(f"Reading link statistics for {interface} failed: {e}")
         return {"error": "Failed to retrieve CAN statistics"}
-    
-    # Parsing the result
+
     stats = {}
-    stat_lines = result.stdout.split('\n')
-    for line in range(len(stat_lines)):
-        if 'can state' in stat_lines[line]:
-            stats['CANstate'] = stat_lines[line].strip().split()[2]
-            if "ERROR" in stats['CANstate']:
-                stats['CANstate'] = stats['CANstate'].split('-')[-1]
-        elif 'bitrate' in stat_lines[line]:
-            bitrate = int(stat_lines[line].strip().split()[1])//1000
-            stats['CANbitrate'] = f"{bitrate}k"
-        elif 'RX:' in stat_lines[line]:
-            rx_header = stat_lines[line].strip().split()[1:] #Remove the "RX:"
-            rx_line = stat_lines[line+1].strip().split()
-            for k,v in zip(rx_header,rx_line):
-                stats['CANRX'+k] = f"{int(v)//1024}kB"
-        elif 'TX:' in stat_lines[line]:
-            tx_header = stat_lines[line].strip().split()[1:] #Remove the "TX:"
-            tx_line = stat_lines[line+1].strip().split()
-            for k,v in zip(tx_header,tx_line):
-                stats['CANTX'+k] = v
+    state = link.get('can_state')
+    if state is not None:
+        stats['CANstate'] = state.split('-')[-1] if "ERROR" in state else state
+    if 'bitrate' in link:
+        stats['CANbitrate'] = f"{link['bitrate']//1000}k"
+    if 'rx_bytes' in link:
+        for column, counter in CAN_STATS_RX_COLUMNS:
+            stats['CANRX'+column] = f"{link[counter]//1024}kB"
+        for column, counter in CAN_STATS_TX_COLUMNS:
+            stats['CANTX'+column] = str(link[counter])
+    id_cache = id_caches.get(interface)
+    if id_cache is not None:
+        stats['IDCacheIDs'] = str(id_cache.stats['ids'])
+        stats['IDCacheHitRate'] = f"{id_cache.stats['hit_rate']:.1%}"
     return {interface:stats}
 
 @app.route('/api/can_stats', methods=['GET'])
 def can_stats():
+    interface = request.args.get('interface', can_interfaces[0])
     stats = get_can_stats(interface)
     return jsonify(stats)
 
+def set_can_filter_profile(profile):
+    global can_filter_profile
+    can_filter_profile = summary_data['can_filter'] = profile
+    for interface, reader in can_readers.items():
+        reader.set_filters(CAN_FILTER_PROFILES[profile])
+        logger.info(f"Applied CAN filter profile {profile} on {interface}")
+
+def capture_all_frames():
+    # Logging keeps every frame, so leave the 'decode' profile when it starts
+    if can_filter_profile == 'full':
+        return
+    try:
+        set_can_filter_profile('full')
+    except OSError as e:
+        logger.warning(f"Switching to the full CAN filter profile for logging failed: {e}")
+
+@app.route('/api/can_filter', methods=['GET', 'POST'])
+def can_filter():
+    if request.method == 'POST':
+        post_data = request.get_json(silent=True) or request.form
+        profile = post_data.get('profile')
+        if profile not in CAN_FILTER_PROFILES:
+            return jsonify({"error": f"Unknown filter profile: {profile}"}), 400
+        if profile != 'full' and logging_active.is_set():
+            return jsonify({"error": "Logging needs the full filter profile, stop logging first"}), 409
+        try:
+            set_can_filter_profile(profile)
+        except OSError as e:
+            return jsonify({"error": str(e)}), 500
+    return jsonify({"profile": can_filter_profile, "profiles": list(CAN_FILTER_PROFILES)})
+
+@app.route('/api/discovery', methods=['GET', 'POST'])
+def discovery_api():
+    # Find the fields that follow a console control (see discovery.py). POST
+    # {"action": "start"}, then "event_start"/"event_end" around every use of
+    # the control, and GET the ranking; "stop" drops the engine.
+    global signal_discovery
+    if request.method == 'POST':
+        post_data = request.get_json(silent=True) or request.form
+        action = post_data.get('action')
+        if action == 'start':
+            signal_discovery = SignalDiscovery()
+        elif action == 'stop':
+            signal_discovery = None
+        elif action not in ('event_start', 'event_end'):
+            return jsonify({"error": f"Unknown discovery action: {action}"}), 400
+        elif signal_discovery is None:
+            return jsonify({"error": "No discovery is running"}), 409
+        elif action == 'event_start':
+            signal_discovery.start_event()
+        else:
+            signal_discovery.end_event()
+    discovery = signal_discovery
+    if discovery is None:
+        return jsonify({"running": False})
+    top = request.args.get('top', default=20, type=int)
+    min_score = request.args.get('min_score', default=0.05, type=float)
+    return jsonify({"running": True, "in_event": discovery.in_event(), "stats": discovery.stats,
+                    "results": discovery.results(top, min_score)})
+
 def start_can(bitrate,interface='can0'):
     '''
     For this function to work, we need to run `sudo visudo` and add the following lines:
@@ -721,6 +1228,9 @@ def system_shutdown():
 
 @app.route('/start_logging', methods=['GET'])
 def start_logging():
+    if write_thread is None or not write_thread.is_alive():
+        start_writer(log_table or "can_data")
+    capture_all_frames()
     logging_active.set()
     return jsonify({"status": "Logging started"}), 200
 
@@ -736,12 +1246,22 @@ def restart_logging():
         return jsonify({"error": "Table name is required"}), 400
     
     logging_active.clear()
+    global log_table
+    if write_thread is not None and write_thread.is_alive():
+        # The running writer ends its session and moves on to the new table
+        log_table = table_name
+    else:
+        start_writer(table_name)
+    capture_all_frames()
+    logging_active.set()
+    return jsonify({"status": f"Logging restarted with table {table_name}"}), 200
+
+def start_writer(table_name):
+    # Without a writer nothing drains processed_data_queue and frames only get dropped
     global write_thread
     write_thread = threading.Thread(target=write_to_db, args=(table_name,))
     write_thread.daemon = True
     write_thread.start()
-    logging_active.set()
-    return jsonify({"status": f"Logging restarted with table {table_name}"}), 200
 
 @app.route('/drop_table', methods=['POST'])
 def drop_table():
@@ -749,34 +1269,55 @@ def drop_table():
     if not table_name:
         return jsonify({"error": "Table name is required"}), 400
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(f"DROP TABLE IF EXISTS {table_name}")
-    conn.commit()
-    conn.close()
-    return jsonify({"status": f"Table {table_name} dropped"}), 200
+    if not table_exists(table_name):
+        return jsonify({"error": f"no such table: {table_name}"}), 404
+    job = start_table_job('drop', table_name)
+    return jsonify({"status": f"Dropping table {table_name} in the background", "job": job['id']}), 202
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ballast controller HMI")
+    parser.add_argument('--replay', metavar='LOG', help="replay a candump log instead of reading the CAN interfaces")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier, 0 for as fast as possible")
+    parser.add_argument('--loop', action='store_true', help="start the replay over when the log ends")
+    parser.add_argument('--log-buffer', type=int, default=LOG_BUFFER_FRAMES, metavar='FRAMES',
+                        help="frames held for the database writer before the overflow policy applies")
+    parser.add_argument('--log-overflow', choices=LOG_BUFFER_POLICIES, default='drop-oldest',
+                        help="what to do with frames the database writer cannot keep up with")
+    parser.add_argument('--spill-dir', help="directory for --log-overflow spill files (default: system temp)")
+    parser.add_argument('--archive-dir', help="also append every log session to a compressed .canarc archive here")
+    parser.add_argument('--stats-window', type=float, default=RECENT_WINDOW, metavar='SECONDS',
+                        help="how far back the recent per byte statistics on the J1939 display reach")
+    args = parser.parse_args()
+
+    ARCHIVE_DIR = args.archive_dir
+    pgn_stats.window = args.stats_window
+
+    processed_data_queue = LogBuffer(args.log_buffer, args.log_overflow, args.spill_dir)
+    summary_data["log_buffer"] = processed_data_queue.stats
+
     #socketio.run(app, host='0.0.0.0', port=5000, debug=False)
     # Define the threads for reading CAN data
     logger.info(f"Setting up read and information threads for {can_interfaces}")
     read_threads = []
     info_threads = []
-    for interface in can_interfaces:
-        ##t = threading.Thread(target=read_can_data, args=(interface,))
-        #info = threading.Thread(target=socket_can_data, args=(interface,))
-        socketio.start_background_task(read_can_data, interface)
-        socketio.start_background_task(socket_can_data, interface)
+    if args.replay:
+        socketio.start_background_task(replay_can_data, args.replay, can_interfaces[0], args.speed, args.loop)
+    else:
+        for interface in can_interfaces:
+            ##t = threading.Thread(target=read_can_data, args=(interface,))
+            #info = threading.Thread(target=socket_can_data, args=(interface,))
+            socketio.start_background_task(read_can_data, interface)
+            socketio.start_background_task(socket_can_data, interface)
     
     
-        # t.daemon = True
-        # info.daemon = True
-        # read_threads.append(t)
-        # info_threads.append(info)
-        # t.start()
-        # info.start()
+            # t.daemon = True
+            # info.daemon = True
+            # read_threads.append(t)
+            # info_threads.append(info)
+            # t.start()
+            # info.start()
     logger.info(f"Started {len(read_threads)} read threads and {len(info_threads)} info threads.")
 
     logger.info(f"Setting up data processing thread.")
@@ -0,0 +1,275 @@
+'''
+Whole-session decoding with NumPy, for offline analysis.
+
+/api/messages hands out a logged table one dict per row, and the live
+decoders in pgn_decoders.py work a frame at a time. Here a session, a log
+table, a .canarc archive or a candump log, is loaded into one structured
+array of FRAME_DTYPE:
+
+    timestamp   float seconds
+    interface   index into the interface names returned alongside
+    can_id      with CAN_EFF_FLAG for 29-bit ids, like the log tables
+    priority, pgn, da, sa
+                the J1939 fields of 29-bit ids, split with the
+                get_j1939_from_id masks over the whole column at once;
+                11-bit ids get the made up values records_from_frames uses
+    dlc         payload length
+    data        the first 8 payload bytes, zero padded, so
+                frames['data'] is an (n, 8) uint8 matrix
+
+and decode_signals() runs every pgn_decoders.json decoder over all the
+matching rows in a handful of array operations per signal, so a million
+frames decode in a fraction of a second.
+
+    python3 batch_decode.py can_messages.db can_data --save can_data.npz
+    python3 batch_decode.py ../SystemDesign/2012_MC_X30_CAN/MCx30_TowerUpDownButton.log
+'''
+import argparse
+import os
+import socket
+import sqlite3
+import time
+
+import numpy as np  # sudo apt install python3-numpy -y
+
+import can_archive
+import can_log
+from j1939 import (PRIORITY_MASK, PF_MASK, PS_MASK, SA_MASK, PDU1_PGN_MASK, PDU2_PGN_MASK)
+from pgn_decoders import load_decoders
+
+FRAME_DTYPE = np.dtype([('timestamp', '<f8'), ('interface', 'u1'), ('can_id', '<u4'), ('priority', 'u1'),
+                        ('pgn', '<u4'), ('da', 'u1'), ('sa', 'u1'), ('dlc', 'u1'), ('data', 'u1', (8,))])
+# struct codes of pgn_decoders.json signals as NumPy types
+SIGNAL_TYPES = {'B': '<u1', 'b': '<i1', 'H': '<u2', 'h': '<i2', 'L': '<u4', 'l': '<i4', 'I': '<u4', 'i': '<i4',
+                'Q': '<u8', 'q': '<i8'}
+CHUNK_ROWS = 65536
+PADDING = bytes(8)
+
+
+def split_ids(frames):
+    # Fill priority, pgn, da and sa from can_id
+    can_id = frames['can_id']
+    extended = (can_id & socket.CAN_EFF_FLAG) != 0
+    raw = can_id & socket.CAN_EFF_MASK
+    pdu2 = (raw & PF_MASK) >> 16 >= 0xF0
+    frames['priority'] = np.where(extended, (raw & PRIORITY_MASK) >> 26, 0xE)
+    frames['pgn'] = np.where(extended, np.where(pdu2, (raw & PDU2_PGN_MASK) >> 8, (raw & PDU1_PGN_MASK) >> 8),
+                             0xFFFFE)
+    frames['da'] = np.where(extended, np.where(pdu2, 0xFF, (raw & PS_MASK) >> 8), 0xFE)
+    frames['sa'] = np.where(extended, raw & SA_MASK, 0xFE)
+
+def make_frames(timestamps, interfaces, can_ids, payloads):
+    '''
+    Build a FRAME_DTYPE array from equal length sequences of timestamps,
+    interface indexes, can_ids and payload bytes.
+    '''
+    frames = np.zeros(len(can_ids), dtype=FRAME_DTYPE)
+    if not len(frames):
+        return frames
+    frames['timestamp'] = timestamps
+    frames['interface'] = interfaces
+    frames['can_id'] = can_ids
+    frames['dlc'] = np.fromiter(map(len, payloads), np.uint8, len(payloads))
+    padded = b''.join([(payload + PADDING)[:8] for payload in payloads])
+    frames['data'] = np.frombuffer(padded, np.uint8).reshape(-1, 8)
+    split_ids(frames)
+    return frames
+
+def interface_index(names, interface):
+    index = names.get(interface)
+    if index is None:
+        index = names[interface] = len(names)
+    return index
+
+def load_table(conn, table_name, chunk_size=CHUNK_ROWS):
+    '''
+    Return (frames, interface names) for a log table, compact or legacy,
+    in rowid order.
+    '''
+    compact = can_log.is_compact(conn, table_name)
+    columns = ('timestamp', 'interface', 'can_id', 'data' if compact else 'data_bytes')
+    names = {}
+    chunks = []
+    id_values = {}  # legacy hex id strings, a few hundred of them
+    for rows in can_log.iter_chunks(conn, table_name, columns, chunk_size=chunk_size):
+        timestamps, interfaces, can_ids, payloads = zip(*rows)
+        if not compact:
+            can_ids = [id_values.get(can_id) or id_values.setdefault(can_id, can_log.can_id_value(can_id))
+                       for can_id in can_ids]
+        lookup = {interface: interface_index(names, interface) for interface in set(interfaces)}
+        if len(lookup) == 1:
+            interfaces = lookup[interfaces[0]]
+        else:
+            interfaces = [lookup[interface] for interface in interfaces]
+        chunks.append(make_frames(timestamps, interfaces, can_ids, payloads))
+    frames = np.concatenate(chunks) if chunks else np.zeros(0, dtype=FRAME_DTYPE)
+    return frames, list(names)
+
+def load_archive(source):
+    # (frames, interface names) of a .canarc archive; its columns go straight in
+    names = {}
+    chunks = []
+    for chunk in can_archive.read_chunks(source):
+        remap = np.array([interface_index(names, name) for name in chunk.interface_names], np.uint8)
+        lengths = np.frombuffer(chunk.lengths, np.uint16)
+        frames = np.zeros(len(chunk), dtype=FRAME_DTYPE)
+        frames['timestamp'] = chunk.times
+        frames['interface'] = remap[np.frombuffer(chunk.interfaces, np.uint8)]
+        frames['can_id'] = np.frombuffer(chunk.can_ids, np.uint32)
+        frames['dlc'] = np.minimum(lengths, 255)
+        # Scatter the first 8 bytes of every payload into the data matrix
+        payload = np.frombuffer(chunk.payload, np.uint8)
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)[:-1]))
+        data = frames['data']
+        for i in range(8):
+            present = lengths > i
+            data[present, i] = payload[offsets[present] + i]
+        split_ids(frames)
+        chunks.append(frames)
+    frames = np.concatenate(chunks) if chunks else np.zeros(0, dtype=FRAME_DTYPE)
+    return frames, list(names)
+
+def load_candump(filename):
+    '''
+    (frames, interface names) of a candump -l log. RTR and CAN FD lines
+    are left out.
+    '''
+    times = []
+    interfaces = []
+    can_ids = []
+    payloads = []
+    names = {}
+    id_values = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].startswith('('):
+                continue
+            can_id_string, sep, data_string = fields[2].partition('#')
+            if not sep or data_string[:1] in ('#', 'R'):
+                continue
+            can_id = id_values.get(can_id_string)
+            if can_id is None:
+                can_id = id_values[can_id_string] = can_log.can_id_value(can_id_string)
+            times.append(fields[0][1:-1])
+            interfaces.append(interface_index(names, fields[1]))
+            can_ids.append(can_id)
+            payloads.append(data_string)
+    timestamps = np.array(times, dtype=np.float64) if times else np.zeros(0)
+    payloads = [bytes.fromhex(payload) for payload in payloads]
+    return make_frames(timestamps, interfaces, can_ids, payloads), list(names)
+
+def load_session(source, table_name=None):
+    '''
+    (frames, interface names) of a log table in the SQLite database
+    source, or of a .canarc archive or candump log file.
+    '''
+    if table_name is not None:
+        conn = sqlite3.connect(source)
+        try:
+            return load_table(conn, table_name)
+        finally:
+            conn.close()
+    with open(source, 'rb') as f:
+        is_archive = f.read(len(can_archive.ARCHIVE_MAGIC)) == can_archive.ARCHIVE_MAGIC
+    if is_archive:
+        return load_archive(source)
+    return load_candump(source)
+
+
+def raw_field(data, start, type):
+    # The little endian field of struct code type at byte start of every row
+    dtype = np.dtype(SIGNAL_TYPES[type])
+    return np.ascontiguousarray(data[:, start:start + dtype.itemsize]).view(dtype)[:, 0]
+
+def signal_values(signal, data):
+    # A decoder signal over the rows of data, like PGNDecoder.decode_into
+    values = raw_field(data, signal.start, signal.type)
+    if signal.mask is not None:
+        values = (values & signal.mask) >> signal.shift
+    if signal.is_bool:
+        return values != 0
+    if not signal.offset and signal.scale == 1:
+        return values.astype(np.int64)  # the raw field, as decode() leaves it
+    values = values.astype(np.float64)
+    if signal.offset:
+        values += signal.offset
+    if signal.scale != 1:
+        values *= signal.scale
+    if signal.digits == 0:
+        return np.round(values).astype(np.int64)
+    if signal.digits is not None:
+        return np.round(values, signal.digits)
+    return values
+
+def decoder_rows(frames, registry, decoder):
+    # Mask of the frames decoder applies to: its PGN, its source (a decoder
+    # for that exact source wins over an any-source one) and long enough
+    rows = frames['pgn'] == decoder.pgn
+    if decoder.sa is not None:
+        rows &= frames['sa'] == decoder.sa
+    else:
+        for sa in registry.by_pgn[decoder.pgn]:
+            if sa is not None:
+                rows &= frames['sa'] != sa
+    return rows & (frames['dlc'] >= decoder.struct.size)
+
+def decode_signals(frames, registry, names=None):
+    '''
+    Decode every signal of the decoders in registry over frames. Returns
+    {signal name: (timestamps, values)}; indexed decoders give one entry
+    per index value, named like the live ones (fluid_level_2). names
+    limits the result to those signals.
+    '''
+    found = {}
+    for decoder in registry.values():
+        if decoder.struct.size > 8:
+            continue  # multi-packet messages are logged as their fragments
+        rows = decoder_rows(frames, registry, decoder)
+        if not rows.any():
+            continue
+        selected = frames[rows]
+        data = selected['data']
+        timestamps = selected['timestamp']
+        if decoder.index is None:
+            for signal in decoder.signals:
+                if names is None or signal.name in names:
+                    found[signal.name] = (timestamps, signal_values(signal, data))
+            continue
+        suffixes = signal_values(decoder.signals[decoder.index], data)
+        for i, signal in enumerate(decoder.signals):
+            if i == decoder.index:
+                continue
+            values = signal_values(signal, data)
+            for suffix in np.unique(suffixes):
+                name = f'{signal.name}_{suffix}'
+                if names is None or name in names:
+                    same = suffixes == suffix
+                    found[name] = (timestamps[same], values[same])
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode a logged session with NumPy")
+    parser.add_argument('source', help="SQLite database, .canarc archive or candump log")
+    parser.add_argument('table', nargs='?', help="log table, when source is a database")
+    parser.add_argument('--decoders', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'pgn_decoders.json'))
+    parser.add_argument('--save', metavar='NPZ', help="write the frames and decoded signals to a .npz file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    frames, interface_names = load_session(args.source, args.table)
+    loaded = time.perf_counter()
+    signals = decode_signals(frames, load_decoders(args.decoders))
+    decoded = time.perf_counter()
+    print(f"{len(frames)} frames on {', '.join(interface_names) or 'no interface'}: "
+          f"loaded in {loaded - start:.3f} s, decoded in {decoded - loaded:.3f} s")
+    for name, (timestamps, values) in sorted(signals.items()):
+        print(f"  {name:<24} {len(values):8d} values  last {values[-1]}")
+    if args.save:
+        arrays = {'frames': frames, 'interfaces': np.array(interface_names)}
+        for name, (timestamps, values) in signals.items():
+            arrays[f'{name}.t'] = timestamps
+            arrays[name] = values
+        np.savez_compressed(args.save, **arrays)
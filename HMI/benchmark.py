@@ -0,0 +1,782 @@
+#!/python
+'''
+Benchmarks for the HMI CAN pipeline.
+
+Run from the HMI directory, e.g.
+    python3 benchmark.py reader
+    python3 benchmark.py reader --interface vcan0
+    python3 benchmark.py decode
+    python3 benchmark.py pipeline --json results.json
+    python3 benchmark.py stats --interface can1
+    python3 benchmark.py sqlite --dir /path/on/the/sd/card
+
+The reader benchmark compares the old one-recv-per-frame loop with the batched
+reader in frames per CPU-second. Without --interface it replays frames from a
+candump log out of memory, so only the user space cost is measured. With
+--interface it sends frames on a (v)can interface and measures the reading
+thread, system calls included.
+
+The decode benchmark runs the candump logs through the old if/elif chain
+from process_data and through the pgn_decoders registry.
+
+The pipeline benchmark runs the real process_data and write_to_db threads
+against injected traffic, for each combination of bus load and interface
+count. It reports frames/s, frame-to-processed latency (p50/p99, from the
+receive stamp until process_data has finished the frame and made any emit
+it triggers), queue high-water marks, the time readers spent blocked on a
+full raw_data_queue, the SQLite insert rate, and the size and encode time
+of each Socket.IO update as JSON and in its binary encoding. Traffic is
+synthetic J1939/NMEA 2000 frames or, with --log, a candump capture re-timed
+to the requested load. --json writes the results, and --compare checks a
+run against an earlier --json file. Each scenario runs in its own forked
+process so the app's module state starts clean.
+
+The stats benchmark times get_can_stats over rtnetlink, with and without
+its cache, against the `ip -details -statistics` subprocess it replaced.
+
+The sqlite benchmark logs full two-bus traffic the way write_to_db used to
+(a new connection per batch, rollback journal, a (interface, sa, pgn,
+timestamp) primary key and the id and data stored as text and blob) and
+the way it does now (one WAL connection, compact rowid table, indexes after
+the session), and reports sustained rows/s, bytes per row and the index
+build time, next to appending the same frames to a .canarc archive
+(can_archive.py). Use --dir to run it on the SD card rather than in /tmp.
+'''
+import argparse
+import glob
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import struct
+
+import app
+from can_socket import CANBatchReader, can_frame_struct, CAN_FRAME_SIZE
+from candump import read_candump
+from pgn_decoders import DecoderRegistry
+from j1939 import j1939_id, get_j1939_from_id
+from binary_payloads import binary_streams, pack_stream
+import can_log
+import can_archive
+from log_buffer import LogBuffer, LOG_BUFFER_FRAMES
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SystemDesign', '2012_MC_X30_CAN')
+DEFAULT_LOG = os.path.join(LOG_DIR, 'MCx30_startup_switches_empyt_steeringturn.log')
+
+# Standard 11-bit id used to tell the live reader that the sender is done
+STOP_ID = 0x7FF
+
+# A 29-bit frame with 8 data bytes plus interframe space, without bit stuffing
+CAN_FRAME_BITS = 134
+INJECT_TICK = 0.01  # seconds between injected batches at a fixed load
+
+def load_packets(filename):
+    # Pack every frame of a candump log into a 16 byte can_frame
+    return [can_frame_struct.pack(can_id, can_dlc, can_data)
+            for timestamp, interface, can_id, can_dlc, can_data in read_candump(filename)]
+
+def unpack_CAN(can_packet):
+    # The original per frame unpacking, kept for the legacy path
+    can_id, can_dlc, can_data = struct.unpack("<lB3x8s", can_packet)
+    extended_frame = bool(can_id & socket.CAN_EFF_FLAG)
+    if extended_frame:
+        can_id &= socket.CAN_EFF_MASK
+        can_id_string = "{:08X}".format(can_id)
+    else:  # Standard Frame
+        can_id &= socket.CAN_SFF_MASK
+        can_id_string = "{:03X}".format(can_id)
+    return extended_frame, can_id, can_dlc, can_data, can_id_string
+
+def legacy_records(interface, packets, raw_queue):
+    # The original read_can_data loop body, one queue.put per frame
+    for can_packet in packets:
+        can_time = time.time()
+        extended_frame, can_id, can_dlc, can_data, can_id_string = unpack_CAN(can_packet)
+        can_data_string = " ".join(["{:02X}".format(b) for b in can_data[:can_dlc]])
+        if extended_frame:
+            priority, pgn, da, sa = get_j1939_from_id(can_id)
+        else:
+            priority, pgn, da, sa = 0xE, 0xFFFFE, 0xFE, 0xFE
+        raw_queue.put((interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data[:can_dlc]))
+        app.logger.debug(f"Raw data put in queue: {interface} {sa} {pgn} {can_time} {da} {can_id_string} {can_data_string}")
+        raw_queue.get()
+
+def batched_records(interface, packets, raw_queue, batch_size):
+    buffer = b''.join(packets)
+    step = batch_size*CAN_FRAME_SIZE
+    for start in range(0, len(buffer), step):
+        frames = list(can_frame_struct.iter_unpack(buffer[start:start+step]))
+        batch = app.records_from_frames(interface, frames, [time.time()]*len(frames))
+        raw_queue.put(batch)
+        app.logger.debug(f"Raw data batch of {len(batch)} frames put in queue from {interface}")
+        raw_queue.get()
+
+def cpu_rate(func, frames, *args):
+    start = time.process_time()
+    func(*args)
+    elapsed = time.process_time() - start
+    return frames/elapsed if elapsed else float('inf')
+
+def bench_reader_memory(packets, repeat, batch_size):
+    packets = packets*repeat
+    raw_queue = queue.Queue(5000)
+    legacy = cpu_rate(legacy_records, len(packets), 'can1', packets, raw_queue)
+    batched = cpu_rate(batched_records, len(packets), 'can1', packets, raw_queue, batch_size)
+    return legacy, batched
+
+def send_frames(interface, packets):
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.bind((interface,))
+    for packet in packets:
+        try:
+            sock.send(packet)
+        except OSError:
+            time.sleep(0.001)  # transmit queue full
+    stop = can_frame_struct.pack(STOP_ID, 0, b'')
+    for _ in range(20):
+        time.sleep(0.05)
+        sock.send(stop)
+    sock.close()
+
+def live_legacy(interface, packets):
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.bind((interface,))
+    raw_queue = queue.Queue(5000)
+    sender = threading.Thread(target=send_frames, args=(interface, packets))
+    count = 0
+    start = time.thread_time()
+    sender.start()
+    while True:
+        can_packet = sock.recv(16)
+        if can_frame_struct.unpack(can_packet)[0] == STOP_ID:
+            break
+        legacy_records(interface, (can_packet,), raw_queue)
+        count += 1
+    elapsed = time.thread_time() - start
+    sender.join()
+    sock.close()
+    return count, count/elapsed
+
+def live_batched(interface, packets, batch_size):
+    reader = CANBatchReader(interface, batch_size)
+    raw_queue = queue.Queue(5000)
+    sender = threading.Thread(target=send_frames, args=(interface, packets))
+    count = 0
+    start = time.thread_time()
+    sender.start()
+    done = False
+    while not done:
+        frames, stamps = reader.read()
+        if any(f[0] == STOP_ID for f in frames):
+            stamps = [t for f, t in zip(frames, stamps) if f[0] != STOP_ID]
+            frames = [f for f in frames if f[0] != STOP_ID]
+            done = True
+        batch = app.records_from_frames(interface, frames, stamps)
+        raw_queue.put(batch)
+        raw_queue.get()
+        count += len(batch)
+    elapsed = time.thread_time() - start
+    sender.join()
+    reader.close()
+    return count, count/elapsed
+
+def legacy_decode(records, nav_state, ballast_data):
+    # The if/elif chain process_data used before the decoder registry
+    for sa, pgn, can_data in records:
+        if sa == 57 and pgn == 0x1F211:
+            ballast_data["center_fill"]=bool(can_data[0])
+            ballast_data["port_fill"]=bool(can_data[1])
+            ballast_data["star_fill"]=bool(can_data[2])
+        elif pgn == 127245 and len(can_data) >= 2:
+            angle = struct.unpack_from('<h', can_data)[0] * 0.0001 * 180/3.14159
+            nav_state["rudder"] = round(angle, 1)
+        elif pgn == 128259 and len(can_data) >= 2:
+            spd = struct.unpack_from('<H', can_data)[0] * 0.01 * 1.94384
+            nav_state["speed"] = round(spd, 2)
+        elif pgn == 127237 and len(can_data) >= 2:
+            goal = struct.unpack_from('<H', can_data)[0] * 0.0001 * 180/3.14159
+            nav_state["hdg_goal"] = round(goal, 1)
+        elif pgn == 127250 and len(can_data) >= 2:
+            hdg = struct.unpack_from('<H', can_data)[0] * 0.0001 * 180/3.14159
+            nav_state["heading"] = round(hdg, 1)
+        elif pgn == 61469 and len(can_data) >= 8:
+            steer = (struct.unpack('<L', can_data[:4])[0] - 0x80000000)/1000
+            nav_state["steer"] = round(steer)
+            sgoal = (struct.unpack('<L', can_data[4:])[0] - 0x80000000)/1000
+            nav_state["steer_goal"] = round(sgoal)
+
+def registry_decode(records, nav_state, ballast_data, decoders):
+    by_source = decoders.by_source
+    for sa, pgn, can_data in records:
+        sources = by_source.get(pgn)
+        if sources is not None:
+            decoder = sources[sa]
+            if decoder is not None:
+                decoder.decode_into(can_data, ballast_data if decoder.target == 'ballast' else nav_state)
+
+def bench_decode(args):
+    records = []
+    for filename in args.logs:
+        for can_id, can_dlc, can_data in can_frame_struct.iter_unpack(b''.join(load_packets(filename))):
+            priority, pgn, da, sa = get_j1939_from_id(can_id & socket.CAN_EFF_MASK)
+            records.append((sa, pgn, can_data[:can_dlc]))
+    records = records*args.repeat
+    # The captures hold no nav traffic, so also time frames that do get decoded
+    nav_records = [(sa, pgn, bytes(range(1, 9))) for sa, pgn in
+                   ((57, 127505), (3, 127245), (3, 128259), (3, 127237), (3, 127250), (3, 61469))]*20000
+    # Same PGNs as the old chain, for a like for like comparison
+    legacy_decoders = DecoderRegistry()
+    for (pgn, sa), decoder in app.pgn_decoders.items():
+        if pgn in (127505, 127245, 128259, 127237, 127250, 61469) and (pgn != 127505 or sa == 57):
+            legacy_decoders.add(decoder)
+    runs = (('if/elif chain', legacy_decode, ()),
+            ('registry', registry_decode, (legacy_decoders,)),
+            ('registry, all decoders', registry_decode, (app.pgn_decoders,)))
+    for title, frames in ((f"{len(records)} frames from {len(args.logs)} logs", records),
+                          (f"{len(nav_records)} nav and ballast frames", nav_records)):
+        print(title)
+        for label, func, extra in runs:
+            elapsed = math.inf
+            for _ in range(5):  # best of five, the machine is rarely quiet
+                start = time.perf_counter()
+                func(frames, {}, {}, *extra)
+                elapsed = min(elapsed, time.perf_counter() - start)
+            print(f"  {label:22s} {elapsed*1e9/len(frames):8.1f} ns/frame")
+
+class PipelineQueue(queue.Queue):
+    '''
+    queue.Queue that keeps high-water marks, in batches and in frames.
+    '''
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.high_water = 0
+        self.frames = 0
+        self.frames_high_water = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.frames += len(item)
+        self.high_water = max(self.high_water, len(self.queue))
+        self.frames_high_water = max(self.frames_high_water, self.frames)
+
+    def _get(self):
+        item = super()._get()
+        self.frames -= len(item)
+        return item
+
+
+class RawQueue(PipelineQueue):
+    '''
+    raw_data_queue stand-in. process_data only comes back for the next batch
+    once it is done with the previous one, so get() marks that batch done.
+    '''
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.current = None
+        self.done = []  # (done time, batch)
+
+    def get(self, block=True, timeout=None):
+        if self.current is not None:
+            self.done.append((time.time(), self.current))
+            self.current = None
+        self.current = super().get(block, timeout)
+        return self.current
+
+
+def synthetic_frames(count=4000, seed=1):
+    # Frames for every decoded PGN plus a spread of other traffic, so both the
+    # decode and the summary paths of process_data are exercised
+    rng = random.Random(seed)
+    ids = []
+    for pgn, sa in app.pgn_decoders:
+        ids.append(j1939_id(2, pgn, 255, 3 if sa is None else sa))
+    for sa in range(0, 40, 3):
+        for pgn in (61443, 61444, 65262, 65263, 65266, 65270, 65271, 0xEF00):
+            ids.append(j1939_id(3, pgn, 0, sa))
+    return [(rng.choice(ids) | socket.CAN_EFF_FLAG, 8, rng.randbytes(8)) for _ in range(count)]
+
+def log_frames(filename):
+    return [(can_id, can_dlc, can_data) for timestamp, interface, can_id, can_dlc, can_data in read_candump(filename)]
+
+def inject(raw_queue, interface, frames, rate, duration, counters):
+    '''
+    Feed frames into raw_data_queue like read_can_data would, at rate frames/s
+    (0 for as fast as the queue takes them). Every frame gets its own
+    increasing receive stamp, as the kernel would give it.
+    '''
+    if rate:
+        batch_size = max(1, round(rate*INJECT_TICK))
+        interval = batch_size/rate
+    else:
+        batch_size = app.CAN_BATCH_SIZE
+        interval = 0
+    position = 0
+    sent = 0
+    blocked = 0.0
+    last_stamp = 0.0
+    start = time.time()
+    next_time = start
+    while time.time() - start < duration:
+        chunk = frames[position:position+batch_size]
+        position = (position + batch_size) % len(frames)
+        stamp = max(time.time() - len(chunk)*1e-6, last_stamp + 1e-6)
+        stamps = [stamp + i*1e-6 for i in range(len(chunk))]
+        last_stamp = stamps[-1]
+        batch = app.records_from_frames(interface, chunk, stamps)
+        put_start = time.perf_counter()
+        raw_queue.put(batch)
+        blocked += time.perf_counter() - put_start
+        sent += len(batch)
+        if interval:
+            next_time += interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    counters[interface] = (sent, blocked)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction*len(values)))]
+
+def run_scenario(load, interfaces, frames, duration, bitrate, viewers=True):
+    '''
+    Run process_data and write_to_db against injected traffic and return a
+    dict of results. load is a fraction of the bus bandwidth, or 0 to inject
+    as fast as the pipeline accepts frames. viewers stands in for open
+    j1939_display, ballast_control and remote_rudder pages.
+    '''
+    names = [f'bench{i}' for i in range(interfaces)]
+    app.raw_data_queue = raw_queue = RawQueue(5000)
+    app.processed_data_queue = processed_queue = LogBuffer(LOG_BUFFER_FRAMES, 'drop-oldest')
+    for name in names:
+        app.summary_data[name] = {"name": name, "count": 0}
+
+    inserted = [0, 0.0]  # rows, seconds
+    insert_records = can_log.insert_records
+    def timed_insert(conn, table_name, table_data, compact=True):
+        start = time.perf_counter()
+        insert_records(conn, table_name, table_data, compact)
+        inserted[0] += len(table_data)
+        inserted[1] += time.perf_counter() - start
+    can_log.insert_records = timed_insert
+
+    # Size and encode time of every update as JSON and in its binary
+    # encoding, and of the whole snapshot 'message' used to send every time
+    streams = {stream: [0, 0, 0.0, 0, 0.0] for stream in ('message', 'ballast', 'nav_update')}
+    full_message = [0, 0.0]  # bytes, seconds
+    emit_stream = app.emit_stream
+    def measured_emit_stream(stream, data):
+        counters = streams[stream]
+        start = time.perf_counter()
+        counters[1] += len(json.dumps(data, separators=(',', ':')))
+        counters[2] += time.perf_counter() - start
+        if stream in binary_streams():
+            start = time.perf_counter()
+            counters[3] += len(pack_stream(stream, data))
+            counters[4] += time.perf_counter() - start
+        counters[0] += 1
+        if stream == 'message':
+            start = time.perf_counter()
+            full_message[0] += len(json.dumps(app.summary_snapshot(), separators=(',', ':')))
+            full_message[1] += time.perf_counter() - start
+        return emit_stream(stream, data)
+    app.emit_stream = measured_emit_stream
+
+    database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    database.close()
+    app.DATABASE = database.name
+    app.logging_active.set()
+    if viewers:
+        for stream in ('message', 'ballast', 'nav_update'):
+            app.stream_subscribers[stream].add('benchmark')
+    for target, args in ((app.process_data, ()), (app.write_to_db, ('bench',))):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    rate = load*bitrate/CAN_FRAME_BITS
+    counters = {}
+    injectors = [threading.Thread(target=inject, args=(raw_queue, name, frames, rate, duration, counters))
+                 for name in names]
+    cpu_start = time.process_time()
+    start = time.time()
+    for t in injectors:
+        t.start()
+    for t in injectors:
+        t.join()
+    sent = sum(n for n, blocked in counters.values())
+
+    # Let the pipeline drain: every batch processed and written
+    deadline = time.time() + 30
+    while sum(len(batch) for done, batch in raw_queue.done) < sent and time.time() < deadline:
+        time.sleep(0.01)
+    finished = raw_queue.done[-1][0] if raw_queue.done else time.time()
+    cpu = time.process_time() - cpu_start
+    while inserted[0] < sent and time.time() < deadline:
+        time.sleep(0.05)
+    os.unlink(database.name)
+
+    latencies = sorted(done - record[3] for done, batch in raw_queue.done for record in batch)
+    processed = len(latencies)
+    elapsed = finished - start
+    return {
+        'load': load or 'max',
+        'interfaces': interfaces,
+        'viewers': viewers,
+        'offered_fps': round(rate*interfaces) if rate else None,
+        'frames': sent,
+        'processed': processed,
+        'frames_per_s': round(processed/elapsed, 1) if elapsed > 0 else None,
+        'cpu_s': round(cpu, 3),
+        'latency_p50_ms': round(percentile(latencies, 0.50)*1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99)*1000, 3) if latencies else None,
+        'latency_max_ms': round(latencies[-1]*1000, 3) if latencies else None,
+        'raw_queue_high_water': raw_queue.high_water,
+        'raw_queue_frames_high_water': raw_queue.frames_high_water,
+        'processed_queue_frames_high_water': processed_queue.stats['high_water'],
+        'log_dropped': processed_queue.stats['dropped'],
+        'reader_blocked_s': round(sum(blocked for n, blocked in counters.values()), 3),
+        'streams': {stream: stream_result(counters, elapsed) for stream, counters in streams.items()},
+        'full_message_bytes_per_s': round(full_message[0]/elapsed) if elapsed > 0 else None,
+        'full_message_encode_us': round(full_message[1]*1e6/streams['message'][0], 1) if streams['message'][0] else None,
+        'rows_inserted': inserted[0],
+        'insert_rows_per_s': round(inserted[0]/inserted[1], 1) if inserted[1] else None,
+    }
+
+def stream_result(counters, elapsed):
+    count, json_bytes, json_seconds, binary_bytes, binary_seconds = counters
+    if not count or elapsed <= 0:
+        return None
+    return {'emits': count,
+            'json_bytes': round(json_bytes/count),
+            'json_encode_us': round(json_seconds*1e6/count, 1),
+            'binary_bytes': round(binary_bytes/count) if binary_bytes else None,
+            'binary_encode_us': round(binary_seconds*1e6/count, 1) if binary_bytes else None,
+            'json_bytes_per_s': round(json_bytes/elapsed),
+            'binary_bytes_per_s': round(binary_bytes/elapsed) if binary_bytes else None}
+
+def _scenario_process(connection, *args):
+    connection.send(run_scenario(*args))
+    connection.close()
+
+def run_isolated(*args):
+    # process_data and write_to_db never return, so each scenario gets its own process
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_scenario_process, args=(sender,) + args, daemon=True)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare_results(results, baseline_file, tolerance):
+    '''
+    Print the scenarios that got worse than the baseline run by more than
+    tolerance and return how many there were.
+    '''
+    with open(baseline_file) as f:
+        baseline = {(r['load'], r['interfaces'], r.get('viewers', True)): r for r in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        old = baseline.get((result['load'], result['interfaces'], result['viewers']))
+        if old is None:
+            continue
+        for key, higher_is_better in (('frames_per_s', True), ('latency_p99_ms', False),
+                                      ('insert_rows_per_s', True)):
+            if not old.get(key) or result.get(key) is None:
+                continue
+            change = result[key]/old[key] - 1
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions += 1
+                print(f"REGRESSION load {result['load']} x{result['interfaces']}: "
+                      f"{key} {old[key]} -> {result[key]} ({change:+.0%})")
+    return regressions
+
+def bench_pipeline(args):
+    if args.log:
+        frames = log_frames(args.log)
+        traffic = os.path.basename(args.log)
+    else:
+        frames = synthetic_frames()
+        traffic = 'synthetic'
+    loads = [0.0 if load == 'max' else float(load)/100 for load in args.loads.split(',')]
+    interface_counts = [int(n) for n in args.interfaces.split(',')]
+
+    print(f"{'load':>5s} {'ifs':>3s} {'frames/s':>10s} {'p50 ms':>8s} {'p99 ms':>8s} "
+          f"{'raw hw':>7s} {'proc hw':>7s} {'blocked s':>9s} {'rows/s':>10s} {'full B/s':>9s}")
+    results = []
+    for interfaces in interface_counts:
+        for load in loads:
+            result = run_isolated(load, interfaces, frames, args.duration, args.bitrate, not args.no_viewers)
+            if result is None:
+                print(f"load {load or 'max'} x{interfaces}: scenario process died")
+                continue
+            results.append(result)
+            load_label = 'max' if not load else f"{load:.0%}"
+            print(f"{load_label:>5s} {interfaces:3d} {result['frames_per_s'] or 0:10,.0f} "
+                  f"{result['latency_p50_ms'] or 0:8.2f} {result['latency_p99_ms'] or 0:8.2f} "
+                  f"{result['raw_queue_frames_high_water']:7d} {result['processed_queue_frames_high_water']:7d} "
+                  f"{result['reader_blocked_s']:9.2f} {result['insert_rows_per_s'] or 0:10,.0f} "
+                  f"{result['full_message_bytes_per_s'] or 0:9,d}")
+            for stream, counters in result['streams'].items():
+                if counters:
+                    print(f"      {stream:10s} {counters['emits']:4d} emits  json {counters['json_bytes']:6,d} B "
+                          f"{counters['json_encode_us']:7.1f} us  binary {counters['binary_bytes'] or 0:6,d} B "
+                          f"{counters['binary_encode_us'] or 0:7.1f} us")
+
+    report = {
+        'benchmark': 'pipeline',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'traffic': traffic,
+        'duration_s': args.duration,
+        'bitrate': args.bitrate,
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}")
+    if args.compare and compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+def legacy_can_stats(interface):
+    # get_can_stats before rtnetlink: fork `ip` through a shell and parse its output
+    command = f"ip -details -statistics link show {interface}"
+    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": "Failed to retrieve CAN statistics"}
+    stats = {}
+    stat_lines = result.stdout.split('\n')
+    for line in range(len(stat_lines)):
+        if 'can state' in stat_lines[line]:
+            stats['CANstate'] = stat_lines[line].strip().split()[2]
+            if "ERROR" in stats['CANstate']:
+                stats['CANstate'] = stats['CANstate'].split('-')[-1]
+        elif 'bitrate' in stat_lines[line]:
+            bitrate = int(stat_lines[line].strip().split()[1])//1000
+            stats['CANbitrate'] = f"{bitrate}k"
+        elif 'RX:' in stat_lines[line]:
+            rx_header = stat_lines[line].strip().split()[1:]
+            rx_line = stat_lines[line+1].strip().split()
+            for k,v in zip(rx_header,rx_line):
+                stats['CANRX'+k] = f"{int(v)//1024}kB"
+        elif 'TX:' in stat_lines[line]:
+            tx_header = stat_lines[line].strip().split()[1:]
+            tx_line = stat_lines[line+1].strip().split()
+            for k,v in zip(tx_header,tx_line):
+                stats['CANTX'+k] = v
+    return {interface:stats}
+
+def bench_stats(args):
+    legacy = legacy_can_stats(args.interface)
+    current = app.get_can_stats(args.interface)
+    print(f"ip:       {legacy}")
+    print(f"netlink:  {current}")
+    # Counters move between the two reads, so compare the fields only
+    if {key for stats in legacy.values() if isinstance(stats, dict) for key in stats} != \
+       {key for stats in current.values() if isinstance(stats, dict) for key in stats}:
+        print("WARNING: the fields differ")
+
+    def per_call(func, number):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return (time.perf_counter() - start)/number
+
+    subprocess_time = per_call(lambda: legacy_can_stats(args.interface), 50)
+    uncached_time = per_call(lambda: app.can_link_stats.query(args.interface), 2000)
+    cached_time = per_call(lambda: app.get_can_stats(args.interface), 20000)
+    print(f"ip subprocess:        {subprocess_time*1e6:10.1f} us/call")
+    print(f"rtnetlink query:      {uncached_time*1e6:10.1f} us/call")
+    print(f"get_can_stats cached: {cached_time*1e6:10.1f} us/call")
+
+def legacy_log_session(database, table_name, batches):
+    # write_to_db before the compact schema: a connection per batch
+    conn = sqlite3.connect(database)
+    conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    interface TEXT,
+                    sa INTEGER,
+                    pgn INTEGER,
+                    timestamp FLOAT,
+                    da INTEGER,
+                    can_id TEXT,
+                    data_hex TEXT,
+                    data_bytes BLOB,
+                    PRIMARY KEY (interface, sa, pgn, timestamp)
+                )
+            ''')
+    conn.commit()
+    conn.close()
+    for batch in batches:
+        conn = sqlite3.connect(database)
+        with conn:
+            conn.executemany(f'''
+                INSERT INTO {table_name} (interface, sa, pgn, timestamp, da, can_id, data_hex, data_bytes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+        conn.close()
+    return 0.0
+
+def compact_log_session(database, table_name, batches):
+    conn = can_log.connect(database)
+    can_log.create_table(conn, table_name)
+    for batch in batches:
+        can_log.insert_records(conn, table_name, batch)
+    start = time.perf_counter()
+    can_log.build_indexes(conn, table_name)
+    index_time = time.perf_counter() - start
+    conn.close()
+    return index_time
+
+def archive_log_session(database, table_name, batches):
+    writer = can_archive.ArchiveWriter(database)
+    for batch in batches:
+        writer.append(batch)
+    writer.close()
+    return 0.0
+
+def log_batches(frames, interfaces, rate, seconds):
+    # write_to_db sized batches of records: UPDATE_PERIOD worth of every interface
+    per_batch = round(rate*app.UPDATE_PERIOD)
+    batches = []
+    position = 0
+    can_time = 1.7e9
+    for _ in range(round(seconds/app.UPDATE_PERIOD)):
+        batch = []
+        for interface in interfaces:
+            chunk = [frames[(position + i) % len(frames)] for i in range(per_batch)]
+            stamps = [can_time + i/rate for i in range(per_batch)]
+            batch.extend(app.records_from_frames(interface, chunk, stamps))
+        position += per_batch
+        can_time += app.UPDATE_PERIOD
+        batches.append(batch)
+    return batches
+
+def bench_sqlite(args):
+    frames = log_frames(args.log) if args.log else synthetic_frames()
+    rate = args.bitrate/CAN_FRAME_BITS
+    interfaces = [f'can{i}' for i in range(args.interfaces)]
+    batches = log_batches(frames, interfaces, rate, args.seconds)
+    rows = sum(len(batch) for batch in batches)
+    print(f"{rows} rows: {args.seconds:.0f}s of {len(interfaces)} buses at {rate:.0f} frames/s each, "
+          f"{len(batches)} batches of {len(batches[0])}")
+    needed = rate*len(interfaces)
+    results = []
+    for label, session in (('legacy', legacy_log_session), ('compact WAL', compact_log_session),
+                           ('archive', archive_log_session)):
+        directory = tempfile.mkdtemp(dir=args.dir)
+        database = os.path.join(directory, 'bench.db')
+        start = time.perf_counter()
+        index_time = session(database, 'bench', batches)
+        elapsed = time.perf_counter() - start - index_time
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+        result = {'mode': label, 'rows': rows, 'rows_per_s': round(rows/elapsed),
+                  'headroom': round(rows/elapsed/needed, 1), 'bytes_per_row': round(size/rows, 1),
+                  'index_s': round(index_time, 3)}
+        results.append(result)
+        print(f"  {label:12s} {result['rows_per_s']:10,d} rows/s ({result['headroom']}x two-bus load) "
+              f"{result['bytes_per_row']:6.1f} B/row  indexes {index_time:.2f}s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': 'sqlite', 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'revision': git_revision(), 'host': platform.node(), 'results': results}, f, indent=2)
+
+def bench_reader(args):
+    packets = load_packets(args.log)
+    print(f"Loaded {len(packets)} frames from {args.log}")
+    if args.interface:
+        n, legacy = live_legacy(args.interface, packets*args.repeat)
+        print(f"legacy  recv():   {n:8d} frames {legacy:12,.0f} frames/CPU-s")
+        n, batched = live_batched(args.interface, packets*args.repeat, args.batch_size)
+        print(f"batched recvmmsg: {n:8d} frames {batched:12,.0f} frames/CPU-s")
+    else:
+        legacy, batched = bench_reader_memory(packets, args.repeat, args.batch_size)
+        print(f"legacy  per-frame: {legacy:12,.0f} frames/CPU-s")
+        print(f"batched x{args.batch_size:<4d}:    {batched:12,.0f} frames/CPU-s")
+    print(f"speedup: {batched/legacy:.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reader = subparsers.add_parser('reader', help='read_can_data frames per CPU-second')
+    reader.add_argument('--log', default=DEFAULT_LOG, help='candump log used as traffic')
+    reader.add_argument('--interface', help='measure live on this (v)can interface')
+    reader.add_argument('--repeat', type=int, default=5, help='times to replay the log')
+    reader.add_argument('--batch-size', type=int, default=app.CAN_BATCH_SIZE)
+    reader.set_defaults(func=bench_reader)
+
+    decode = subparsers.add_parser('decode', help='process_data PGN decode cost per frame')
+    decode.add_argument('logs', nargs='*', default=sorted(glob.glob(os.path.join(LOG_DIR, '*.log'))))
+    decode.add_argument('--repeat', type=int, default=5, help='times to replay the logs')
+    decode.set_defaults(func=bench_decode)
+
+    pipeline = subparsers.add_parser('pipeline', help='end to end frames/s, latency, queue depth and SQLite rate')
+    pipeline.add_argument('--log', help='candump log used as traffic instead of synthetic frames')
+    pipeline.add_argument('--loads', default='25,50,100,max',
+                          help='comma separated bus loads in percent of --bitrate, or max')
+    pipeline.add_argument('--interfaces', default='1,2', help='comma separated interface counts')
+    pipeline.add_argument('--duration', type=float, default=5.0, help='seconds of traffic per scenario')
+    pipeline.add_argument('--bitrate', type=int, default=250000)
+    pipeline.add_argument('--no-viewers', action='store_true',
+                          help='run with no page subscribed, so no updates are built')
+    pipeline.add_argument('--json', help='write the results to this file')
+    pipeline.add_argument('--compare', metavar='BASELINE', help='fail if worse than this earlier --json file')
+    pipeline.add_argument('--tolerance', type=float, default=0.2, help='allowed relative change for --compare')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    stats = subparsers.add_parser('stats', help='get_can_stats cost, rtnetlink against the ip subprocess')
+    stats.add_argument('--interface', default=app.can_interfaces[0])
+    stats.set_defaults(func=bench_stats)
+
+    sqlite_parser = subparsers.add_parser('sqlite', help='sustained SQLite logging rate at full bus load')
+    sqlite_parser.add_argument('--dir', help='directory for the test database (default: system temp)')
+    sqlite_parser.add_argument('--log', help='candump log used as traffic instead of synthetic frames')
+    sqlite_parser.add_argument('--interfaces', type=int, default=2)
+    sqlite_parser.add_argument('--seconds', type=float, default=60, help='bus time to log')
+    sqlite_parser.add_argument('--bitrate', type=int, default=250000)
+    sqlite_parser.add_argument('--json', help='write the results to this file')
+    sqlite_parser.set_defaults(func=bench_sqlite)
+
+    args = parser.parse_args()
+
+    # Keep the app's DEBUG level so log formatting is counted, but don't print it
+    logging.getLogger().handlers = [logging.NullHandler()]
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Binary encodings for the high rate Socket.IO streams.
+
+Pages that can decode them subscribe with {"streams": [...], "binary": true}
+and are put in the "<stream>.bin" room instead of the JSON one, so both kinds
+of client can be attached at once. The browser side lives in
+static/js/binary_payloads.js.
+
+nav_update is a fixed layout of little endian floats, in the order of
+NAV_FIELDS, with NaN for a value that was not received this period. Any
+other nav_state keys, such as the per engine engine_rpm_<instance>, follow
+it as a MessagePack map; without msgpack such an update goes out as JSON,
+so a binary client never gets fewer fields than a JSON one. The
+summary ('message') and ballast updates are nested dicts with keys that
+come and go, so they are sent as MessagePack when the msgpack package is
+installed; without it those streams stay JSON for everyone.
+'''
+import math
+import struct
+
+try:
+    import msgpack  # sudo apt install python3-msgpack -y
+except ImportError:
+    msgpack = None
+
+BINARY_SUFFIX = '.bin'
+
+# Keep in step with NAV_FIELDS in static/js/binary_payloads.js
+NAV_FIELDS = ('rudder', 'speed', 'hdg_goal', 'heading', 'steer', 'steer_goal',
+              'cog', 'sog', 'depth', 'engine_rpm', 'satellites', 'latitude', 'longitude')
+# Degrees of latitude/longitude need the 15 significant digits of a double
+nav_struct = struct.Struct('<11f2d')
+
+def binary_streams():
+    # Streams that have a binary encoding with the packages installed here
+    streams = {'nav_update'}
+    if msgpack is not None:
+        streams.update(('message', 'ballast'))
+    return streams
+
+def pack_nav(nav_state):
+    # The fixed layout plus a MessagePack map of the other keys, or nav_state
+    # itself (sent as JSON) when there are other keys and no msgpack
+    values = []
+    for name in NAV_FIELDS:
+        value = nav_state.get(name)
+        values.append(math.nan if value is None else value)
+    packed = nav_struct.pack(*values)
+    if len(nav_state) > sum(name in nav_state for name in NAV_FIELDS):
+        if msgpack is None:
+            return nav_state
+        packed += msgpack.packb({name: value for name, value in nav_state.items() if name not in NAV_FIELDS})
+    return packed
+
+def pack_msgpack(data):
+    return msgpack.packb(data)
+
+def pack_stream(stream, data):
+    if stream == 'nav_update':
+        return pack_nav(data)
+    return pack_msgpack(data)
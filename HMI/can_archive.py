@@ -0,0 +1,287 @@
+'''
+Columnar, compressed archive files for logged CAN sessions (.canarc).
+
+A log table holds one row per frame; an archive holds the same frames as
+a series of self-contained chunks of up to CHUNK_FRAMES frames each, with
+every column stored and compressed on its own:
+
+    timestamps   int32 microseconds since the previous frame (the first
+                 one since the chunk's base time)
+    interfaces   uint8 index into the chunk's interface names
+    can_ids      uint32, with CAN_EFF_FLAG for 29-bit ids
+    lengths      uint16 payload length (the dlc, or the size of a rebuilt
+                 multi-packet message)
+    payload      every frame's data bytes back to back
+
+The numeric columns are byte-shuffled (all the low bytes, then the next
+ones, ...) before zlib, which is what makes slowly changing timestamps and
+a few hundred repeating ids compress well.
+
+File layout: ARCHIVE_MAGIC, then chunks. A chunk is CHUNK_HEADER
+(b'CHNK', frame count, base time in microseconds, number of interfaces),
+the interface names (a length byte and UTF-8 each), COLUMN_LENGTHS and
+the compressed columns. Files are only ever appended to, a chunk at a
+time, so a session that ends with a power cut leaves a readable file; a
+partly written last chunk is ignored by the readers.
+
+    python3 can_archive.py pack can_messages.db can_data can_data.canarc
+    python3 can_archive.py dump can_data.canarc > can_data.log  # candump -l format
+'''
+import argparse
+import array
+import io
+import os
+import socket
+import sqlite3
+import struct
+import sys
+import zlib
+
+import can_log
+
+ARCHIVE_MAGIC = b'CANARC\x00\x01'
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIqB')
+COLUMN_LENGTHS = struct.Struct('<5I')
+CHUNK_FRAMES = 16384
+COMPRESS_LEVEL = 6
+MAX_DELTA = 0x7FFFFFFF  # microseconds an int32 timestamp delta can hold, about 36 minutes
+
+
+def shuffle(column):
+    # Byte planes of an array: all the first bytes, then all the second bytes, ...
+    data = column.tobytes()
+    size = column.itemsize
+    if size == 1:
+        return data
+    return b''.join(data[i::size] for i in range(size))
+
+def unshuffle(data, typecode):
+    column = array.array(typecode)
+    size = column.itemsize
+    if size > 1:
+        count = len(data)//size
+        interleaved = bytearray(len(data))
+        for i in range(size):
+            interleaved[i::size] = data[i*count:(i + 1)*count]
+        data = interleaved
+    column.frombytes(data)
+    return column
+
+
+class ArchiveChunk:
+    '''
+    One decoded chunk. times are float seconds; the other columns are the
+    arrays as stored, so analysis code can work on whole columns at once.
+    '''
+    __slots__ = ('interface_names', 'times', 'interfaces', 'can_ids', 'lengths', 'payload')
+
+    def __init__(self, interface_names, times, interfaces, can_ids, lengths, payload):
+        self.interface_names = interface_names
+        self.times = times
+        self.interfaces = interfaces
+        self.can_ids = can_ids
+        self.lengths = lengths
+        self.payload = payload
+
+    def __len__(self):
+        return len(self.can_ids)
+
+    def records(self):
+        # (timestamp, interface, can_id, data) for every frame
+        names = self.interface_names
+        payload = self.payload
+        offset = 0
+        for timestamp, index, can_id, length in zip(self.times, self.interfaces, self.can_ids, self.lengths):
+            yield timestamp, names[index], can_id, payload[offset:offset + length]
+            offset += length
+
+
+class ArchiveWriter:
+    '''
+    Append frames to an archive, given a path or a binary file object; a
+    chunk is written every CHUNK_FRAMES frames, and by flush() and close().
+    With truncate a path is started over instead of appended to.
+    '''
+    def __init__(self, target, chunk_frames=CHUNK_FRAMES, level=COMPRESS_LEVEL, truncate=False):
+        self.chunk_frames = chunk_frames
+        self.level = level
+        if isinstance(target, (str, os.PathLike)):
+            target = open(target, 'wb' if truncate else 'ab')
+        self.file = target
+        if self.file.tell() == 0:
+            self.file.write(ARCHIVE_MAGIC)
+        self.frames = 0
+        self.bytes_in = 0  # what the frames take uncompressed, for the ratio
+        self._reset()
+
+    def _reset(self):
+        self.base = None
+        self.last = 0
+        self.names = {}
+        self.times = array.array('i')
+        self.interfaces = bytearray()
+        self.can_ids = array.array('I')
+        self.lengths = array.array('H')
+        self.payload = bytearray()
+
+    def append(self, records):
+        # raw_data_queue records (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data)
+        for interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data in records:
+            self.append_frame(can_time, interface, can_log.can_id_value(can_id_string), can_data)
+
+    def append_frame(self, timestamp, interface, can_id, data):
+        now = round(timestamp*1e6)
+        if self.base is None:
+            self.base = self.last = now
+        elif not -MAX_DELTA <= now - self.last <= MAX_DELTA or len(self.names) == 255 and interface not in self.names:
+            self.flush()
+            self.base = self.last = now
+        index = self.names.get(interface)
+        if index is None:
+            index = self.names[interface] = len(self.names)
+        self.times.append(now - self.last)
+        self.last = now
+        self.interfaces.append(index)
+        self.can_ids.append(can_id)
+        self.lengths.append(len(data))
+        self.payload += data
+        if len(self.can_ids) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        count = len(self.can_ids)
+        if not count:
+            return
+        columns = [zlib.compress(data, self.level) for data in
+                   (shuffle(self.times), bytes(self.interfaces), shuffle(self.can_ids),
+                    shuffle(self.lengths), bytes(self.payload))]
+        parts = [CHUNK_HEADER.pack(CHUNK_MAGIC, count, self.base, len(self.names))]
+        for name in self.names:
+            encoded = name.encode()
+            parts.append(bytes((len(encoded),)) + encoded)
+        parts.append(COLUMN_LENGTHS.pack(*map(len, columns)))
+        parts.extend(columns)
+        # One write per chunk, so a reader never sees half a header
+        self.file.write(b''.join(parts))
+        self.file.flush()
+        self.frames += count
+        self.bytes_in += count*11 + len(self.payload)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_chunks(source):
+    '''
+    Yield an ArchiveChunk for every complete chunk of an archive, given a
+    path or a binary file object.
+    '''
+    f = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    try:
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(f"{getattr(f, 'name', source)} is not a CAN archive")
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            magic, count, base, interface_count = CHUNK_HEADER.unpack(header)
+            if magic != CHUNK_MAGIC:
+                raise ValueError(f"Corrupt chunk header in {getattr(f, 'name', source)}")
+            names = []
+            for _ in range(interface_count):
+                length = f.read(1)
+                if not length:
+                    return
+                names.append(f.read(length[0]).decode())
+            lengths = f.read(COLUMN_LENGTHS.size)
+            if len(lengths) < COLUMN_LENGTHS.size:
+                return
+            lengths = COLUMN_LENGTHS.unpack(lengths)
+            columns = [f.read(length) for length in lengths]
+            if any(len(column) < length for column, length in zip(columns, lengths)):
+                return  # the last chunk was cut short
+            try:
+                columns = [zlib.decompress(column) for column in columns]
+            except zlib.error:
+                return
+            deltas = unshuffle(columns[0], 'i')
+            times = []
+            now = base
+            for delta in deltas:
+                now += delta
+                times.append(now/1e6)
+            yield ArchiveChunk(names, times, columns[1], unshuffle(columns[2], 'I'),
+                               unshuffle(columns[3], 'H'), columns[4])
+    finally:
+        if f is not source:
+            f.close()
+
+def read_archive(source):
+    # (timestamp, interface, can_id, data) for every frame of an archive
+    for chunk in read_chunks(source):
+        yield from chunk.records()
+
+def table_frames(conn, table_name, chunk_size=CHUNK_FRAMES):
+    # (timestamp, interface, can_id, data) for every row of a log table, in rowid order
+    if can_log.is_compact(conn, table_name):
+        columns = ('timestamp', 'interface', 'can_id', 'data')
+        convert = None
+    else:
+        columns = ('timestamp', 'interface', 'can_id', 'data_bytes')
+        convert = can_log.can_id_value
+    for rows in can_log.iter_chunks(conn, table_name, columns, chunk_size=chunk_size):
+        for timestamp, interface, can_id, data in rows:
+            yield timestamp, interface, convert(can_id) if convert else can_id, data
+
+def generate_archive(conn, table_name, chunk_frames=CHUNK_FRAMES):
+    '''
+    Yield an archive of a log table chunk by chunk, for streaming it
+    straight into an HTTP response.
+    '''
+    buffer = io.BytesIO()
+    writer = ArchiveWriter(buffer, chunk_frames)
+    for frame in table_frames(conn, table_name, chunk_frames):
+        writer.append_frame(*frame)
+        if buffer.tell() > 0 and not writer.can_ids:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    writer.flush()
+    yield buffer.getvalue()
+
+def pack_table(database, table_name, path):
+    conn = sqlite3.connect(database)
+    try:
+        with open(path, 'wb') as f:
+            for data in generate_archive(conn, table_name):
+                f.write(data)
+    finally:
+        conn.close()
+
+def candump_line(timestamp, interface, can_id, data):
+    if can_id & socket.CAN_EFF_FLAG:
+        can_id_string = "{:08X}".format(can_id & socket.CAN_EFF_MASK)
+    else:
+        can_id_string = "{:03X}".format(can_id & socket.CAN_SFF_MASK)
+    return f"({timestamp:.6f}) {interface} {can_id_string}#{data.hex().upper()}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CAN session archives")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack = subparsers.add_parser('pack', help='archive a log table')
+    pack.add_argument('database')
+    pack.add_argument('table')
+    pack.add_argument('archive')
+    dump = subparsers.add_parser('dump', help='print an archive in candump -l format')
+    dump.add_argument('archive')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        pack_table(args.database, args.table, args.archive)
+    else:
+        for frame in read_archive(args.archive):
+            sys.stdout.write(candump_line(*frame) + '\n')
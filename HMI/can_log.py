@@ -0,0 +1,377 @@
+'''
+SQLite storage for logged CAN frames.
+
+write_to_db keeps one connection open for the whole run, in WAL mode with
+synchronous=NORMAL, and inserts each batch in a single transaction. New log
+tables use the compact schema
+
+    timestamp REAL, interface TEXT, sa INTEGER, pgn INTEGER, can_id INTEGER, data BLOB
+
+in a plain rowid table. can_id carries CAN_EFF_FLAG for 29-bit ids, so the
+hex id, the destination address and the hex data the old schema stored next
+to the blob can all be derived. There is no primary key to maintain while
+logging; the indexes in LOG_INDEXES are built once a logging session ends.
+
+Tables made with the old schema (interface, sa, pgn, timestamp, da, can_id
+TEXT, data_hex, data_bytes) are still read and appended to as they are.
+legacy_row() turns a compact row back into that column layout for the
+pages and downloads that show it.
+
+The log_catalog table keeps a summary of every log table (row count,
+payload bytes, first and last timestamp, interfaces, source addresses and
+PGNs). insert_records() updates it in the same transaction as the rows, so
+listing the sessions never has to count them. Tables logged before the
+catalog existed are summarised once by catalog_table().
+'''
+import json
+import socket
+import sqlite3
+import time
+
+LEGACY_COLUMNS = ('interface', 'sa', 'pgn', 'timestamp', 'da', 'can_id', 'data_hex', 'data_bytes')
+COMPACT_COLUMNS = ('timestamp', 'interface', 'sa', 'pgn', 'can_id', 'data')
+
+# Built when a logging session ends, dropped when one starts: (name, columns).
+# Each ends in timestamp so a filtered query can read its time range in order.
+LOG_INDEXES = (('can_id', 'can_id, timestamp'), ('pgn_sa', 'pgn, sa, timestamp'), ('timestamp', 'timestamp'))
+
+# Fields query_frames can return, in the column order of the old schema
+QUERY_FIELDS = LEGACY_COLUMNS[:-1]
+
+PRAGMAS = (
+    "auto_vacuum=INCREMENTAL",    # only takes on a new database; lets reclaim_space() shrink the file
+    "journal_mode=WAL",           # readers don't block the writer, one fsync per checkpoint
+    "synchronous=NORMAL",         # safe with WAL; a power cut loses at most the last commits
+    "cache_size=-8192",           # 8 MiB page cache
+    "temp_store=MEMORY",
+    "journal_size_limit=67108864" # truncate the WAL back to 64 MiB after checkpoints
+)
+
+CATALOG_TABLE = 'log_catalog'
+TRASH_PREFIX = 'deleting_'  # tables swapped out by swap_out_table, waiting to be dropped
+VACUUM_STEP = 1024  # pages freed per incremental_vacuum transaction, about 0.25 s of work
+CATALOG_COLUMNS = ('table_name', 'rows', 'bytes', 'first_time', 'last_time', 'interfaces', 'sas', 'pgns')
+
+def connect(database, timeout=60):
+    # The writer waits for a lock held by an index build rather than fail
+    conn = sqlite3.connect(database, timeout=timeout)
+    for pragma in PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+def table_columns(conn, table_name):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+
+def is_compact(conn, table_name):
+    return 'data_hex' not in table_columns(conn, table_name)
+
+def has_rows(conn, table_name):
+    return conn.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchone() is not None
+
+def create_table(conn, table_name):
+    '''
+    Create a compact log table unless the name is taken, and return whether
+    the table (new or existing) uses the compact schema.
+    '''
+    create_catalog(conn)
+    with conn:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                timestamp REAL,
+                interface TEXT,
+                sa INTEGER,
+                pgn INTEGER,
+                can_id INTEGER,
+                data BLOB
+            )
+        ''')
+    return is_compact(conn, table_name)
+
+def drop_indexes(conn, table_name):
+    with conn:
+        for name, columns in LOG_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {table_name}_{name}_idx")
+
+def build_indexes(conn, table_name):
+    with conn:
+        for name, columns in LOG_INDEXES:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{name}_idx ON {table_name} ({columns})")
+    conn.execute("PRAGMA optimize")
+
+def can_id_value(can_id_string):
+    # "18FEF100" -> 0x98FEF100 with CAN_EFF_FLAG, "123" -> 0x123
+    can_id = int(can_id_string, 16)
+    if len(can_id_string) > 3:
+        can_id |= socket.CAN_EFF_FLAG
+    return can_id
+
+def can_id_text(can_id):
+    if can_id & socket.CAN_EFF_FLAG:
+        return "{:08X}".format(can_id & socket.CAN_EFF_MASK)
+    return "{:03X}".format(can_id & socket.CAN_SFF_MASK)
+
+def insert_records(conn, table_name, records, compact=True):
+    '''
+    Insert raw_data_queue records
+    (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data)
+    in one transaction, together with their log_catalog update.
+    '''
+    with conn:
+        update_catalog(conn, table_name, records)
+        if compact:
+            conn.executemany(f"INSERT INTO {table_name} (timestamp, interface, sa, pgn, can_id, data) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(can_time, interface, sa, pgn, can_id_value(can_id_string), can_data)
+                              for interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data in records])
+        else:
+            conn.executemany(f'''
+                INSERT INTO {table_name} (interface, sa, pgn, timestamp, da, can_id, data_hex, data_bytes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', records)
+
+def create_catalog(conn):
+    with conn:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+                table_name TEXT PRIMARY KEY,
+                rows INTEGER,
+                bytes INTEGER,
+                first_time REAL,
+                last_time REAL,
+                interfaces TEXT,
+                sas TEXT,
+                pgns TEXT
+            )
+        ''')
+
+def log_tables(conn):
+    # Every table but the catalog and SQLite's own
+    return [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+            if name != CATALOG_TABLE and not name.startswith(('sqlite_', TRASH_PREFIX))]
+
+def catalog_entry(conn, table_name):
+    # The catalog row of a table as a dict, with the sets as sorted lists, or None
+    row = conn.execute(f"SELECT {', '.join(CATALOG_COLUMNS)} FROM {CATALOG_TABLE} WHERE table_name = ?",
+                       (table_name,)).fetchone()
+    if row is None:
+        return None
+    entry = dict(zip(CATALOG_COLUMNS, row))
+    for key in ('interfaces', 'sas', 'pgns'):
+        entry[key] = json.loads(entry[key])
+    return entry
+
+def read_catalog(conn):
+    # {table_name: entry} of every catalogued table
+    try:
+        rows = conn.execute(f"SELECT table_name FROM {CATALOG_TABLE}").fetchall()
+    except sqlite3.OperationalError:
+        return {}  # no catalog yet
+    return {name: catalog_entry(conn, name) for name, in rows}
+
+def write_catalog_entry(conn, entry):
+    conn.execute(f"INSERT OR REPLACE INTO {CATALOG_TABLE} ({', '.join(CATALOG_COLUMNS)}) "
+                 f"VALUES ({', '.join('?' for _ in CATALOG_COLUMNS)})",
+                 [json.dumps(sorted(value)) if key in ('interfaces', 'sas', 'pgns') else value
+                  for key, value in ((key, entry[key]) for key in CATALOG_COLUMNS)])
+
+def empty_entry(table_name):
+    return {'table_name': table_name, 'rows': 0, 'bytes': 0, 'first_time': None, 'last_time': None,
+            'interfaces': [], 'sas': [], 'pgns': []}
+
+def update_catalog(conn, table_name, records):
+    # Merge a batch of raw_data_queue records into the table's catalog row; call inside a transaction
+    if not records:
+        return
+    entry = catalog_entry(conn, table_name) or empty_entry(table_name)
+    interfaces, sas, pgns, times, das, can_ids, data_strings, datas = zip(*records)
+    first = min(times)
+    last = max(times)
+    entry['rows'] += len(records)
+    entry['bytes'] += sum(map(len, datas))
+    entry['first_time'] = first if entry['first_time'] is None else min(entry['first_time'], first)
+    entry['last_time'] = last if entry['last_time'] is None else max(entry['last_time'], last)
+    entry['interfaces'] = set(entry['interfaces']).union(interfaces)
+    entry['sas'] = set(entry['sas']).union(sas)
+    entry['pgns'] = set(entry['pgns']).union(pgns)
+    write_catalog_entry(conn, entry)
+
+def catalog_table(conn, table_name):
+    '''
+    Summarise a table with full scans and store its catalog row. Only needed
+    once, for tables logged before the catalog existed.
+    '''
+    create_catalog(conn)
+    data_column = 'data' if is_compact(conn, table_name) else 'data_bytes'
+    rows, size, first, last = conn.execute(
+        f"SELECT COUNT(*), TOTAL(length({data_column})), MIN(timestamp), MAX(timestamp) FROM {table_name}").fetchone()
+    entry = {'table_name': table_name, 'rows': rows, 'bytes': int(size), 'first_time': first, 'last_time': last}
+    for key, column in (('interfaces', 'interface'), ('sas', 'sa'), ('pgns', 'pgn')):
+        entry[key] = [value for value, in conn.execute(f"SELECT DISTINCT {column} FROM {table_name}")]
+    with conn:
+        write_catalog_entry(conn, entry)
+    return catalog_entry(conn, table_name)
+
+def clear_catalog_entry(conn, table_name):
+    # After the rows of a table were deleted; call inside a transaction
+    write_catalog_entry(conn, empty_entry(table_name))
+
+def drop_catalog_entry(conn, table_name):
+    # After a table was dropped; call inside a transaction
+    conn.execute(f"DELETE FROM {CATALOG_TABLE} WHERE table_name = ?", (table_name,))
+
+def swap_out_table(conn, table_name, keep=True):
+    '''
+    Rename a table out of the way (and, with keep, create an empty one with
+    the same definition in its place) in one short transaction, and return
+    the name it was renamed to. Freeing its pages is left to drop_trash(),
+    so the writer and readers are only held up for the rename.
+    '''
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+    if row is None:
+        raise sqlite3.OperationalError(f"no such table: {table_name}")
+    trash = f"{TRASH_PREFIX}{table_name}_{int(time.time()*1000)}"
+    create_catalog(conn)
+    with conn:
+        conn.execute(f"ALTER TABLE {table_name} RENAME TO {trash}")
+        if keep:
+            conn.execute(row[0])  # the CREATE TABLE statement, under the original name
+            clear_catalog_entry(conn, table_name)
+        else:
+            drop_catalog_entry(conn, table_name)
+    return trash
+
+def trash_tables(conn):
+    return [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?",
+                                            (TRASH_PREFIX + '%',))]
+
+def drop_trash(conn, trash, progress=None):
+    '''
+    Drop a swapped out table and its indexes, one transaction each, calling
+    progress(done, total) after each.
+    '''
+    indexes = [name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (trash,))]
+    total = len(indexes) + 1
+    for done, name in enumerate(indexes, 1):
+        with conn:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        if progress:
+            progress(done, total)
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {trash}")
+    if progress:
+        progress(total, total)
+
+def reclaim_space(conn, progress=None, step=VACUUM_STEP, pause=0.05):
+    '''
+    Give free pages back to the file system a step at a time with
+    incremental_vacuum, calling progress(done, total) in pages. Returns
+    the pages freed; 0 when the database was not made with
+    auto_vacuum=INCREMENTAL (see convert_to_incremental).
+    '''
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    total = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    done = 0
+    while done < total:
+        # executescript steps the pragma to the end; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({step});")
+        left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        done = total - left
+        if progress:
+            progress(done, total)
+        if left == 0 or done <= 0:
+            break
+        time.sleep(pause)  # let the writer in; a busy wait would lose the lock to the next step
+    # In WAL mode the file only shrinks once the moved pages are checkpointed
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return done
+
+def convert_to_incremental(conn):
+    # One full VACUUM that switches an existing database to auto_vacuum=INCREMENTAL
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+def filter_clause(start=None, end=None, interfaces=(), sas=(), pgns=()):
+    '''
+    WHERE conditions and parameters for a time range and sets of
+    interfaces, source addresses and PGNs, for either schema. Returns
+    ("", []) when nothing is filtered.
+    '''
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("timestamp < ?")
+        params.append(end)
+    for column, values in (('interface', interfaces), ('sa', sas), ('pgn', pgns)):
+        if values:
+            conditions.append(f"{column} IN ({','.join('?' for _ in values)})")
+            params.extend(values)
+    return ' AND '.join(conditions), params
+
+def iter_chunks(conn, table_name, columns, where='', params=(), chunk_size=10000):
+    '''
+    Yield lists of up to chunk_size rows in rowid order. Each query starts
+    after the last rowid seen, so every row is read once however far into
+    the table the export is, unlike LIMIT/OFFSET which rescans the skipped
+    rows for every chunk.
+    '''
+    select = f"SELECT rowid, {', '.join(columns)} FROM {table_name} WHERE rowid > ?"
+    if where:
+        select += f" AND {where}"
+    select += f" ORDER BY rowid LIMIT {int(chunk_size)}"
+    last = -1
+    while True:
+        rows = conn.execute(select, (last, *params)).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+def query_frames(conn, table_name, fields=QUERY_FIELDS, can_ids=(), after=None, limit=1000, **filters):
+    '''
+    One page of frames in (timestamp, rowid) order, as (rows, cursor).
+    rows are tuples of the requested fields; cursor is the (timestamp,
+    rowid) to pass as after for the next page, or None on the last one.
+    can_ids are hex strings; filters are those of filter_clause().
+    '''
+    compact = is_compact(conn, table_name)
+    where, params = filter_clause(**filters)
+    conditions = [where] if where else []
+    if can_ids:
+        conditions.append(f"can_id IN ({','.join('?' for _ in can_ids)})")
+        params.extend(can_id_value(can_id) if compact else can_id.upper() for can_id in can_ids)
+    if after is not None:
+        # Row values compare like the index on timestamp (with the rowid it carries)
+        conditions.append("(timestamp, rowid) > (?, ?)")
+        params.extend(after)
+
+    columns = COMPACT_COLUMNS if compact else ('timestamp', *fields)
+    select = f"SELECT rowid, {', '.join(columns)} FROM {table_name}"
+    if conditions:
+        select += f" WHERE {' AND '.join(conditions)}"
+    select += f" ORDER BY timestamp, rowid LIMIT {int(limit)}"
+    rows = conn.execute(select, params).fetchall()
+
+    cursor = None
+    if len(rows) == limit:
+        rowid, timestamp = rows[-1][:2]  # timestamp leads both column lists
+        cursor = (timestamp, rowid)
+    if compact:
+        positions = [QUERY_FIELDS.index(field) for field in fields]
+        rows = [tuple(legacy[i] for i in positions) for legacy in (legacy_row(*row[1:]) for row in rows)]
+    else:
+        rows = [row[2:] for row in rows]
+    return rows, cursor
+
+def legacy_row(timestamp, interface, sa, pgn, can_id, data):
+    # A compact row in the column order of the old schema, LEGACY_COLUMNS
+    if not can_id & socket.CAN_EFF_FLAG:
+        da = 0xFE
+    elif (can_id >> 16) & 0xFF < 0xF0:
+        da = (can_id >> 8) & 0xFF  # PDU1: the PS byte is the destination
+    else:
+        da = 255
+    return (interface, sa, pgn, timestamp, da, can_id_text(can_id), data.hex(' ').upper(), data)
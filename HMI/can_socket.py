@@ -0,0 +1,370 @@
+'''
+SocketCAN helpers for the HMI reader threads.
+
+read_can_data() in app.py used to call sock.recv(16) once per frame. The
+CANBatchReader below drains up to batch_size frames per system call with
+recvmmsg() into a preallocated ring of can_frame structs, so the reader can
+hand whole batches downstream. Kernel side CAN_RAW_FILTER sets keep frames
+nobody decodes from waking the reader at all, and every frame carries the
+kernel receive time from SO_TIMESTAMPNS rather than the time the batch
+happened to be read.
+
+LinkStatsReader asks the kernel for interface counters and the CAN
+controller state over rtnetlink, replacing a fork/exec of
+`ip -details -statistics link show`.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import threading
+import time
+
+CAN_FRAME_SIZE = 16  # sizeof(struct can_frame)
+MSG_WAITFORONE = 0x10000  # block for the first frame, then take whatever is queued
+CAN_RAW_FILTER = getattr(socket, 'CAN_RAW_FILTER', 1)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+
+# struct can_frame { canid_t can_id; __u8 can_dlc; __u8 pad, res0, res1; __u8 data[8]; }
+can_frame_struct = struct.Struct("<IB3x8s")
+# struct can_filter { canid_t can_id; canid_t can_mask; }
+can_filter_struct = struct.Struct("=II")
+# struct timespec, and the struct cmsghdr it arrives in as ancillary data
+timespec_struct = struct.Struct("@ll")
+cmsg_timespec_struct = struct.Struct("@Niill")
+CMSG_SIZE = socket.CMSG_SPACE(timespec_struct.size)
+
+# 29-bit J1939 id fields
+J1939_PDU2_PGN_MASK = 0x03FFFF00
+J1939_PDU1_PGN_MASK = 0x03FF0000
+J1939_SA_MASK = 0x000000FF
+
+def pgn_filter(pgn, sa=None):
+    '''
+    Return the (can_id, can_mask) pair that passes extended frames carrying
+    pgn, optionally only from source address sa. For PDU1 PGNs the PS byte is
+    the destination address, so any destination is accepted.
+    '''
+    if (pgn >> 8) & 0xFF >= 0xF0:
+        mask = J1939_PDU2_PGN_MASK
+    else:
+        mask = J1939_PDU1_PGN_MASK
+    can_id = (pgn << 8) & mask
+    if sa is not None:
+        can_id |= sa
+        mask |= J1939_SA_MASK
+    return can_id | socket.CAN_EFF_FLAG, mask | socket.CAN_EFF_FLAG
+
+def pack_filters(filters):
+    # An empty filter list makes the socket receive nothing at all
+    return b''.join(can_filter_struct.pack(can_id, can_mask) for can_id, can_mask in filters)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                         ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+
+class CANBatchReader:
+    '''
+    Raw CAN socket bound to one interface that returns frames in batches.
+
+    read() blocks until at least one frame is available and then returns every
+    frame already queued in the kernel (up to batch_size) as a list of
+    (can_id, can_dlc, can_data) tuples, plus a list with the receive time of
+    each frame. can_id still carries the EFF/RTR/ERR flags and can_data is the
+    full 8 byte payload, just like unpack_CAN().
+    '''
+    def __init__(self, interface, batch_size=64, filters=None):
+        self.interface = interface
+        self.batch_size = batch_size
+        self.filters = filters
+        self.sock = None
+        self.timestamping = False
+        self.stamps = []
+
+        # One contiguous buffer holds the ring of can_frame structs, another
+        # the ancillary data (receive timestamp) that goes with each frame
+        self.buffer = bytearray(CAN_FRAME_SIZE * batch_size)
+        self.view = memoryview(self.buffer)
+        self.slots = [self.view[i*CAN_FRAME_SIZE:(i+1)*CAN_FRAME_SIZE] for i in range(batch_size)]
+        self.control = bytearray(CMSG_SIZE * batch_size)
+
+        # Scatter table for recvmmsg: one iovec and control slot per can_frame
+        base = ctypes.addressof((ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+        control_base = ctypes.addressof((ctypes.c_char * len(self.control)).from_buffer(self.control))
+        self.iovecs = (iovec * batch_size)()
+        self.msgvec = (mmsghdr * batch_size)()
+        for i in range(batch_size):
+            self.iovecs[i].iov_base = base + i*CAN_FRAME_SIZE
+            self.iovecs[i].iov_len = CAN_FRAME_SIZE
+            self.msgvec[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgvec[i].msg_hdr.msg_iovlen = 1
+            self.msgvec[i].msg_hdr.msg_control = control_base + i*CMSG_SIZE
+            self.msgvec[i].msg_hdr.msg_controllen = CMSG_SIZE
+        self.open()
+
+    def open(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.set_filters(self.filters)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.timestamping = True
+        except OSError:
+            self.timestamping = False
+        self.sock.bind((self.interface,))
+
+    def set_filters(self, filters):
+        '''
+        Install a list of (can_id, can_mask) pairs with CAN_RAW_FILTER so the
+        kernel drops everything else before it reaches user space. None
+        restores the default of receiving every frame. Safe to call while
+        another thread is blocked in read().
+        '''
+        self.filters = filters
+        if self.sock is None:
+            return
+        if filters is None:
+            filters = [(0, 0)]
+        self.sock.setsockopt(socket.SOL_CAN_RAW, CAN_RAW_FILTER, pack_filters(filters))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv_batch(self):
+        '''
+        Fill the ring buffer and self.stamps, and return the number of frames
+        received.
+        '''
+        if _recvmmsg is None:
+            return self._recv_batch_fallback()
+        count = _recvmmsg(self.sock.fileno(), self.msgvec, self.batch_size, MSG_WAITFORONE, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                self.stamps = []
+                return 0
+            raise OSError(err, os.strerror(err))
+
+        stamps = []
+        for i in range(count):
+            hdr = self.msgvec[i].msg_hdr
+            stamp = None
+            if hdr.msg_controllen:
+                cmsg_len, level, cmsg_type, sec, nsec = cmsg_timespec_struct.unpack_from(self.control, i*CMSG_SIZE)
+                if level == socket.SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS:
+                    stamp = sec + nsec*1e-9
+            if stamp is None:
+                # No kernel time: still a distinct one per frame, as legacy log
+                # tables key rows on (interface, sa, pgn, timestamp)
+                stamp = time.time()
+                if stamps and stamp <= stamps[-1]:
+                    stamp = stamps[-1] + 1e-6
+            hdr.msg_controllen = CMSG_SIZE  # the kernel shrinks it to what it used
+            stamps.append(stamp)
+        self.stamps = stamps
+        return count
+
+    def _recv_one(self, slot, flags=0):
+        nbytes, ancdata, msg_flags, address = self.sock.recvmsg_into([slot], CMSG_SIZE, flags)
+        for level, cmsg_type, data in ancdata:
+            if level == socket.SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS:
+                sec, nsec = timespec_struct.unpack_from(data)
+                return sec + nsec*1e-9
+        return time.time()
+
+    def _recv_batch_fallback(self):
+        # No recvmmsg in the C library: block for one frame, then drain without waiting
+        stamps = [self._recv_one(self.slots[0])]
+        while len(stamps) < self.batch_size:
+            try:
+                stamps.append(self._recv_one(self.slots[len(stamps)], socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        self.stamps = stamps
+        return len(stamps)
+
+    def read(self):
+        count = self.recv_batch()
+        return list(can_frame_struct.iter_unpack(self.view[:count*CAN_FRAME_SIZE])), self.stamps
+
+
+# rtnetlink, from linux/netlink.h, linux/rtnetlink.h, linux/if_link.h and linux/can/netlink.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 1
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+NLA_TYPE_MASK = 0x3FFF  # strips NLA_F_NESTED/NLA_F_NET_BYTEORDER
+IFLA_IFNAME = 3
+IFLA_LINKINFO = 18
+IFLA_STATS64 = 23
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_CAN_BITTIMING = 1
+IFLA_CAN_STATE = 4
+IFLA_CAN_BERR_COUNTER = 7
+
+nlmsghdr_struct = struct.Struct("=IHHII")
+nlmsgerr_struct = struct.Struct("=i")
+ifinfomsg_struct = struct.Struct("=BxHiII")
+rtattr_struct = struct.Struct("=HH")
+u32_struct = struct.Struct("=I")
+# The leading fields of struct rtnl_link_stats64; newer kernels append more
+LINK_STATS64_FIELDS = (
+    'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes', 'rx_errors', 'tx_errors',
+    'rx_dropped', 'tx_dropped', 'multicast', 'collisions',
+    'rx_length_errors', 'rx_over_errors', 'rx_crc_errors', 'rx_frame_errors',
+    'rx_fifo_errors', 'rx_missed_errors', 'tx_aborted_errors', 'tx_carrier_errors',
+    'tx_fifo_errors', 'tx_heartbeat_errors', 'tx_window_errors',
+    'rx_compressed', 'tx_compressed')
+link_stats64_struct = struct.Struct("=%dQ" % len(LINK_STATS64_FIELDS))
+# struct can_bittiming { bitrate, sample_point, tq, prop_seg, phase_seg1, phase_seg2, sjw, brp }
+can_bittiming_struct = struct.Struct("=8I")
+can_berr_counter_struct = struct.Struct("=HH")
+# enum can_state, spelled the way ip prints it
+CAN_STATES = ('ERROR-ACTIVE', 'ERROR-WARNING', 'ERROR-PASSIVE', 'BUS-OFF', 'STOPPED', 'SLEEPING')
+
+def _align(length):
+    return (length + 3) & ~3
+
+def iter_attributes(data, offset, end):
+    # Yield (type, start, end) for each rtattr between offset and end
+    while offset + rtattr_struct.size <= end:
+        length, kind = rtattr_struct.unpack_from(data, offset)
+        if length < rtattr_struct.size:
+            break
+        yield kind & NLA_TYPE_MASK, offset + rtattr_struct.size, offset + length
+        offset += _align(length)
+
+
+class LinkStatsReader:
+    '''
+    RTM_GETLINK queries over one long lived rtnetlink socket.
+
+    get(interface) returns a dict with the rtnl_link_stats64 counters (by
+    their kernel names) plus 'kind', and for CAN interfaces 'can_state',
+    'bitrate', 'sample_point' and 'berr_counter'. Answers are cached for ttl
+    seconds so every caller polling the same interface shares one query.
+    Raises OSError if the interface does not exist.
+    '''
+    def __init__(self, ttl=0.5):
+        self.ttl = ttl
+        self.sock = None
+        self.seq = 0
+        self.cache = {}  # interface: (monotonic time, link dict)
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.close()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def get(self, interface):
+        with self.lock:
+            now = time.monotonic()
+            cached = self.cache.get(interface)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+            try:
+                link = self.query(interface)
+            except OSError as e:
+                if e.errno != errno.ENODEV:
+                    self.close()  # start over with a fresh socket next time
+                raise
+            self.cache[interface] = (now, link)
+            return link
+
+    def query(self, interface):
+        if self.sock is None:
+            self.open()
+        self.seq += 1
+        name = interface.encode() + b'\0'
+        attribute = rtattr_struct.pack(rtattr_struct.size + len(name), IFLA_IFNAME) + name
+        attribute += bytes(_align(len(attribute)) - len(attribute))
+        payload = ifinfomsg_struct.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + attribute
+        self.sock.send(nlmsghdr_struct.pack(nlmsghdr_struct.size + len(payload), RTM_GETLINK,
+                                            NLM_F_REQUEST, self.seq, 0) + payload)
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + nlmsghdr_struct.size <= len(data):
+                length, kind, flags, seq, pid = nlmsghdr_struct.unpack_from(data, offset)
+                if length < nlmsghdr_struct.size:
+                    break
+                body = offset + nlmsghdr_struct.size
+                if seq == self.seq:
+                    if kind == NLMSG_ERROR:
+                        error = -nlmsgerr_struct.unpack_from(data, body)[0]
+                        raise OSError(error, f"{os.strerror(error)}: {interface}")
+                    if kind == RTM_NEWLINK:
+                        return self._parse(data, body, offset + length)
+                offset += _align(length)
+
+    def _parse(self, data, offset, end):
+        link = {'kind': None}
+        for kind, start, stop in iter_attributes(data, offset + ifinfomsg_struct.size, end):
+            if kind == IFLA_STATS64 and stop - start >= link_stats64_struct.size:
+                link.update(zip(LINK_STATS64_FIELDS, link_stats64_struct.unpack_from(data, start)))
+            elif kind == IFLA_LINKINFO:
+                for info_kind, info_start, info_stop in iter_attributes(data, start, stop):
+                    if info_kind == IFLA_INFO_KIND:
+                        link['kind'] = bytes(data[info_start:info_stop]).rstrip(b'\0').decode()
+                    elif info_kind == IFLA_INFO_DATA:
+                        self._parse_can(link, data, info_start, info_stop)
+        return link
+
+    def _parse_can(self, link, data, offset, end):
+        for kind, start, stop in iter_attributes(data, offset, end):
+            if kind == IFLA_CAN_STATE:
+                state = u32_struct.unpack_from(data, start)[0]
+                link['can_state'] = CAN_STATES[state] if state < len(CAN_STATES) else str(state)
+            elif kind == IFLA_CAN_BITTIMING and stop - start >= can_bittiming_struct.size:
+                bitrate, sample_point = can_bittiming_struct.unpack_from(data, start)[:2]
+                link['bitrate'] = bitrate
+                link['sample_point'] = sample_point/1000
+            elif kind == IFLA_CAN_BERR_COUNTER:
+                link['berr_counter'] = can_berr_counter_struct.unpack_from(data, start)
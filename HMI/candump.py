@@ -0,0 +1,91 @@
+'''
+candump log files as a CAN source.
+
+read_candump() parses the "(timestamp) interface ID#DATA" lines written by
+`candump -l` (like the captures in SystemDesign/2012_MC_X30_CAN), and
+replay_candump() hands them out in the same (frames, stamps) batches that
+CANBatchReader.read() returns, paced by the original timestamps. That lets
+the HMI pipeline run from a capture on a laptop with no boat and no vcan.
+'''
+import socket
+import time
+
+def parse_candump_line(line):
+    '''
+    Return (timestamp, interface, can_id, can_dlc, can_data) for one log line,
+    or None for lines that are not classic CAN frames. can_id carries the
+    EFF/RTR flags and can_data is padded to 8 bytes, like a struct can_frame.
+    '''
+    fields = line.split()
+    if len(fields) < 3 or not fields[0].startswith('('):
+        return None
+    timestamp = float(fields[0][1:-1])
+    interface = fields[1]
+    can_id_string, sep, data_string = fields[2].partition('#')
+    if not sep or data_string.startswith('#'):
+        return None  # not a frame, or a CAN FD frame
+    can_id = int(can_id_string, 16)
+    if len(can_id_string) > 3:
+        can_id |= socket.CAN_EFF_FLAG
+    if data_string.startswith('R'):
+        can_id |= socket.CAN_RTR_FLAG
+        can_dlc = int(data_string[1:] or 0)
+        can_data = bytes(8)
+    else:
+        can_data = bytes.fromhex(data_string)
+        can_dlc = len(can_data)
+        can_data = can_data.ljust(8, b'\x00')
+    return timestamp, interface, can_id, can_dlc, can_data
+
+def read_candump(filename):
+    with open(filename) as f:
+        for line in f:
+            frame = parse_candump_line(line)
+            if frame is not None:
+                yield frame
+
+def replay_candump(filename, speed=1.0, batch_size=64, loop=False):
+    '''
+    Yield (frames, stamps) batches from a candump log.
+
+    speed 1 replays in real time, N replays N times faster and 0 as fast as
+    possible. The stamps are the logged times; when looping, each pass starts
+    one average frame gap after the last frame of the one before, so time
+    keeps moving forward across the wrap.
+    '''
+    shift = 0.0
+    while True:
+        start_wall = time.time()
+        first_time = None
+        last_time = None
+        count = 0
+        frames = []
+        stamps = []
+        for timestamp, interface, can_id, can_dlc, can_data in read_candump(filename):
+            if first_time is None:
+                first_time = timestamp
+            last_time = timestamp
+            count += 1
+            if speed > 0:
+                delay = start_wall + (timestamp - first_time)/speed - time.time()
+                if delay > 0:
+                    # Hand over what we have before waiting for the next frame
+                    if frames:
+                        yield frames, stamps
+                        frames = []
+                        stamps = []
+                    time.sleep(delay)
+            frames.append((can_id, can_dlc, can_data))
+            stamps.append(timestamp + shift)
+            if len(frames) >= batch_size:
+                yield frames, stamps
+                frames = []
+                stamps = []
+        if frames:
+            yield frames, stamps
+        if not loop or first_time is None:
+            return
+        gap = (last_time - first_time)/(count - 1) if count > 1 else 1.0
+        shift += last_time - first_time + gap
+        if speed > 0:
+            time.sleep(gap/speed)
@@ -0,0 +1,325 @@
+'''
+Find the data bytes and bits that react to a console control.
+
+The SystemDesign captures were made pressing one control at a time (tower
+up/down, tab buttons, switches). Given the event windows, the times the
+control was being worked, SignalDiscovery keeps a histogram of every data
+byte of every (sa, pgn) inside and outside the windows and ranks the
+fields by how much knowing the field's value says about whether the event
+was on:
+
+    score = (H(field) - H(field | event)) / H(event) * (1 - changes outside)
+
+H(field) - H(field | event) is the entropy the field loses once the event
+state is known (its information gain, in bits), and dividing by the
+entropy of the event state makes it 0 for a field that ignores the
+control and 1 for one that follows it exactly. Counters, checksums and
+timers never repeat a value, so they "follow" any time window exactly;
+the last factor, the share of the frames outside the windows where the
+field changed, rules them out. A bit that is steady until a button is
+held and then flips scores 1, and so does a sensor byte that only moves
+while the tower does. Each field also reports its entropy inside and
+outside the windows, and the values it took there most often.
+
+Memory is bounded: a (sa, pgn) is two 8x256 histograms of frame counts
+and the change counts of its bytes and bits, and at most max_pgns of them
+are kept. Frames that repeat the payload and event state of the previous
+frame of their (sa, pgn) are only counted, and added to the histograms
+when that changes or results() is called, so a frame costs a dict lookup
+and a comparison most of the time.
+
+Offline, from a candump log, with the windows in seconds from its first frame:
+
+    python3 discovery.py ../SystemDesign/2012_MC_X30_CAN/MCx30_TowerUpDownButton.log --event 12.5:14 --event 30:31.5
+
+Live, /api/discovery starts an engine fed from process_data and marks
+event windows as they happen, at the time of the latest frame so a
+--replay works the same.
+'''
+import argparse
+import array
+import bisect
+import math
+import socket
+import threading
+
+from candump import read_candump
+from j1939 import get_j1939_from_id
+
+MAX_PGNS = 512  # 17 KiB each
+MIN_FRAMES = 2  # inside and outside the windows, for a field to be scored
+EVENT_BASE = 8*256  # offset of the inside-the-windows half of a histogram
+EVENT_CHANGES = 8*8 + 8  # offset of the inside-the-windows change counts
+NOT_J1939 = (0xFFFFE, 0xFE)  # (pgn, sa) records_from_frames gives 11-bit ids
+
+
+def entropy(counts, total):
+    # Shannon entropy in bits of a histogram
+    if not total:
+        return 0.0
+    bits = -sum(count/total*math.log2(count/total) for count in counts if count)
+    # A single value sums to -0.0, and rounding can leave a tiny negative
+    return bits if bits > 0 else 0.0
+
+def field_score(inside, outside, changes_out):
+    '''
+    Return (score, entropy inside, entropy outside) of a field from its
+    {value: frames} histograms inside and outside the event windows and
+    the number of frames outside where it changed.
+    '''
+    n_in = sum(inside.values())
+    n_out = sum(outside.values())
+    total = n_in + n_out
+    h_in = entropy(inside.values(), n_in)
+    h_out = entropy(outside.values(), n_out)
+    combined = dict(outside)
+    for value, count in inside.items():
+        combined[value] = combined.get(value, 0) + count
+    gain = entropy(combined.values(), total) - (n_in*h_in + n_out*h_out)/total
+    h_event = entropy((n_in, n_out), total)
+    steady = 1 - min(changes_out/n_out, 1.0)
+    return max(gain, 0.0)/h_event*steady, h_in, h_out
+
+def common_values(histogram, count=3):
+    return [value for value, frames in sorted(histogram.items(), key=lambda item: -item[1])[:count]]
+
+
+class FieldHistogram:
+    '''
+    Frame counts of each value of the 8 data bytes of one (sa, pgn),
+    outside the event windows at i*256 + value and inside at
+    EVENT_BASE + i*256 + value, and of the frames where bit b of byte i
+    (at i*8 + b) or byte i (at 64 + i) changed, outside and, from
+    EVENT_CHANGES on, inside.
+    '''
+    __slots__ = ('counts', 'changes', 'data', 'event', 'repeats')
+
+    def __init__(self):
+        self.counts = array.array('I', bytes(4*2*EVENT_BASE))
+        self.changes = array.array('I', bytes(4*2*EVENT_CHANGES))
+        self.data = None
+        self.event = False
+        self.repeats = 0
+
+    def settle(self):
+        repeats = self.repeats
+        if repeats:
+            counts = self.counts
+            index = EVENT_BASE if self.event else 0
+            for value in self.data[:8]:
+                counts[index + value] += repeats
+                index += 256
+            self.repeats = 0
+
+    def count_changes(self, data, event):
+        # Count the bytes and bits that differ between the last payload and data
+        diff = int.from_bytes(self.data[:8], 'little') ^ int.from_bytes(data[:8], 'little')
+        changes = self.changes
+        base = EVENT_CHANGES if event else 0
+        last_byte = None
+        while diff:
+            low = diff & -diff
+            index = low.bit_length() - 1
+            changes[base + index] += 1
+            if index >> 3 != last_byte:
+                last_byte = index >> 3
+                changes[base + 64 + last_byte] += 1
+            diff ^= low
+
+    def byte(self, i, event):
+        # {value: frames} of byte i inside or outside the windows
+        start = (EVENT_BASE if event else 0) + i*256
+        counts = self.counts
+        return {value: counts[start + value] for value in range(256) if counts[start + value]}
+
+
+class SignalDiscovery:
+    '''
+    windows are (start, end) timestamps, or seconds from the first frame
+    fed with relative. More can be opened and closed as they happen with
+    start_event() and end_event(), at the time of the last frame fed
+    unless given one.
+    '''
+    def __init__(self, windows=(), relative=False, max_pgns=MAX_PGNS):
+        self.max_pgns = max_pgns
+        self.relative = relative
+        self.origin = None
+        self.last_time = None
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(windows):
+            self._add_window(start, end)
+        self.histograms = {}  # (sa, pgn): FieldHistogram
+        self.lock = threading.Lock()
+        self.stats = {'frames': 0, 'event_frames': 0, 'pgns': 0, 'ignored': 0}
+        self._forget_state()
+
+    def _add_window(self, start, end):
+        if self.starts and start <= self.ends[-1]:
+            self.ends[-1] = max(self.ends[-1], end)  # overlaps the one before
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def _forget_state(self):
+        # The span of time the cached event state holds for, empty to look it up again
+        self.state_from = self.state_until = 0.0
+        self.state = False
+
+    def _event_at(self, timestamp):
+        if self.relative:
+            if self.origin is None:
+                self.origin = timestamp
+            timestamp -= self.origin
+        if self.state_from <= timestamp < self.state_until:
+            return self.state
+        i = bisect.bisect_right(self.starts, timestamp) - 1
+        if i >= 0 and timestamp < self.ends[i]:
+            self.state = True
+            self.state_from, self.state_until = self.starts[i], self.ends[i]
+        else:
+            self.state = False
+            self.state_from = self.ends[i] if i >= 0 else -math.inf
+            self.state_until = self.starts[i + 1] if i + 1 < len(self.starts) else math.inf
+        return self.state
+
+    def _now(self, timestamp):
+        if timestamp is None:
+            timestamp = self.last_time or 0.0
+        if self.relative and self.origin is not None:
+            timestamp -= self.origin
+        return timestamp
+
+    def start_event(self, timestamp=None):
+        with self.lock:
+            if not self.in_event():
+                self._add_window(self._now(timestamp), math.inf)
+                self._forget_state()
+
+    def end_event(self, timestamp=None):
+        with self.lock:
+            timestamp = self._now(timestamp)
+            if self.in_event():
+                self.ends[-1] = timestamp
+                self._forget_state()
+
+    def in_event(self):
+        return bool(self.ends) and self.ends[-1] == math.inf
+
+    def feed(self, timestamp, sa, pgn, data):
+        self.last_time = timestamp
+        event = self._event_at(timestamp)
+        key = (sa, pgn)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            if len(self.histograms) >= self.max_pgns:
+                self.stats['ignored'] += 1
+                return
+            histogram = self.histograms[key] = FieldHistogram()
+            self.stats['pgns'] += 1
+        elif data != histogram.data:
+            histogram.settle()
+            histogram.count_changes(data, event)
+        elif event != histogram.event:
+            histogram.settle()
+        histogram.data = data
+        histogram.event = event
+        histogram.repeats += 1
+        self.stats['frames'] += 1
+        if event:
+            self.stats['event_frames'] += 1
+
+    def feed_records(self, records):
+        # A batch in the raw_data_queue layout
+        # (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data)
+        with self.lock:
+            feed = self.feed
+            for interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data in records:
+                feed(can_time, sa, pgn, can_data)
+
+    def feed_candump(self, filename):
+        with self.lock:
+            for timestamp, interface, can_id, can_dlc, can_data in read_candump(filename):
+                if can_id & socket.CAN_EFF_FLAG:
+                    priority, pgn, da, sa = get_j1939_from_id(can_id & socket.CAN_EFF_MASK)
+                else:
+                    pgn, sa = NOT_J1939
+                self.feed(timestamp, sa, pgn, can_data[:can_dlc])
+
+    def results(self, top=20, min_score=0.05):
+        '''
+        The top fields by score, as dicts with sa, pgn, byte, bit (None for
+        the whole byte), score, entropy_in, entropy_out and the most common
+        values_in and values_out. A bit is listed instead of its byte when
+        it scores at least as well, as a button in a byte that also holds a
+        counter does.
+        '''
+        found = []
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.settle()
+            for (sa, pgn), histogram in self.histograms.items():
+                for i in range(8):
+                    inside = histogram.byte(i, True)
+                    outside = histogram.byte(i, False)
+                    if sum(inside.values()) < MIN_FRAMES or sum(outside.values()) < MIN_FRAMES:
+                        continue
+                    if len(inside) == 1 and inside.keys() == outside.keys():
+                        continue  # never changed
+                    changes = histogram.changes
+                    score, h_in, h_out = field_score(inside, outside, changes[64 + i])
+                    bits = []
+                    for bit in range(8):
+                        bit_in = {}
+                        bit_out = {}
+                        for values, counts in ((bit_in, inside), (bit_out, outside)):
+                            for value, count in counts.items():
+                                state = value >> bit & 1
+                                values[state] = values.get(state, 0) + count
+                        if len(bit_in) == 1 and bit_in.keys() == bit_out.keys():
+                            continue
+                        bit_score = field_score(bit_in, bit_out, changes[i*8 + bit])
+                        if bit_score[0] >= score*0.99:
+                            bits.append((bit, bit_score, bit_in, bit_out))
+                    if bits:
+                        for bit, (bit_score, bit_h_in, bit_h_out), bit_in, bit_out in bits:
+                            found.append((bit_score, sa, pgn, i, bit, bit_h_in, bit_h_out, bit_in, bit_out))
+                    else:
+                        found.append((score, sa, pgn, i, None, h_in, h_out, inside, outside))
+        found.sort(key=lambda field: -field[0])
+        return [{'sa': sa, 'pgn': pgn, 'byte': i, 'bit': bit, 'score': round(score, 3),
+                 'entropy_in': round(h_in, 3), 'entropy_out': round(h_out, 3),
+                 'values_in': common_values(inside), 'values_out': common_values(outside)}
+                for score, sa, pgn, i, bit, h_in, h_out, inside, outside in found
+                if score >= min_score][:top]
+
+
+def parse_window(text):
+    start, sep, end = text.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected START:END, got {text!r}")
+    return float(start), float(end)
+
+def format_result(result):
+    field = f"byte {result['byte']}" if result['bit'] is None else f"byte {result['byte']} bit {result['bit']}"
+    values_in = ' '.join(f"{value:02X}" for value in result['values_in'])
+    values_out = ' '.join(f"{value:02X}" for value in result['values_out'])
+    return (f"{result['score']:5.3f}  sa {result['sa']:3d}  pgn {result['pgn']:6d}  {field:<13}"
+            f"  H {result['entropy_out']:.2f} -> {result['entropy_in']:.2f}  out [{values_out}]  in [{values_in}]")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank the CAN data fields that follow an event")
+    parser.add_argument('log', help="candump -l log file")
+    parser.add_argument('--event', type=parse_window, action='append', required=True, metavar='START:END',
+                        help="seconds from the first frame the control was worked, can be repeated")
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--min-score', type=float, default=0.05)
+    args = parser.parse_args()
+
+    discovery = SignalDiscovery(args.event, relative=True)
+    discovery.feed_candump(args.log)
+    print(f"{discovery.stats['frames']} frames, {discovery.stats['event_frames']} in the event windows, "
+          f"{discovery.stats['pgns']} PGNs")
+    for result in discovery.results(args.top, args.min_score):
+        print(format_result(result))
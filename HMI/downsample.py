@@ -0,0 +1,349 @@
+'''
+Decimation of logged signals for plotting.
+
+A signal is read from a log table with the same pgn_decoders.json
+definitions process_data uses, or as one raw data byte, and reduced to
+about as many points as the plot is pixels wide, so a three hour session
+costs the phone the same as a three minute one:
+
+    bucket_stats  min, max, mean, last and count per time bucket; drawing
+                  the min-max band keeps every spike visible
+    lttb          Largest-Triangle-Three-Buckets, a line through the
+                  points that keep the shape of the signal
+
+Decoding every frame of a long session takes seconds, so whole-session
+views come from a SignalSummary: SUMMARY_STEP buckets of the signal,
+built on the first request and extended with only the new rows after
+that. Views zoomed in past SUMMARY_STEP per point read the raw frames of
+their time range instead.
+
+Frames are logged before multi-packet reassembly, so only single frame
+PGNs can be plotted this way.
+'''
+import array
+import collections
+import threading
+
+import can_log
+
+MAX_WIDTH = 4000
+SUMMARY_STEP = 1.0  # seconds
+SUMMARY_CACHE_SIZE = 16
+
+def signal_pgns(registry, name, pgns=()):
+    '''
+    Return the PGNs with a decoder that produces signal name. A decoder
+    with an index makes names like fluid_level_2, so those match on the
+    prefix.
+    '''
+    found = set()
+    for (pgn, sa), decoder in registry.items():
+        if pgns and pgn not in pgns:
+            continue
+        for i, signal in enumerate(decoder.signals):
+            if decoder.index is None:
+                if signal.name == name:
+                    found.add(pgn)
+            elif i != decoder.index and name.startswith(signal.name + '_'):
+                found.add(pgn)
+    return sorted(found)
+
+def query_pgns(registry, name, byte, pgns):
+    # The PGNs to read for a signal name, or for a raw byte of the given PGNs
+    if name is not None:
+        pgns = signal_pgns(registry, name, pgns)
+        if not pgns:
+            raise KeyError(f"No decoder produces {name}")
+    elif byte is None or not pgns:
+        raise ValueError("Give a signal name, or a pgn and a byte")
+    return pgns
+
+def signal_values(conn, table_name, registry, name=None, byte=None, pgns=(), sas=(), interfaces=(),
+                  start=None, end=None, after_rowid=0, until_rowid=None):
+    '''
+    Yield (rowid, timestamp, value) for a decoded signal, or for data byte
+    number byte of the given PGNs, from the rows after after_rowid up to
+    and including until_rowid.
+    '''
+    pgns = query_pgns(registry, name, byte, pgns)
+    data_column = 'data' if can_log.is_compact(conn, table_name) else 'data_bytes'
+    where, params = can_log.filter_clause(start, end, interfaces, sas, pgns)
+    conditions = ["rowid > ?"]
+    bounds = [after_rowid]
+    if until_rowid is not None:
+        conditions.append("rowid <= ?")
+        bounds.append(until_rowid)
+    if where:
+        conditions.append(where)
+    cursor = conn.execute(f"SELECT rowid, timestamp, sa, pgn, {data_column} FROM {table_name} "
+                          f"WHERE {' AND '.join(conditions)}", (*bounds, *params))
+    state = {}
+    find = registry.find
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            return
+        for rowid, timestamp, sa, pgn, data in rows:
+            if name is None:
+                if byte >= len(data):
+                    continue
+                yield rowid, timestamp, data[byte]
+            else:
+                decoder = find(pgn, sa)
+                if decoder is None or not decoder.decode_into(data, state):
+                    continue
+                value = state.get(name)
+                state.clear()
+                if value is not None:  # None: another instance of an indexed signal
+                    yield rowid, timestamp, value
+
+def read_signal(conn, table_name, registry, name=None, byte=None, pgns=(), sas=(), interfaces=(),
+                start=None, end=None):
+    '''
+    Return (times, values) arrays for a signal (see signal_values), sorted
+    by time.
+    '''
+    times = array.array('d')
+    values = array.array('d')
+    ordered = True
+    last_time = float('-inf')
+    for rowid, timestamp, value in signal_values(conn, table_name, registry, name, byte, pgns, sas,
+                                                 interfaces, start, end):
+        if timestamp < last_time:
+            ordered = False
+        last_time = timestamp
+        times.append(timestamp)
+        values.append(value)
+    if not ordered:
+        order = sorted(range(len(times)), key=times.__getitem__)
+        times = array.array('d', (times[i] for i in order))
+        values = array.array('d', (values[i] for i in order))
+    return times, values
+
+def bucket_stats(times, values, width, start=None, end=None):
+    '''
+    Split [start, end) into width equal time buckets and return a dict of
+    columns t (bucket start), min, max, mean, last and count, leaving out
+    the empty buckets. times must be sorted.
+    '''
+    columns = {'t': [], 'min': [], 'max': [], 'mean': [], 'last': [], 'count': []}
+    if not times:
+        return columns
+    start = times[0] if start is None else start
+    end = times[-1] if end is None else end
+    span = (end - start) or 1.0
+    step = span/width
+    current = None
+    for timestamp, value in zip(times, values):
+        bucket = int((timestamp - start)/step)
+        if bucket >= width:
+            bucket = width - 1
+        if bucket != current:
+            if current is not None:
+                columns['t'].append(start + current*step)
+                columns['min'].append(low)
+                columns['max'].append(high)
+                columns['mean'].append(total/count)
+                columns['last'].append(last)
+                columns['count'].append(count)
+            current = bucket
+            low = high = total = last = value
+            count = 1
+        else:
+            if value < low:
+                low = value
+            elif value > high:
+                high = value
+            total += value
+            last = value
+            count += 1
+    columns['t'].append(start + current*step)
+    columns['min'].append(low)
+    columns['max'].append(high)
+    columns['mean'].append(total/count)
+    columns['last'].append(last)
+    columns['count'].append(count)
+    return columns
+
+def lttb(times, values, threshold):
+    '''
+    Largest-Triangle-Three-Buckets: keep threshold of the points (the first,
+    the last and, from each bucket in between, the one making the largest
+    triangle with the point kept before it and the mean of the next
+    bucket). Returns (times, values) lists.
+    '''
+    count = len(times)
+    if threshold >= count or threshold < 3:
+        return list(times), list(values)
+    kept_times = [times[0]]
+    kept_values = [values[0]]
+    every = (count - 2)/(threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Mean of the next bucket
+        next_start = int((i + 1)*every) + 1
+        next_end = min(int((i + 2)*every) + 1, count)
+        span = next_end - next_start
+        mean_time = sum(times[next_start:next_end])/span
+        mean_value = sum(values[next_start:next_end])/span
+
+        bucket_start = int(i*every) + 1
+        bucket_end = int((i + 1)*every) + 1
+        a_time = times[a]
+        a_value = values[a]
+        largest = -1.0
+        chosen = bucket_start
+        for j in range(bucket_start, bucket_end):
+            area = abs((a_time - mean_time)*(values[j] - a_value) - (a_time - times[j])*(mean_value - a_value))
+            if area > largest:
+                largest = area
+                chosen = j
+        kept_times.append(times[chosen])
+        kept_values.append(values[chosen])
+        a = chosen
+    kept_times.append(times[-1])
+    kept_values.append(values[-1])
+    return kept_times, kept_values
+
+
+class SignalSummary:
+    '''
+    min, max, sum, count and last value of one signal per SUMMARY_STEP of
+    a log table, kept up to date by update() as the table grows.
+    '''
+    def __init__(self, query):
+        self.query = query  # signal_values() arguments after conn and table_name
+        self.first_rowid = None
+        self.last_rowid = 0
+        self.buckets = {}  # bucket number: [min, max, sum, count, last, last time]
+        self.lock = threading.Lock()
+
+    def update(self, conn, table_name):
+        with self.lock:
+            # Separate queries: SQLite only answers a lone min() or max() from the b-tree ends
+            first_rowid = conn.execute(f"SELECT min(rowid) FROM {table_name}").fetchone()[0]
+            last_rowid = conn.execute(f"SELECT max(rowid) FROM {table_name}").fetchone()[0]
+            if first_rowid != self.first_rowid or (last_rowid or 0) < self.last_rowid:
+                # Emptied or recreated since the last update
+                self.first_rowid = first_rowid
+                self.last_rowid = 0
+                self.buckets = {}
+            if (last_rowid or 0) == self.last_rowid:
+                return
+            buckets = self.buckets
+            # Stop at last_rowid: rows written during the scan belong to the next update
+            for rowid, timestamp, value in signal_values(conn, table_name, *self.query, after_rowid=self.last_rowid,
+                                                         until_rowid=last_rowid):
+                number = int(timestamp//SUMMARY_STEP)
+                bucket = buckets.get(number)
+                if bucket is None:
+                    buckets[number] = [value, value, value, 1, value, timestamp]
+                    continue
+                if value < bucket[0]:
+                    bucket[0] = value
+                elif value > bucket[1]:
+                    bucket[1] = value
+                bucket[2] += value
+                bucket[3] += 1
+                if timestamp >= bucket[5]:
+                    bucket[4] = value
+                    bucket[5] = timestamp
+            self.last_rowid = last_rowid
+
+    def span(self):
+        if not self.buckets:
+            return None, None
+        return min(self.buckets)*SUMMARY_STEP, (max(self.buckets) + 1)*SUMMARY_STEP
+
+    def bucket_stats(self, width, start=None, end=None):
+        '''
+        Like bucket_stats() over the raw values, to SUMMARY_STEP accuracy.
+        '''
+        columns = {'t': [], 'min': [], 'max': [], 'mean': [], 'last': [], 'count': []}
+        first, last = self.span()
+        if first is None:
+            return columns
+        start = first if start is None else start
+        end = last if end is None else end
+        step = ((end - start) or SUMMARY_STEP)/width
+        merged = {}
+        for number in sorted(self.buckets):
+            low, high, total, count, value, value_time = self.buckets[number]
+            timestamp = number*SUMMARY_STEP
+            if timestamp < start - SUMMARY_STEP or timestamp >= end:
+                continue
+            index = min(max(int((timestamp - start)/step), 0), width - 1)
+            entry = merged.get(index)
+            if entry is None:
+                merged[index] = [low, high, total, count, value]
+            else:
+                entry[0] = min(entry[0], low)
+                entry[1] = max(entry[1], high)
+                entry[2] += total
+                entry[3] += count
+                entry[4] = value
+        for index in sorted(merged):
+            low, high, total, count, value = merged[index]
+            columns['t'].append(start + index*step)
+            columns['min'].append(low)
+            columns['max'].append(high)
+            columns['mean'].append(total/count)
+            columns['last'].append(value)
+            columns['count'].append(count)
+        return columns
+
+    def means(self, start=None, end=None):
+        # (times, values) of the bucket means, the input for lttb()
+        times = []
+        values = []
+        for number in sorted(self.buckets):
+            timestamp = number*SUMMARY_STEP
+            if (start is None or timestamp >= start - SUMMARY_STEP) and (end is None or timestamp < end):
+                bucket = self.buckets[number]
+                times.append(timestamp + SUMMARY_STEP/2)
+                values.append(bucket[2]/bucket[3])
+        return times, values
+
+
+summaries = collections.OrderedDict()  # (table_name, *query): SignalSummary, least recently used first
+summaries_lock = threading.Lock()
+
+def signal_summary(conn, table_name, registry, name=None, byte=None, pgns=(), sas=(), interfaces=()):
+    # The up to date SignalSummary of a signal, from the cache when it is there
+    query = (registry, name, byte, tuple(query_pgns(registry, name, byte, pgns)), tuple(sas), tuple(interfaces))
+    key = (table_name, *query[1:])
+    with summaries_lock:
+        summary = summaries.pop(key, None)
+        if summary is None:
+            summary = SignalSummary(query)
+        summaries[key] = summary
+        while len(summaries) > SUMMARY_CACHE_SIZE:
+            summaries.popitem(last=False)
+    summary.update(conn, table_name)
+    return summary
+
+def forget_table(table_name):
+    # Drop the summaries of a table that was deleted or recreated; a new table
+    # under the same name starts again at rowid 1, which update() cannot tell
+    with summaries_lock:
+        for key in [key for key in summaries if key[0] == table_name]:
+            del summaries[key]
+
+def downsample(conn, table_name, registry, width, method='minmax', name=None, byte=None, pgns=(), sas=(),
+               interfaces=(), start=None, end=None):
+    '''
+    A signal reduced to width points as a dict of columns: t, min, max,
+    mean, last and count for minmax, t and value for lttb.
+    '''
+    if start is not None and end is not None and (end - start)/width < SUMMARY_STEP:
+        # Zoomed in past the summary: the raw values of the range are few
+        times, values = read_signal(conn, table_name, registry, name, byte, pgns, sas, interfaces, start, end)
+        if method == 'lttb':
+            t, value = lttb(times, values, width)
+            return {'t': t, 'value': value}
+        return bucket_stats(times, values, width, start, end)
+    summary = signal_summary(conn, table_name, registry, name, byte, pgns, sas, interfaces)
+    if method == 'lttb':
+        t, value = lttb(*summary.means(start, end), width)
+        return {'t': t, 'value': value}
+    return summary.bucket_stats(width, start, end)
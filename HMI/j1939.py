@@ -0,0 +1,391 @@
+'''
+J1939 multi-packet message handling for process_data.
+
+TransportReassembler follows J1939-21 transport protocol sessions (TP.CM
+and TP.DT) on the bus as a passive listener. Both broadcast (BAM) and
+connection mode (RTS/CTS) transfers are rebuilt, keyed by
+(interface, sa, da). Sessions and their 1785 byte payload buffers come
+from a fixed pool, so memory is bounded and nothing is allocated for a
+data packet. Stale sessions are evicted after the J1939 timeouts.
+
+FastPacketAssembler does the same for NMEA 2000 fast packets, keyed by
+(interface, sa, pgn, sequence id). Frames may arrive in any order; a
+message with a dropped frame is evicted when it goes stale. Only single
+frames go through it; a fast packet PGN that arrived over transport
+protocol passes straight on to the decoders.
+
+get_j1939_from_id() splits a 29-bit id into its J1939 fields and
+j1939_id() builds one. IDCache keeps those fields and the id text of the
+few hundred ids a bus carries, so the readers split each id once.
+'''
+import socket
+
+TP_CM_PGN = 0xEC00  # Transport Protocol - Connection Management
+TP_DT_PGN = 0xEB00  # Transport Protocol - Data Transfer
+
+TP_CM_RTS = 16
+TP_CM_CTS = 17
+TP_CM_EOM_ACK = 19
+TP_CM_BAM = 32
+TP_CM_ABORT = 255
+
+TP_MAX_SIZE = 1785  # 255 packets of 7 bytes
+TP_BAM_TIMEOUT = 0.75  # T1, between broadcast data packets
+TP_RTS_TIMEOUT = 1.25  # T2/T3, connection mode
+TP_MAX_SESSIONS = 32
+TP_PRIORITY = 6
+NOT_SEEN = bytes(256)
+NOT_SEEN_FAST = bytes(32)
+
+FAST_PACKET_MAX_SIZE = 223  # 6 bytes in the first frame + 31 frames of 7
+FAST_PACKET_TIMEOUT = 0.75
+FAST_PACKET_MAX_SESSIONS = 32
+
+ID_CACHE_SIZE = 2048  # ids kept; a bus carries a few hundred
+
+# NMEA 2000 PGNs sent as fast packets that show up on boat networks.
+# 127237 Heading/Track control is left out because pgn_decoders.json reads
+# it as a single frame, which is how the autopilot on this boat sends it.
+FAST_PACKET_PGNS = {
+    126208, 126464, 126720, 126983, 126984, 126985, 126986, 126987, 126988, 126996, 126998,
+    127233, 127489, 127496, 127497, 127498, 127503, 127504, 127506, 127507, 127509,
+    127510, 127511, 127512, 127513, 127514,
+    128275, 128520,
+    129029, 129038, 129039, 129040, 129041, 129044, 129045, 129284, 129285, 129301, 129302,
+    129538, 129540, 129541, 129542, 129545, 129547, 129549, 129551, 129556, 129792, 129793,
+    129794, 129795, 129796, 129797, 129798, 129799, 129800, 129801, 129802, 129803, 129804,
+    129805, 129806, 129807, 129808, 129809, 129810,
+    130052, 130053, 130054, 130060, 130061, 130064, 130065, 130066, 130067, 130068, 130069,
+    130070, 130071, 130072, 130073, 130074, 130320, 130321, 130322, 130323, 130324, 130567,
+    130577, 130578, 130816,
+}
+
+# J1939 bit masks and shifts
+PRIORITY_MASK = 0x1C000000
+EDP_MASK = 0x02000000
+DP_MASK = 0x01000000
+PF_MASK = 0x00FF0000
+PS_MASK = 0x0000FF00
+SA_MASK = 0x000000FF
+PDU1_PGN_MASK = 0x03FF0000
+PDU2_PGN_MASK = 0x03FFFF00
+
+def get_j1939_from_id(can_id):
+    priority = (PRIORITY_MASK & can_id) >> 26
+    PF = (can_id & PF_MASK) >> 16
+    if PF >= 0xF0:  # PDU 2 format
+        DA = 255
+        PGN = (can_id & PDU2_PGN_MASK) >> 8
+    else:  # PDU 1 format
+        PGN = (can_id & PDU1_PGN_MASK) >> 8
+        DA = (can_id & PS_MASK) >> 8
+    SA = (can_id & SA_MASK)
+    return priority, PGN, DA, SA
+
+def split_can_id(can_id):
+    # (priority, pgn, da, sa, id text) of a can_id with its EFF/RTR/ERR flags,
+    # with made up out of range fields for 11-bit ids, where J1939 is not defined
+    if can_id & socket.CAN_EFF_FLAG:
+        can_id &= socket.CAN_EFF_MASK
+        return (*get_j1939_from_id(can_id), "{:08X}".format(can_id))
+    return 0xE, 0xFFFFE, 0xFE, 0xFE, "{:03X}".format(can_id & socket.CAN_SFF_MASK)
+
+def j1939_id(priority, pgn, da, sa):
+    # Build the 29-bit id a single frame with this PGN would have used
+    if (pgn >> 8) & 0xFF < 0xF0:
+        pgn = (pgn & 0x3FF00) | da
+    return (priority << 26) | (pgn << 8) | sa
+
+
+class TransportSession:
+    __slots__ = ('key', 'pgn', 'size', 'packets', 'received', 'seen', 'buffer', 'last_time', 'bam')
+
+    def __init__(self):
+        self.key = None
+        self.pgn = 0
+        self.size = 0
+        self.packets = 0
+        self.received = 0
+        self.seen = bytearray(256)
+        self.buffer = bytearray(TP_MAX_SIZE)
+        self.last_time = 0.0
+        self.bam = False
+
+    def start(self, key, pgn, size, packets, can_time, bam):
+        self.key = key
+        self.pgn = pgn
+        self.size = size
+        self.packets = packets
+        self.received = 0
+        self.seen[:] = NOT_SEEN
+        self.last_time = can_time
+        self.bam = bam
+
+
+class TransportReassembler:
+    '''
+    Feed it TP.CM and TP.DT records; feed() returns the rebuilt record once
+    the last data packet of a session arrives.
+
+    Records have the raw_data_queue layout
+    (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data).
+    '''
+    def __init__(self, max_sessions=TP_MAX_SESSIONS):
+        self.free = [TransportSession() for _ in range(max_sessions)]
+        self.sessions = {}
+        self.next_expire = 0.0
+        self.stats = {'completed': 0, 'aborted': 0, 'timed_out': 0, 'evicted': 0, 'orphans': 0}
+
+    def expand(self, batch):
+        # Yield every record of the batch, each followed by any message it completes
+        for record in batch:
+            yield record
+            pgn = record[2]
+            if pgn == TP_CM_PGN or pgn == TP_DT_PGN:
+                message = self.feed(record)
+                if message is not None:
+                    yield message
+
+    def feed(self, record):
+        interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data = record
+        if can_time >= self.next_expire:
+            self.expire(can_time)
+            self.next_expire = can_time + TP_BAM_TIMEOUT/3
+        if len(can_data) < 8:
+            return None
+        if pgn == TP_DT_PGN:
+            return self._data(interface, sa, da, can_time, can_data)
+        self._connection(interface, sa, da, can_time, can_data)
+        return None
+
+    def _connection(self, interface, sa, da, can_time, can_data):
+        control = can_data[0]
+        if control == TP_CM_BAM or control == TP_CM_RTS:
+            size = can_data[1] | (can_data[2] << 8)
+            packets = can_data[3]
+            pgn = can_data[5] | (can_data[6] << 8) | (can_data[7] << 16)
+            if size > TP_MAX_SIZE or packets == 0 or packets*7 < size:
+                return
+            key = (interface, sa, da)
+            session = self.sessions.pop(key, None)
+            if session is not None:
+                self.stats['aborted'] += 1  # superseded by a new announcement
+            else:
+                session = self._allocate(can_time)
+            session.start(key, pgn, size, packets, can_time, control == TP_CM_BAM)
+            self.sessions[key] = session
+        elif control == TP_CM_CTS:
+            # Sent by the receiver, so the session is keyed the other way round
+            session = self.sessions.get((interface, da, sa))
+            if session is not None:
+                session.last_time = can_time
+        elif control == TP_CM_ABORT:
+            for key in ((interface, sa, da), (interface, da, sa)):
+                session = self.sessions.pop(key, None)
+                if session is not None:
+                    self.stats['aborted'] += 1
+                    self.free.append(session)
+
+    def _data(self, interface, sa, da, can_time, can_data):
+        key = (interface, sa, da)
+        session = self.sessions.get(key)
+        if session is None:
+            self.stats['orphans'] += 1
+            return None
+        sequence = can_data[0]
+        if sequence == 0 or sequence > session.packets:
+            return None
+        session.last_time = can_time
+        if not session.seen[sequence]:
+            session.seen[sequence] = 1
+            session.received += 1
+            offset = (sequence - 1)*7
+            session.buffer[offset:offset+7] = can_data[1:8]
+        if session.received < session.packets:
+            return None
+
+        del self.sessions[key]
+        self.free.append(session)
+        self.stats['completed'] += 1
+        data = bytes(session.buffer[:session.size])
+        pgn = session.pgn
+        can_id_string = "{:08X}".format(j1939_id(TP_PRIORITY, pgn, da, sa))
+        return (interface, sa, pgn, can_time, da, can_id_string, data.hex(' ').upper(), data)
+
+    def _allocate(self, can_time):
+        if self.free:
+            return self.free.pop()
+        # Pool exhausted: reuse the session that has been quiet the longest
+        oldest = min(self.sessions.values(), key=lambda s: s.last_time)
+        del self.sessions[oldest.key]
+        self.stats['evicted'] += 1
+        return oldest
+
+    def expire(self, now):
+        for key, session in list(self.sessions.items()):
+            timeout = TP_BAM_TIMEOUT if session.bam else TP_RTS_TIMEOUT
+            if now - session.last_time > timeout:
+                del self.sessions[key]
+                self.free.append(session)
+                self.stats['timed_out'] += 1
+
+
+class FastPacketSession:
+    __slots__ = ('key', 'size', 'frames', 'received', 'seen', 'buffer', 'last_time')
+
+    def __init__(self):
+        self.key = None
+        self.size = -1
+        self.frames = 0
+        self.received = 0
+        self.seen = bytearray(32)
+        self.buffer = bytearray(FAST_PACKET_MAX_SIZE)
+        self.last_time = 0.0
+
+    def start(self, key, can_time):
+        self.key = key
+        self.size = -1  # unknown until frame 0 arrives
+        self.frames = 0
+        self.received = 0
+        self.seen[:] = NOT_SEEN_FAST
+        self.last_time = can_time
+
+
+class FastPacketAssembler:
+    '''
+    Feed it frames of fast packet PGNs; feed() returns the rebuilt record
+    once every frame of a message has arrived.
+    '''
+    def __init__(self, pgns=FAST_PACKET_PGNS, max_sessions=FAST_PACKET_MAX_SESSIONS):
+        self.pgns = pgns
+        self.free = [FastPacketSession() for _ in range(max_sessions)]
+        self.sessions = {}
+        self.next_expire = 0.0
+        self.message = None  # the last rebuilt record
+        self.stats = {'completed': 0, 'restarted': 0, 'timed_out': 0, 'evicted': 0}
+
+    def expand(self, records):
+        # Yield every record, each followed by any message it completes
+        pgns = self.pgns
+        for record in records:
+            yield record
+            if record[2] in pgns and len(record[7]) <= 8:
+                message = self.feed(record)
+                if message is not None:
+                    self.message = message
+                    yield message
+
+    def is_fragment(self, record):
+        # True for a single frame of a fast packet PGN, which must not be decoded
+        # on its own. Longer records were rebuilt by TransportReassembler.
+        return record[2] in self.pgns and record is not self.message and len(record[7]) <= 8
+
+    def feed(self, record):
+        interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data = record
+        if can_time >= self.next_expire:
+            self.expire(can_time)
+            self.next_expire = can_time + FAST_PACKET_TIMEOUT/3
+        if len(can_data) < 2:
+            return None
+        sequence = can_data[0] >> 5
+        frame = can_data[0] & 0x1F
+        key = (interface, sa, pgn, sequence)
+        session = self.sessions.get(key)
+        if session is None:
+            session = self._allocate()
+            session.start(key, can_time)
+            self.sessions[key] = session
+        elif session.seen[frame]:
+            # Same sequence id again before the last message finished
+            self.stats['restarted'] += 1
+            session.start(key, can_time)
+        session.last_time = can_time
+
+        if frame == 0:
+            size = can_data[1]
+            if size > FAST_PACKET_MAX_SIZE:
+                self._release(key, session)
+                return None
+            session.size = size
+            session.frames = 1 if size <= 6 else 1 + (size - 6 + 6)//7
+            session.buffer[0:6] = can_data[2:8]
+        else:
+            offset = 6 + (frame - 1)*7
+            session.buffer[offset:offset+7] = can_data[1:8]
+        session.seen[frame] = 1
+        session.received += 1
+
+        if session.size < 0 or session.received < session.frames:
+            return None
+        if session.seen.count(1, 0, session.frames) < session.frames:
+            return None  # a frame past the end was counted; wait for the real ones
+        data = bytes(session.buffer[:session.size])
+        self._release(key, session)
+        self.stats['completed'] += 1
+        return (interface, sa, pgn, can_time, da, can_id_string, data.hex(' ').upper(), data)
+
+    def _release(self, key, session):
+        del self.sessions[key]
+        self.free.append(session)
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        oldest = min(self.sessions.values(), key=lambda s: s.last_time)
+        del self.sessions[oldest.key]
+        self.stats['evicted'] += 1
+        return oldest
+
+    def expire(self, now):
+        for key, session in list(self.sessions.items()):
+            if now - session.last_time > FAST_PACKET_TIMEOUT:
+                self._release(key, session)
+                self.stats['timed_out'] += 1
+
+
+class IDCache:
+    '''
+    split_can_id() of every can_id seen, keyed by the raw id with its flags.
+    Once size ids are kept the oldest one is dropped for each new id, so a
+    bus flooded with random ids costs a bounded dict and nothing more.
+
+    split_frames() does a whole batch from a reader and counts the lookups
+    and misses in stats, along with the hit rate so far.
+    '''
+    def __init__(self, size=ID_CACHE_SIZE):
+        self.size = size
+        self.fields = {}
+        self.stats = {'lookups': 0, 'misses': 0, 'ids': 0, 'hit_rate': 0.0}
+
+    def _add(self, can_id):
+        fields = self.fields
+        if len(fields) >= self.size:
+            del fields[next(iter(fields))]
+        entry = fields[can_id] = split_can_id(can_id)
+        self.stats['misses'] += 1
+        return entry
+
+    def split(self, can_id):
+        stats = self.stats
+        stats['lookups'] += 1
+        entry = self.fields.get(can_id)
+        if entry is None:
+            entry = self._add(can_id)
+            stats['ids'] = len(self.fields)
+        stats['hit_rate'] = 1 - stats['misses']/stats['lookups']
+        return entry
+
+    def split_frames(self, frames):
+        # split_can_id() of the can_id of every (can_id, can_dlc, can_data) frame
+        get = self.fields.get
+        found = [get(frame[0]) for frame in frames]
+        if None in found:
+            for i, entry in enumerate(found):
+                if entry is None:
+                    found[i] = get(frames[i][0]) or self._add(frames[i][0])
+            self.stats['ids'] = len(self.fields)
+        stats = self.stats
+        stats['lookups'] += len(frames)
+        if stats['lookups']:
+            stats['hit_rate'] = 1 - stats['misses']/stats['lookups']
+        return found
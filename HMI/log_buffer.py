@@ -0,0 +1,134 @@
+'''
+Bounded hand-off between process_data and write_to_db.
+
+processed_data_queue used to be a queue.Queue(5000), so a writer that fell
+behind (a slow SD card, a long index build) or was never started made
+process_data block on put() and froze every live display with it.
+LogBuffer.put() never blocks. Once max_frames are waiting, the overflow
+policy decides what gives:
+
+    drop-oldest  the oldest batches are thrown away to make room (a ring)
+    drop-newest  the incoming batch is thrown away
+    spill        batches go to segment files in spill_dir and are read back
+                 in order once the writer catches up; past spill_limit bytes
+                 the incoming batch is thrown away
+
+Every frame that was thrown away is counted in stats['dropped'].
+'''
+import collections
+import marshal
+import os
+import tempfile
+import threading
+
+LOG_BUFFER_POLICIES = ('drop-oldest', 'drop-newest', 'spill')
+LOG_BUFFER_FRAMES = 200000  # about 50 s of two buses at full load
+SPILL_LIMIT = 256*1024*1024  # bytes
+SPILL_SEGMENT_SIZE = 4*1024*1024  # bytes, also the most take() reads back at once
+
+
+class LogBuffer:
+    '''
+    Holds batches of raw_data_queue records
+    (interface, sa, pgn, can_time, da, can_id_string, can_data_string, can_data).
+    '''
+    def __init__(self, max_frames=LOG_BUFFER_FRAMES, policy='drop-oldest', spill_dir=None, spill_limit=SPILL_LIMIT):
+        if policy not in LOG_BUFFER_POLICIES:
+            raise ValueError(f"Unknown log buffer policy {policy!r}, expected one of {LOG_BUFFER_POLICIES}")
+        self.max_frames = max_frames
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.spill_limit = spill_limit
+        self.lock = threading.Lock()
+        self.batches = collections.deque()
+        self.frames = 0
+        self.segments = collections.deque()  # closed spill files, oldest first
+        self.segment = None  # the spill file being appended to
+        self.stats = {'policy': policy, 'queued': 0, 'high_water': 0, 'dropped': 0,
+                      'spilled': 0, 'spill_bytes': 0}
+
+    def put(self, batch):
+        with self.lock:
+            if self.segment is not None or self.segments:
+                # Keep the order: nothing goes back in memory until the spill is read
+                self._spill(batch)
+            elif self.frames + len(batch) <= self.max_frames:
+                self._append(batch)
+            elif self.policy == 'drop-oldest':
+                while self.batches and self.frames + len(batch) > self.max_frames:
+                    dropped = len(self.batches.popleft())
+                    self.frames -= dropped
+                    self.stats['dropped'] += dropped
+                self._append(batch)
+            elif self.policy == 'spill':
+                self._spill(batch)
+            else:
+                self.stats['dropped'] += len(batch)
+
+    def drop(self, count):
+        # Count frames lost after take(), like the ones put() drops
+        with self.lock:
+            self.stats['dropped'] += count
+
+    def take(self):
+        '''
+        Return the waiting records as one list, oldest first: everything held
+        in memory or, once that is empty, the oldest spill segment.
+        '''
+        with self.lock:
+            if self.batches:
+                batches = self.batches
+                self.batches = collections.deque()
+                self.frames = 0
+                self.stats['queued'] = 0
+                records = []
+                for batch in batches:
+                    records.extend(batch)
+                return records
+            if not self.segments and self.segment is not None:
+                self._close_segment()
+            if not self.segments:
+                return []
+            path, size = self.segments.popleft()
+            self.stats['spill_bytes'] -= size
+        # Read the segment outside the lock so put() never waits on the disk
+        records = []
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    records.extend(marshal.load(f))
+                except EOFError:
+                    break
+        os.unlink(path)
+        return records
+
+    def qsize(self):
+        return self.frames
+
+    def _append(self, batch):
+        self.batches.append(batch)
+        self.frames += len(batch)
+        self.stats['queued'] = self.frames
+        if self.frames > self.stats['high_water']:
+            self.stats['high_water'] = self.frames
+
+    def _spill(self, batch):
+        if self.stats['spill_bytes'] >= self.spill_limit:
+            self.stats['dropped'] += len(batch)
+            return
+        if self.segment is None:
+            fd, path = tempfile.mkstemp(prefix='can_log_spill_', suffix='.bin', dir=self.spill_dir)
+            self.segment = (os.fdopen(fd, 'wb'), path)
+        f, path = self.segment
+        start = f.tell()
+        marshal.dump(list(batch), f)
+        self.stats['spill_bytes'] += f.tell() - start
+        self.stats['spilled'] += len(batch)
+        if f.tell() >= SPILL_SEGMENT_SIZE:
+            self._close_segment()
+
+    def _close_segment(self):
+        f, path = self.segment
+        self.segments.append((path, f.tell()))
+        f.close()
+        self.segment = None
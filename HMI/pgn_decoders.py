@@ -0,0 +1,176 @@
+'''
+Table driven PGN decoders for process_data.
+
+Decoders are declared in pgn_decoders.json and looked up by (pgn, sa), with
+(pgn, None) matching any source address. Each entry looks like
+
+    {"pgn": 127250, "name": "Vessel Heading", "target": "nav",
+     "signals": [{"name": "heading", "type": "H", "start": 0,
+                  "scale": 0.0057295..., "round": 1}]}
+
+target    which state dict gets the values ("nav" or "ballast")
+sa        optional source address the decoder is limited to
+enqueue   optional, put the nav state on nav_data_queue after decoding
+index     optional, name of a signal whose value is appended to the other
+          signal names (e.g. one fluid level per tank instance)
+
+Signal keys: type is a little endian struct code (B, b, H, h, L, l, Q, q),
+start is the byte offset, and the optional mask, shift, offset, scale,
+round and bool are applied in that order:
+    value = (((raw & mask) >> shift) + offset) * scale
+round: 0 gives an int like round(x), null leaves the float alone.
+
+All signals of a decoder are compiled into one struct.Struct, so a frame
+is unpacked with a single unpack_from call, and into a straight line
+decode_into function (the same trick collections.namedtuple uses) so the
+per frame work matches the hand written if/elif branches it replaced. The registry also keeps a
+pgn -> [decoder for each sa] table, so frames without a decoder cost one
+int lookup and the others one more list index.
+'''
+import json
+import struct
+
+class Signal:
+    __slots__ = ('name', 'type', 'start', 'mask', 'shift', 'offset', 'scale', 'digits', 'is_bool')
+
+    def __init__(self, name, type, start=0, mask=None, shift=0, offset=0, scale=1,
+                 round=None, bool=False):
+        self.name = name
+        self.type = type
+        self.start = start
+        self.mask = mask
+        self.shift = shift
+        self.offset = offset
+        self.scale = scale
+        self.digits = round
+        self.is_bool = bool
+
+    def as_tuple(self, field):
+        return (self.name, field, self.mask, self.shift, self.offset, self.scale, self.digits, self.is_bool)
+
+
+class PGNDecoder:
+    __slots__ = ('pgn', 'sa', 'name', 'target', 'enqueue', 'signals', 'fields', 'struct', 'index', 'plan',
+                 'decode_into')
+
+    def __init__(self, pgn, signals, name='', target='nav', sa=None, enqueue=False, index=None):
+        self.pgn = pgn
+        self.sa = sa
+        self.name = name
+        self.target = target
+        self.enqueue = enqueue
+        self.signals = [Signal(**s) for s in signals]
+
+        # Build one little endian layout with pad bytes between the raw fields.
+        # Bit field signals share a raw field with the same start and type.
+        raw_fields = sorted({(s.start, s.type) for s in self.signals})
+        layout = '<'
+        position = 0
+        for start, type in raw_fields:
+            if start < position:
+                raise ValueError(f"PGN {pgn} field at byte {start} overlaps the previous field")
+            layout += 'x'*(start - position) + type
+            position = start + struct.calcsize('<' + type)
+        self.struct = struct.Struct(layout)
+        self.fields = [raw_fields.index((s.start, s.type)) for s in self.signals]
+        self.plan = [s.as_tuple(f) for s, f in zip(self.signals, self.fields)]
+
+        self.index = None
+        if index is not None:
+            names = [s.name for s in self.signals]
+            if index not in names:
+                raise ValueError(f"PGN {pgn} index {index} is not one of its signals")
+            self.index = names.index(index)
+        self.decode_into = self._compile()
+
+    def _compile(self):
+        # Generate "state['rudder'] = round(r0 * 0.0057, 1)" style lines
+        # Builtins are bound as defaults so they are locals, and a short frame
+        # is caught from unpack_from rather than checked on every call
+        raw_names = ', '.join(f"r{i}" for i in range(max(self.fields) + 1))
+        lines = ["def decode_into(data, state, unpack_from=unpack_from, error=error, round=round, bool=bool):",
+                 "    try:",
+                 f"        {raw_names}, = unpack_from(data)",
+                 "    except error:",
+                 "        return False"]
+        if self.index is not None:
+            index_name = self.signals[self.index].name
+        for name, field, mask, shift, offset, scale, digits, is_bool in self.plan:
+            expr = f"r{field}"
+            if mask is not None:
+                expr = f"((r{field} & {mask}) >> {shift})"
+            if is_bool:
+                expr = f"bool({expr})"
+            else:
+                if offset:
+                    expr = f"({expr} + {offset!r})"
+                if scale != 1:
+                    expr = f"{expr} * {scale!r}"
+                if digits == 0:
+                    expr = f"round({expr})"
+                elif digits is not None:
+                    expr = f"round({expr}, {digits})"
+            if self.index is None:
+                lines.append(f"    state[{name!r}] = {expr}")
+            elif name == index_name:
+                lines.insert(5, f"    suffix = {expr}")
+            else:
+                lines.append(f"    state[f'{name}_{{suffix}}'] = {expr}")
+        lines.append("    return True")
+        namespace = {'unpack_from': self.struct.unpack_from, 'error': struct.error}
+        exec('\n'.join(lines), namespace)
+        return namespace['decode_into']
+
+    def decode(self, data):
+        '''
+        Return a dict of converted signal values, or None if data is too short.
+        decode_into(data, state) stores them straight into state and returns
+        False if data is too short.
+        '''
+        values = {}
+        if not self.decode_into(data, values):
+            return None
+        return values
+
+
+class DecoderRegistry(dict):
+    '''
+    dict of PGNDecoder keyed by (pgn, sa), with sa None for any source.
+    by_source maps a pgn to a list of the decoder find() gives for each of
+    the 256 source addresses, so the per frame lookup is a dict get and a
+    list index.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.by_pgn = {}
+        self.by_source = {}
+
+    def add(self, decoder):
+        key = (decoder.pgn, decoder.sa)
+        if key in self:
+            raise ValueError(f"Duplicate decoder for PGN {decoder.pgn} SA {decoder.sa}")
+        self[key] = decoder
+        self.by_pgn.setdefault(decoder.pgn, {})[decoder.sa] = decoder
+        self.by_source[decoder.pgn] = [self.find(decoder.pgn, sa) for sa in range(256)]
+
+    def find(self, pgn, sa):
+        # A decoder for this exact source address wins over the any-source one
+        by_sa = self.by_pgn.get(pgn)
+        if by_sa is None:
+            return None
+        decoder = by_sa.get(sa)
+        if decoder is None:
+            decoder = by_sa.get(None)
+        return decoder
+
+
+def load_decoders(filename):
+    '''
+    Read a declarative decoder file and return a DecoderRegistry.
+    '''
+    with open(filename) as f:
+        definitions = json.load(f)
+    registry = DecoderRegistry()
+    for definition in definitions['decoders']:
+        registry.add(PGNDecoder(**definition))
+    return registry
@@ -0,0 +1,245 @@
+'''
+Per PGN statistics behind the j1939_display 'message' stream.
+
+process_data used to keep these in summary_data as
+summary_data[interface]['source'][sa]['pgns'][pgn] dicts, looked up about
+ten times per frame, with list sums of ever growing ints and a time_delta
+string formatted for every frame. A PGNStats holds one (interface, sa, pgn)
+in slots, with everything raw:
+
+    count       frames seen
+    time        timestamp of the last frame
+    interval    seconds between the last two frames, None after the first
+    id, da      of the last frame
+    data        payload of the last frame
+    low, high   smallest and largest value of each of the first 8 bytes,
+                up to the current step
+
+and the moments of those bytes, as arrays of MOMENTS: the frame count of
+each payload length (elements 0 to 8, longer ones counted as 8), then the
+sum and sum of squares of each byte (elements 9 + i and 17 + i):
+
+    bucket      the current step of window/buckets seconds
+    window      the steps before it that are still in the window
+    totals      every step before it
+
+Bytes are integers, so the moments are exact and the variance comes from
+(n*squares - sum²)/(n*(n - 1)) without the cancellation that
+squares/count - mean² in floats suffers once the sums are large. The
+lifetime statistics are totals + bucket and the recent ones, "what is
+changing right now", window + bucket. A new step moves the bucket into
+totals and window and drops the oldest step from window, so no frame
+costs more than a fixed number of additions and an entry stays the same
+size however long the boat runs. Smallest and largest values can't be
+subtracted out again, so each step keeps its own low and high bytes next
+to its moments, and render() takes the window's from the few steps in it.
+
+Most PGNs repeat the same payload frame after frame, so the moments are
+not updated per frame: repeats counts the frames that carried data since
+it was last added in, and settle() adds the bytes repeats times over when
+the payload changes, the step ends or the entry is read. A frame costs
+one dict lookup, a time comparison, a bytes comparison and a few
+attribute updates; strings and deviations are only made by render(), when
+an update is sent.
+'''
+import array
+import collections
+import math
+
+RECENT_WINDOW = 5.0  # seconds
+RECENT_BUCKETS = 5
+MOMENTS = 25  # frames per payload length, sums and sums of squares of 8 bytes
+EMPTY_MOMENTS = array.array('Q', bytes(8*MOMENTS))
+
+# The per byte lists of render(), sent as {index: value} when only some change
+BYTE_FIELDS = ('std', 'mean', 'min', 'max', 'recent_std', 'recent_min', 'recent_max')
+
+
+def byte_stats(moments):
+    # [(mean, sample standard deviation) or None without frames] of the 8 bytes
+    stats = []
+    for i in range(8):
+        count = sum(moments[i + 1:9])  # the frames long enough to have byte i
+        total = moments[9 + i]
+        if not count:
+            stats.append(None)
+        elif count == 1:
+            stats.append((total, 0.0))
+        else:
+            variance = (count*moments[17 + i] - total*total)/(count*(count - 1))
+            stats.append((total/count, math.sqrt(variance)))
+    return stats
+
+
+class PGNStats:
+    __slots__ = ('interface', 'sa', 'pgn', 'count', 'time', 'interval', 'id', 'da', 'data', 'repeats',
+                 'low', 'high', 'bucket', 'bucket_low', 'bucket_high', 'bucket_span', 'window', 'steps', 'totals',
+                 'changed')
+
+    def __init__(self, interface, sa, pgn):
+        self.interface = interface
+        self.sa = sa
+        self.pgn = pgn
+        self.count = 0
+        self.time = None
+        self.interval = None
+        self.id = None
+        self.da = None
+        self.data = None
+        self.repeats = 0
+        self.low = bytearray(b'\xff'*8)
+        self.high = bytearray(8)
+        self.bucket = array.array('Q', EMPTY_MOMENTS)
+        self.bucket_low = bytearray(b'\xff'*8)
+        self.bucket_high = bytearray(8)
+        self.bucket_span = None  # (start, end) of the bucket's step
+        self.window = array.array('Q', EMPTY_MOMENTS)
+        self.steps = collections.deque()  # (moments, low, high) of the steps in window, None for an empty one
+        self.totals = array.array('Q', EMPTY_MOMENTS)
+        self.changed = False
+
+    def settle(self):
+        # Add the frames counted in repeats, all carrying data, to the bucket
+        repeats = self.repeats
+        if not repeats:
+            return
+        data = self.data[:8]
+        bucket = self.bucket
+        low = self.bucket_low
+        high = self.bucket_high
+        bucket[len(data)] += repeats
+        for i, value in enumerate(data):
+            bucket[9 + i] += value*repeats
+            bucket[17 + i] += value*value*repeats
+            if value < low[i]:
+                low[i] = value
+            if value > high[i]:
+                high[i] = value
+        self.repeats = 0
+
+    def step(self, now, step, buckets):
+        # Start the bucket of the step now falls in
+        if self.bucket_span is None:
+            self.bucket_span = (now, now + step)
+            return
+        self.settle()
+        start, end = self.bucket_span
+        bucket = self.bucket
+        bucket_low = self.bucket_low
+        bucket_high = self.bucket_high
+        totals = self.totals
+        for i in range(MOMENTS):
+            totals[i] += bucket[i]
+        self.low = bytearray(map(min, self.low, bucket_low))
+        self.high = bytearray(map(max, self.high, bucket_high))
+        passed = int((now - end)//step) + 1
+        if now < start or passed >= buckets:
+            # Replayed from the start again, or quiet for the whole window
+            self.steps.clear()
+            self.window = array.array('Q', EMPTY_MOMENTS)
+            start = now
+        else:
+            window = self.window
+            steps = self.steps
+            steps.append((bucket, bucket_low, bucket_high))
+            for i in range(MOMENTS):
+                window[i] += bucket[i]
+            steps.extend([None]*(passed - 1))
+            while len(steps) >= buckets:
+                dropped = steps.popleft()
+                if dropped is not None:
+                    dropped = dropped[0]
+                    for i in range(MOMENTS):
+                        window[i] -= dropped[i]
+            start = end + (passed - 1)*step
+        self.bucket = array.array('Q', EMPTY_MOMENTS)
+        self.bucket_low = bytearray(b'\xff'*8)
+        self.bucket_high = bytearray(8)
+        self.bucket_span = (start, start + step)
+
+    def render(self):
+        # What j1939_display shows for the PGN
+        self.settle()
+        if self.interval is None:
+            time_delta = "-1ms"
+        else:
+            time_delta = "{:d}ms".format(int(self.interval*1000))
+        bucket = self.bucket
+        lifetime = [a + b for a, b in zip(self.totals, bucket)]
+        recent = [a + b for a, b in zip(self.window, bucket)]
+        recent_low = self.bucket_low
+        recent_high = self.bucket_high
+        for moments_low_high in self.steps:
+            if moments_low_high is not None:
+                recent_low = map(min, recent_low, moments_low_high[1])
+                recent_high = map(max, recent_high, moments_low_high[2])
+        recent_low = bytearray(recent_low)
+        recent_high = bytearray(recent_high)
+        values = {field: [0]*8 for field in BYTE_FIELDS}
+        for i, (stats, recent_stats) in enumerate(zip(byte_stats(lifetime), byte_stats(recent))):
+            if stats is None:
+                continue
+            values['mean'][i] = round(stats[0], 1)
+            values['std'][i] = round(stats[1], 2)
+            values['min'][i] = min(self.low[i], recent_low[i])
+            values['max'][i] = max(self.high[i], recent_high[i])
+            if recent_stats is not None:
+                values['recent_std'][i] = round(recent_stats[1], 2)
+                values['recent_min'][i] = recent_low[i]
+                values['recent_max'][i] = recent_high[i]
+        return {'count': self.count,
+                'time_delta': time_delta,
+                'id': self.id,
+                'da': self.da,
+                'data': self.data.hex(' ').upper(),
+                **values}
+
+
+class StatsStore:
+    '''
+    The PGNStats of every (interface, sa, pgn) seen, and the ones updated
+    since the last take_changed(). The recent statistics cover the last
+    window seconds, in buckets steps.
+    '''
+    def __init__(self, window=RECENT_WINDOW, buckets=RECENT_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self.entries = {}
+        self.sources = {}  # (interface, sa): list of the source's PGNStats
+        self.changed = []
+
+    def update(self, interface, sa, pgn, can_time, da, can_id_string, can_data):
+        key = (interface, sa, pgn)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = PGNStats(interface, sa, pgn)
+            self.sources.setdefault((interface, sa), []).append(entry)
+            entry.step(can_time, self.window/self.buckets, self.buckets)
+        else:
+            entry.interval = can_time - entry.time
+            start, end = entry.bucket_span
+            if not start <= can_time < end:
+                entry.step(can_time, self.window/self.buckets, self.buckets)
+            elif can_data != entry.data:
+                entry.settle()
+        entry.count += 1
+        entry.time = can_time
+        entry.id = can_id_string
+        entry.da = da
+        entry.data = can_data
+        entry.repeats += 1
+        if not entry.changed:
+            entry.changed = True
+            self.changed.append(entry)
+        return entry
+
+    def take_changed(self):
+        # The entries updated since the last call, in the order first updated
+        changed = self.changed
+        self.changed = []
+        for entry in changed:
+            entry.changed = False
+        return changed
+
+    def source_count(self, interface, sa):
+        return sum(entry.count for entry in self.sources.get((interface, sa), ()))
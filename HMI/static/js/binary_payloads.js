@@ -0,0 +1,110 @@
+/* binary_payloads.js – decode the binary Socket.IO streams (see binary_payloads.py)
+ *
+ * Pages subscribe with {streams: [...], binary: true}. The server answers
+ * with binary only for the streams it can encode, so handlers pass every
+ * payload through decodePayload() and get the same object either way.
+ */
+(function () {
+  // Keep in step with NAV_FIELDS in binary_payloads.py: 11 float32 then 2 float64,
+  // then a MessagePack map of any other fields
+  const NAV_FIELDS = ['rudder', 'speed', 'hdg_goal', 'heading', 'steer', 'steer_goal',
+                      'cog', 'sog', 'depth', 'engine_rpm', 'satellites', 'latitude', 'longitude'];
+  const NAV_FLOATS = 11;
+  const NAV_SIZE = NAV_FLOATS * 4 + (NAV_FIELDS.length - NAV_FLOATS) * 8;
+
+  function decodeNavUpdate(view) {
+    const data = {};
+    NAV_FIELDS.forEach((name, i) => {
+      let value;
+      if (i < NAV_FLOATS) {
+        // Back to the shortest decimal the float32 stands for (3.4, not 3.4000000953674316)
+        value = parseFloat(view.getFloat32(i * 4, true).toPrecision(7));
+      } else {
+        value = view.getFloat64(NAV_FLOATS * 4 + (i - NAV_FLOATS) * 8, true);
+      }
+      data[name] = isNaN(value) ? null : value;
+    });
+    if (view.byteLength > NAV_SIZE) {
+      const extra = new DataView(view.buffer, view.byteOffset + NAV_SIZE, view.byteLength - NAV_SIZE);
+      Object.assign(data, decodeMsgpack(extra));
+    }
+    return data;
+  }
+
+  /* Minimal MessagePack decoder: nil, bool, int, float, str, bin, array, map */
+  function decodeMsgpack(view) {
+    let pos = 0;
+    const text = new TextDecoder();
+
+    function str(length) {
+      const value = text.decode(new Uint8Array(view.buffer, view.byteOffset + pos, length));
+      pos += length;
+      return value;
+    }
+    function bin(length) {
+      const value = view.buffer.slice(view.byteOffset + pos, view.byteOffset + pos + length);
+      pos += length;
+      return value;
+    }
+    function array(length) {
+      const value = new Array(length);
+      for (let i = 0; i < length; i++) value[i] = read();
+      return value;
+    }
+    function map(length) {
+      const value = {};
+      for (let i = 0; i < length; i++) {
+        const key = read();
+        value[key] = read();
+      }
+      return value;
+    }
+    function read() {
+      const type = view.getUint8(pos++);
+      let value;
+      if (type < 0x80) return type;                          // positive fixint
+      if (type < 0x90) return map(type & 0x0f);              // fixmap
+      if (type < 0xa0) return array(type & 0x0f);            // fixarray
+      if (type < 0xc0) return str(type & 0x1f);              // fixstr
+      if (type >= 0xe0) return type - 0x100;                 // negative fixint
+      switch (type) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: value = view.getUint8(pos); pos += 1; return bin(value);
+        case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+        case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+        case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+        case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+        case 0xcc: value = view.getUint8(pos); pos += 1; return value;
+        case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+        case 0xce: value = view.getUint32(pos); pos += 4; return value;
+        case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+        case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+        case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+        case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+        case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+        case 0xd9: value = view.getUint8(pos); pos += 1; return str(value);
+        case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+        case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+        case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+        case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+        case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+        case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+      }
+      throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    }
+    return read();
+  }
+
+  function decodePayload(stream, payload) {
+    if (!(payload instanceof ArrayBuffer) && !ArrayBuffer.isView(payload)) {
+      return payload;  // JSON
+    }
+    const view = payload instanceof ArrayBuffer ? new DataView(payload)
+                 : new DataView(payload.buffer, payload.byteOffset, payload.byteLength);
+    return stream === 'nav_update' ? decodeNavUpdate(view) : decodeMsgpack(view);
+  }
+
+  window.decodePayload = decodePayload;
+})();
@@ -20,6 +20,7 @@
     
     socket.on('connect', function() {
         console.log('Connected to WebSocket for compass updates.');
+        socket.emit('subscribe', {streams: ['nav_update'], binary: true});
     });
     
     socket.on('disconnect', function() {
@@ -28,7 +29,8 @@
 
 
 
-    socket.on('nav_update', data => {
+    socket.on('nav_update', payload => {
+      const data = decodePayload('nav_update', payload);
       console.log('[nav_update]', data);
       heading    = clamp360(data.heading);
       rudder     = data.rudder;
@@ -36,6 +38,7 @@
       goal       = clamp360(data.hdg_goal);
       steer      =  data.steer;
       steer_goal = data.steer_goal;    
+      updatePosition(data);
     });
     
    
@@ -109,6 +112,21 @@
   }
 
 
+  /* Position and COG come from the GNSS at ~1 Hz, so keep the last fix
+     shown until a newer one arrives */
+  function updatePosition(data) {
+    const pos = document.getElementById('position');
+    if (pos && data.latitude != null && data.longitude != null) {
+      const lat = Math.abs(data.latitude).toFixed(5) + (data.latitude >= 0 ? '°N' : '°S');
+      const lon = Math.abs(data.longitude).toFixed(5) + (data.longitude >= 0 ? '°E' : '°W');
+      pos.innerHTML = `${lat}<br>${lon}`;
+    }
+    const cog = document.getElementById('cog');
+    if (cog && data.cog != null) {
+      cog.textContent = fmtDeg(data.cog) + (data.sog != null ? ` ${fmtSpd(data.sog)}kn` : '');
+    }
+  }
+
   /* put this once near the top of the file */
   function fmtDeg(val, digits = 3) {
     try {
@@ -0,0 +1,47 @@
+import sqlite3
+
+import can_log
+from downsample import SignalSummary
+from pgn_decoders import DecoderRegistry
+
+TABLE = 'can_log_test'
+
+
+def records(start, count):
+    return [('can0', 0x10, 65280, start + i*0.01, 255, '18FF0010', '01', bytes([1]))
+            for i in range(count)]
+
+
+class WritingConnection(sqlite3.Connection):
+    # Commits more rows right after update() has read max(rowid), like the
+    # writer thread does while a summary is being extended
+    late_records = None
+
+    def execute(self, sql, *args):
+        cursor = super().execute(sql, *args)
+        if self.late_records and sql.startswith("SELECT max(rowid)"):
+            late, self.late_records = self.late_records, None
+            can_log.insert_records(self, TABLE, late)
+        return cursor
+
+
+def count(summary):
+    return sum(bucket[3] for bucket in summary.buckets.values())
+
+
+def test_rows_written_during_update_are_counted_once(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'log.db', factory=WritingConnection)
+    can_log.create_table(conn, TABLE)
+    can_log.insert_records(conn, TABLE, records(0, 100))
+    summary = SignalSummary((DecoderRegistry(), None, 0, [65280]))
+
+    summary.update(conn, TABLE)
+    assert count(summary) == 100
+
+    can_log.insert_records(conn, TABLE, records(1, 50))
+    conn.late_records = records(2, 50)
+    summary.update(conn, TABLE)
+    assert count(summary) == 150
+
+    summary.update(conn, TABLE)
+    assert count(summary) == 200